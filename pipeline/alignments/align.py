@@ -3,14 +3,19 @@
 Calculates alignments for a parallel corpus.
 
 Some efficiency measures were implemented as it needs to process 500M sentences long corpus for the student model:
-1. Tokenization with Moses with remapping the alignments back to whitespace based tokenization to reduce vocabulary size and improve accuracy
+1. Tokenization with Moses with remapping the alignments back to whitespace based tokenization to reduce vocabulary size and improve accuracy.
+   The tokenizer writes out the word index of every token, so the remapping is a vectorized lookup.
 2. Using fast C++ Moses tokenizer
-2. Parallelization with multiprocessing (tokenization and remapping)
+2. Parallelization with multiprocessing (tokenization, alignment and priors of the chunks, and remapping)
 3. Buffering on writing the output files to improve throughput
+4. Streaming the chunks to align from the compressed corpus, so that the full corpus is never decompressed to disk
+5. Optionally symmetrizing the alignments in parallel with NumPy instead of the single threaded
+   atools, with --symmetrizer=numpy
+6. Checkpointing the aligned chunks, so that a preempted task resumes instead of starting over
 
 
 Example:
-    BIN=bin SRC=ru TRG=en python pipeline/alignments/align.py \
+    SRC=ru TRG=en python pipeline/alignments/align.py \
         --corpus_src=fetches/corpus.ru.zst
         --corpus_trg=fetches/corpus.en.zst
         --output_path=artifacts/corpus.aln.zst
@@ -26,18 +31,77 @@ import subprocess
 import sys
 from contextlib import ExitStack
 from enum import Enum
-from glob import glob
-from typing import Dict, Optional
+from collections import Counter, deque
+from itertools import chain, count, islice
+from multiprocessing.pool import AsyncResult
+from typing import Dict, Generator, NamedTuple, Optional
 
-import zstandard
+import numpy as np
 from tqdm import tqdm
 
-from pipeline.alignments.tokenizer import tokenize, TokenizerType
-from pipeline.common.datasets import decompress
+from pipeline.alignments.checkpoint import (
+    AlignmentCheckpoint,
+    fetch_previous_checkpoint,
+    save_chunk,
+)
+from pipeline.alignments.symmetrize import (
+    Heuristic,
+    parse_alignments,
+    parse_ints,
+    symmetrize_with_atools,
+)
+from pipeline.alignments.symmetrize import symmetrize as symmetrize_alignments
+from pipeline.alignments.tokenizer import get_word_indices, tokenize, TokenizerType
+from pipeline.common import format_bytes
+from pipeline.common.downloads import get_file_digest, read_lines
 from pipeline.common.logging import get_logger
 
 logger = get_logger("alignments")
 
+# A rough estimate of the peak memory that eflomal uses per token of a part. It holds the
+# sentences, the links and the sampler state for both directions.
+BYTES_PER_TOKEN = 64
+
+# The number of lines that are read from a part to estimate the average sentence length.
+MEMORY_SAMPLE_LINES = 10_000
+
+# The number of lines that are sent to a worker at once when remapping the alignments.
+REMAP_BATCH_LINES = 100_000
+
+
+class AlignmentPart(NamedTuple):
+    """The input and output files of a chunk of the corpus that is aligned separately."""
+
+    suffix: str
+    src: str
+    trg: str
+    fwd: str
+    rev: str
+    priors_input_path: Optional[str]
+    # Count the priors of the part right after it is aligned.
+    calculate_priors: bool = False
+    # Save the alignments of the part to this checkpoint directory.
+    checkpoint_dir: Optional[str] = None
+
+
+class Priors(NamedTuple):
+    """The counts that eflomal uses as priors, in the order of `eflomal.calculate_priors`."""
+
+    lex: Counter
+    hmmf: Counter
+    hmmr: Counter
+    ferf: Counter
+    ferr: Counter
+
+    @staticmethod
+    def empty() -> "Priors":
+        return Priors(Counter(), Counter(), Counter(), Counter(), Counter())
+
+    def merge(self, other: "Priors") -> None:
+        """Add the counts of another part. The counts are summed, so the order doesn't matter."""
+        for counts, other_counts in zip(self, other):
+            counts.update(other_counts)
+
 
 class Tokenization(Enum):
     spaces = "spaces"
@@ -45,6 +109,13 @@ class Tokenization(Enum):
     icu = "icu"
 
 
+class Symmetrizer(Enum):
+    # The atools binary from fast_align, found in BIN. This stays the default until the NumPy
+    # symmetrizer is verified against it, see test_symmetrize_matches_atools.
+    atools = "atools"
+    numpy = "numpy"
+
+
 def run(
     corpus_src: str,
     corpus_trg: str,
@@ -54,28 +125,23 @@ def run(
     output_tokenized: bool,
     priors_input_path: Optional[str],
     priors_output_path: Optional[str],
+    num_workers: Optional[int] = None,
+    tokenization_cache: Optional[str] = None,
+    checkpoint_dir: Optional[str] = None,
+    symmetrizer: Symmetrizer = Symmetrizer.atools,
 ):
-    bin = os.environ["BIN"]
     src = os.environ["SRC"]
     trg = os.environ["TRG"]
 
     tmp_dir = os.path.join(os.path.dirname(output_path), "tmp")
     os.makedirs(tmp_dir, exist_ok=True)
 
-    corpus_src = maybe_decompress(corpus_src)
-    corpus_trg = maybe_decompress(corpus_trg)
-
     if tokenization == Tokenization.spaces:
         tokenized_src, tokenized_trg = corpus_src, corpus_trg
         output_aln = output_path
     else:
-        ext = f".tok-{tokenization.value}"
-        tokenized_src = (
-            corpus_src[: corpus_src.rfind(".")] + ext + corpus_src[corpus_src.rfind(".") :]
-        )
-        tokenized_trg = (
-            corpus_trg[: corpus_trg.rfind(".")] + ext + corpus_trg[corpus_trg.rfind(".") :]
-        )
+        tokenized_src = get_tokenized_path(corpus_src, tokenization, tmp_dir)
+        tokenized_trg = get_tokenized_path(corpus_trg, tokenization, tmp_dir)
         output_aln = os.path.join(tmp_dir, "aln")
 
         if tokenization == Tokenization.moses:
@@ -84,10 +150,32 @@ def run(
             tokenizer = TokenizerType.icu
         else:
             raise ValueError(f"Unrecognized tokenization type {tokenization}")
+        # The word indices are only needed for remapping the alignments.
+        src_word_indices = None if output_tokenized else f"{tokenized_src[:-4]}.word-indices.zst"
+        trg_word_indices = None if output_tokenized else f"{tokenized_trg[:-4]}.word-indices.zst"
         # C++ tokenizer can process 100k sentences per second on a single core,
         # so the chunks to parallelize things should be large enough to increase throughput
-        tokenize(corpus_src, tokenized_src, src, sentences_per_chunk=500000, tokenizer=tokenizer)
-        tokenize(corpus_trg, tokenized_trg, trg, sentences_per_chunk=500000, tokenizer=tokenizer)
+        tokenize(
+            corpus_src,
+            tokenized_src,
+            src,
+            sentences_per_chunk=500000,
+            tokenizer=tokenizer,
+            word_indices_path=src_word_indices,
+            cache_dir=tokenization_cache,
+        )
+        tokenize(
+            corpus_trg,
+            tokenized_trg,
+            trg,
+            sentences_per_chunk=500000,
+            tokenizer=tokenizer,
+            word_indices_path=trg_word_indices,
+            cache_dir=tokenization_cache,
+        )
+
+    if checkpoint_dir:
+        fetch_previous_checkpoint(checkpoint_dir)
 
     fwd_path, rev_path = align(
         corpus_src=tokenized_src,
@@ -95,29 +183,26 @@ def run(
         priors_input_path=priors_input_path,
         tmp_dir=tmp_dir,
         chunk_lines=chunk_lines,
+        num_workers=num_workers,
+        priors_output_path=priors_output_path,
+        checkpoint_dir=checkpoint_dir,
+    )
+    symmetrize(
+        fwd_path=fwd_path, rev_path=rev_path, output_path=output_aln, symmetrizer=symmetrizer
     )
-    symmetrize(bin=bin, fwd_path=fwd_path, rev_path=rev_path, output_path=output_aln)
-
-    if priors_output_path:
-        write_priors(
-            corpus_src=tokenized_src,
-            corpus_trg=tokenized_trg,
-            fwd_path=fwd_path,
-            rev_path=rev_path,
-            priors_output_path=priors_output_path,
-        )
 
     if tokenization != Tokenization.spaces:
         if output_tokenized:
             logger.info("Saving tokenized corpus")
-            # Copy tokenized corpus to output directory
+            # Move the compressed tokenized corpus to the output directory
             for file in tokenized_src, tokenized_trg:
-                output_corpus = shutil.move(file, os.path.dirname(output_path))
-                subprocess.check_call(["zstdmt", "-f", "--rm", output_corpus])
+                shutil.move(
+                    file, os.path.join(os.path.dirname(output_path), os.path.basename(file))
+                )
         else:
             # Remap alignments to whitespace based tokenization
             remapped_aln = os.path.join(tmp_dir, "aln.remapped")
-            remap(corpus_src, corpus_trg, tokenized_src, tokenized_trg, output_aln, remapped_aln)
+            remap(src_word_indices, trg_word_indices, output_aln, remapped_aln)
             output_aln = remapped_aln
 
     if output_path.endswith(".zst"):
@@ -126,12 +211,21 @@ def run(
         output_aln += ".zst"
     shutil.move(output_aln, output_path)
     shutil.rmtree(tmp_dir)
+    # The checkpoint is not needed once the task succeeded, so it's not uploaded with the outputs.
+    if checkpoint_dir and os.path.exists(checkpoint_dir):
+        shutil.rmtree(checkpoint_dir)
 
 
-def maybe_decompress(file_path: str):
-    if file_path.endswith(".zst"):
-        return str(decompress(file_path, remove=True, logger=logger))
-    return file_path
+def get_tokenized_path(corpus_path: str, tokenization: Tokenization, tmp_dir: str) -> str:
+    """
+    The tokenized corpus is written compressed to the tmp dir,
+    e.g. "fetches/corpus.en.zst" -> "artifacts/tmp/corpus.tok-icu.en.zst"
+    """
+    name = os.path.basename(corpus_path)
+    if name.endswith(".zst"):
+        name = name[: -len(".zst")]
+    ext = f".tok-{tokenization.value}"
+    return os.path.join(tmp_dir, name[: name.rfind(".")] + ext + name[name.rfind(".") :] + ".zst")
 
 
 def align(
@@ -140,139 +234,314 @@ def align(
     tmp_dir: str,
     chunk_lines: int,
     priors_input_path: Optional[str],
+    num_workers: Optional[int] = None,
+    priors_output_path: Optional[str] = None,
+    checkpoint_dir: Optional[str] = None,
 ):
-    import eflomal
+    """
+    Align the corpus in chunks to prevent OOM. The chunks are streamed from the (possibly
+    compressed) corpus into temporary files right before they are aligned, and the files are
+    removed as soon as the chunk is finished, so only a few chunks are on disk at once.
 
-    logger.info("Splitting corpus into parts")
-    # align in chunks to prevent OOM
-    # produces chunks of files, like "corpus.en.aa", "corpus.en.ab", "corpus.en.ac" etc.
-    subprocess.check_call(["split", "--lines", str(chunk_lines), corpus_src, corpus_src + "."])
-    subprocess.check_call(["split", "--lines", str(chunk_lines), corpus_trg, corpus_trg + "."])
+    When a priors_output_path is provided, the priors of each chunk are counted by the worker
+    that aligned it, and the counts are summed as the chunks are merged.
 
+    When a checkpoint_dir is provided, every aligned chunk is saved there and recorded in its
+    manifest. The chunks that are already in the manifest with the same input digests are
+    merged from the checkpoint instead of being aligned again.
+    """
     fwd_path = os.path.join(tmp_dir, "aln.fwd")
     rev_path = os.path.join(tmp_dir, "aln.rev")
 
-    for src_part in sorted(glob(f"{corpus_src}.*")):
-        suffix = src_part.split(".")[-1]
-        logger.info(f"Processing part {suffix}")
+    if priors_input_path:
+        logger.info(f"Using provided priors: {priors_input_path}")
 
-        with ExitStack() as stack:
-            if priors_input_path:
-                logger.info(f"Using provided priors: {priors_input_path}")
-                priors_input = stack.enter_context(open(priors_input_path, "r", encoding="utf-8"))
-            else:
-                priors_input = None
-
-            src_input = stack.enter_context(open(f"{corpus_src}.{suffix}", "r", encoding="utf-8"))
-            trg_input = stack.enter_context(open(f"{corpus_trg}.{suffix}", "r", encoding="utf-8"))
-
-            logger.info("Calculating alignments...")
-            # We use eflomal aligner.
-            # It is less memory intensive than fast_align.
-            # fast_align failed with OOM in a large white-space tokenized corpus
-            aligner = eflomal.Aligner()
-            aligner.align(
-                src_input,
-                trg_input,
-                links_filename_fwd=f"{fwd_path}.{suffix}",
-                links_filename_rev=f"{rev_path}.{suffix}",
-                priors_input=priors_input,
-                quiet=False,
-                use_gdb=False,
-            )
+    priors = Priors.empty()
+    checkpoint = AlignmentCheckpoint(checkpoint_dir, priors_input_path) if checkpoint_dir else None
+    # The digests of the inputs of the parts that are being aligned, by the part suffix.
+    digests: dict[str, tuple[str, str]] = {}
+
+    with ExitStack() as stack:
+        fwd_out = stack.enter_context(open(fwd_path, "wb"))
+        rev_out = stack.enter_context(open(rev_path, "wb"))
+
+        def merge_part(part: AlignmentPart, part_priors: Optional[Priors]):
+            # Merge alignments parts into one file, in the order of the parts
+            logger.info(f"Merging alignments of part {part.suffix}")
+            for part_path, out in (part.fwd, fwd_out), (part.rev, rev_out):
+                with open(part_path, "rb") as part_file:
+                    shutil.copyfileobj(part_file, out, length=2**20)
+                os.remove(part_path)
+            if part_priors:
+                priors.merge(part_priors)
+            if checkpoint:
+                checkpoint.add(
+                    part.suffix, *digests.pop(part.suffix), with_priors=part.calculate_priors
+                )
+
+        def resume_part(part: AlignmentPart) -> bool:
+            """Merge the part from the checkpoint if it was already aligned."""
+            if not checkpoint:
+                return False
+            part_digests = get_file_digest(part.src), get_file_digest(part.trg)
+            if not checkpoint.find(part.suffix, *part_digests, part.calculate_priors):
+                digests[part.suffix] = part_digests
+                return False
+            os.remove(part.src)
+            os.remove(part.trg)
+            logger.info(f"Merging alignments of part {part.suffix} from the checkpoint")
+            part_priors = checkpoint.load_chunk(part.suffix, fwd_out, rev_out)
+            if part_priors:
+                priors.merge(part_priors)
+            return True
+
+        parts = write_parts(
+            corpus_src,
+            corpus_trg,
+            tmp_dir,
+            chunk_lines,
+            priors_input_path,
+            calculate_priors=bool(priors_output_path),
+            checkpoint_dir=checkpoint_dir,
+        )
+        first_part = next(parts, None)
+        if first_part is None:
+            logger.info("The corpus is empty")
+            parts = iter([])
+            num_workers = 1
+        else:
+            parts = chain([first_part], parts)
+            num_workers = get_num_workers(first_part, chunk_lines, num_workers)
+            logger.info(f"Aligning the parts with {num_workers} workers")
+
+        if num_workers == 1:
+            for part in parts:
+                if not resume_part(part):
+                    merge_part(part, align_part(part))
+        else:
+            pool = stack.enter_context(multiprocessing.Pool(processes=num_workers))
+            pending: deque[tuple[AlignmentPart, AsyncResult]] = deque()
+            for part in parts:
+                # The parts are merged in order, so a part can only be resumed from the
+                # checkpoint once the parts before it are merged.
+                while pending and checkpoint and checkpoint.chunks.get(part.suffix):
+                    finished_part, result = pending.popleft()
+                    merge_part(finished_part, result.get())
+                if resume_part(part):
+                    continue
+                pending.append((part, pool.apply_async(align_part, (part,))))
+                # Don't write out the next part until a worker is about to become free. The
+                # parts are of equal size, so the oldest part should be the first one to finish.
+                while len(pending) >= num_workers:
+                    finished_part, result = pending.popleft()
+                    merge_part(finished_part, result.get())
+
+            while pending:
+                finished_part, result = pending.popleft()
+                merge_part(finished_part, result.get())
 
-    # Merge alignments parts into one file
-    with open(fwd_path, "w") as fwd_out:
-        fwd_parts = sorted(glob(f"{fwd_path}.*"))
-        logger.info(f"Merging alignments: {fwd_parts}")
-        subprocess.check_call(["cat"] + fwd_parts, stdout=fwd_out)
-    with open(rev_path, "w") as rev_out:
-        rev_parts = sorted(glob(f"{rev_path}.*"))
-        logger.info(f"Merging alignments: {rev_parts}")
-        subprocess.check_call(["cat"] + rev_parts, stdout=rev_out)
+    if priors_output_path:
+        write_priors(priors, priors_output_path)
 
     return fwd_path, rev_path
 
 
-def symmetrize(bin: str, fwd_path: str, rev_path: str, output_path: str):
+def write_parts(
+    corpus_src: str,
+    corpus_trg: str,
+    tmp_dir: str,
+    chunk_lines: int,
+    priors_input_path: Optional[str],
+    calculate_priors: bool = False,
+    checkpoint_dir: Optional[str] = None,
+) -> Generator[AlignmentPart, None, None]:
     """
-    Symmetrize the forward and reverse alignments of the corpus.
+    Lazily write out the parts of the corpus with up to chunk_lines lines, e.g. "tmp/part.0.src",
+    "tmp/part.0.trg", "tmp/part.1.src", ... The next part is only written when it's requested.
+    """
+    with read_lines(corpus_src) as src_lines, read_lines(corpus_trg) as trg_lines:
+        lines = zip(src_lines, trg_lines)
+        for index in count():
+            suffix = str(index)
+            part = AlignmentPart(
+                suffix,
+                src=os.path.join(tmp_dir, f"part.{suffix}.src"),
+                trg=os.path.join(tmp_dir, f"part.{suffix}.trg"),
+                fwd=os.path.join(tmp_dir, f"aln.fwd.{suffix}"),
+                rev=os.path.join(tmp_dir, f"aln.rev.{suffix}"),
+                priors_input_path=priors_input_path,
+                calculate_priors=calculate_priors,
+                checkpoint_dir=checkpoint_dir,
+            )
+            part_lines = 0
+            with open(part.src, "w", encoding="utf-8") as src_out, open(
+                part.trg, "w", encoding="utf-8"
+            ) as trg_out:
+                for src_line, trg_line in islice(lines, chunk_lines):
+                    src_out.write(src_line)
+                    trg_out.write(trg_line)
+                    part_lines += 1
 
-    Alignments are generated in two directions, source to target, and target to source.
-    This function symmetrizes them so that both directions share the same alignment information.
-    It uses `atools` binary from `fast_align`
+            if part_lines == 0:
+                os.remove(part.src)
+                os.remove(part.trg)
+                return
+
+            logger.info(f"Wrote part {suffix} with {part_lines:,} lines")
+            yield part
+
+
+def align_part(part: AlignmentPart) -> Optional[Priors]:
     """
-    logger.info("Symmetrizing alignments...")
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    # Wrap the file with a compressor stream if it needs to be compressed
+    Align a single part of the corpus. This runs in a worker process when aligning in parallel.
+    The priors of the part are counted while its files are still around, if requested.
+    """
+    import eflomal
+
+    logger.info(f"Processing part {part.suffix}")
+
     with ExitStack() as stack:
-        with (
-            zstandard.ZstdCompressor().stream_writer(stack.enter_context(open(output_path, "wb")))
-            if output_path.endswith(".zst")
-            else stack.enter_context(open(output_path, "w", encoding="utf-8"))
-        ) as stream:
-            with subprocess.Popen(
-                [
-                    os.path.join(bin, "atools"),
-                    "-i",
-                    fwd_path,
-                    "-j",
-                    rev_path,
-                    "-c",
-                    "grow-diag-final-and",
-                ],
-                stdout=subprocess.PIPE,
-                text=True,
-                bufsize=1,
-                encoding="utf-8",
-            ) as proc:
-                for line in proc.stdout:
-                    stream.write(line.encode("utf-8") if output_path.endswith(".zst") else line)
-
-                proc.wait()
-                # Check for any errors in the subprocess execution
-                if proc.returncode != 0:
-                    logger.error(f"atools exit code: {proc.returncode}")
-                    raise subprocess.CalledProcessError(proc.returncode, proc.args)
-
-
-def write_priors(
-    corpus_src: str,
-    corpus_trg: str,
+        if part.priors_input_path:
+            priors_input = stack.enter_context(open(part.priors_input_path, "r", encoding="utf-8"))
+        else:
+            priors_input = None
+
+        src_input = stack.enter_context(open(part.src, "r", encoding="utf-8"))
+        trg_input = stack.enter_context(open(part.trg, "r", encoding="utf-8"))
+
+        logger.info(f"Calculating alignments for part {part.suffix}...")
+        # We use eflomal aligner.
+        # It is less memory intensive than fast_align.
+        # fast_align failed with OOM in a large white-space tokenized corpus
+        aligner = eflomal.Aligner()
+        aligner.align(
+            src_input,
+            trg_input,
+            links_filename_fwd=part.fwd,
+            links_filename_rev=part.rev,
+            priors_input=priors_input,
+            quiet=False,
+            use_gdb=False,
+        )
+
+    priors = None
+    if part.calculate_priors:
+        logger.info(f"Calculating priors for part {part.suffix}...")
+        with ExitStack() as stack:
+            priors = Priors(
+                *eflomal.calculate_priors(
+                    stack.enter_context(open(part.src, "r", encoding="utf-8")),
+                    stack.enter_context(open(part.trg, "r", encoding="utf-8")),
+                    stack.enter_context(open(part.fwd, "r", encoding="utf-8")),
+                    stack.enter_context(open(part.rev, "r", encoding="utf-8")),
+                )
+            )
+
+    if part.checkpoint_dir:
+        logger.info(f"Saving part {part.suffix} to the checkpoint")
+        save_chunk(part.checkpoint_dir, part.suffix, part.fwd, part.rev, priors)
+
+    os.remove(part.src)
+    os.remove(part.trg)
+    return priors
+
+
+def estimate_part_memory(src_part: str, trg_part: str, chunk_lines: int) -> int:
+    """
+    Estimate the peak memory of aligning a part from its number of lines and the average number
+    of tokens per line, which is sampled from the beginning of the part.
+    """
+    lines = 0
+    tokens = 0
+    with open(src_part, "r", encoding="utf-8") as src, open(
+        trg_part, "r", encoding="utf-8"
+    ) as trg:
+        for src_line, trg_line in islice(zip(src, trg), MEMORY_SAMPLE_LINES):
+            lines += 1
+            tokens += len(src_line.split()) + len(trg_line.split())
+
+    if lines == 0:
+        return BYTES_PER_TOKEN
+    return int(chunk_lines * tokens / lines * BYTES_PER_TOKEN)
+
+
+def get_num_workers(part: AlignmentPart, chunk_lines: int, num_workers: Optional[int]) -> int:
+    """
+    Determine how many parts can be aligned at once. Unless it is set explicitly, this is
+    limited by the CPUs and how many parts fit in the available memory.
+    """
+    if num_workers:
+        return max(1, num_workers)
+
+    import psutil
+
+    # All of the parts are the same size except the last, so estimate from the first.
+    part_memory = estimate_part_memory(part.src, part.trg, chunk_lines)
+    available_memory = psutil.virtual_memory().available
+    fits_in_memory = available_memory // max(part_memory, 1)
+    logger.info(
+        f"Estimated memory per part: {format_bytes(part_memory)}, "
+        f"available: {format_bytes(available_memory)}"
+    )
+
+    return int(max(1, min(multiprocessing.cpu_count(), fits_in_memory)))
+
+
+def symmetrize(
     fwd_path: str,
     rev_path: str,
-    priors_output_path: str,
+    output_path: str,
+    symmetrizer: Symmetrizer = Symmetrizer.atools,
 ):
+    """
+    Symmetrize the forward and reverse alignments of the corpus.
+
+    Alignments are generated in two directions, source to target, and target to source.
+    This function symmetrizes them with grow-diag-final-and so that both directions share the
+    same alignment information. By default this runs the `atools` binary from `fast_align`,
+    and the NumPy implementation in `pipeline/alignments/symmetrize.py` is opt-in.
+    """
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    if symmetrizer == Symmetrizer.atools:
+        symmetrize_with_atools(
+            atools_path=os.path.join(os.environ["BIN"], "atools"),
+            fwd_path=fwd_path,
+            rev_path=rev_path,
+            output_path=output_path,
+            heuristic=Heuristic.grow_diag_final_and,
+        )
+        return
+
+    symmetrize_alignments(
+        fwd_path=fwd_path,
+        rev_path=rev_path,
+        output_path=output_path,
+        heuristic=Heuristic.grow_diag_final_and,
+    )
+
+
+def write_priors(priors: Priors, priors_output_path: str):
     import eflomal
 
-    logger.info("Calculating priors...")
-    with ExitStack() as stack:
-        src_input = stack.enter_context(open(corpus_src, "r", encoding="utf-8"))
-        trg_input = stack.enter_context(open(corpus_trg, "r", encoding="utf-8"))
-        fwd_f = stack.enter_context(open(fwd_path, "r", encoding="utf-8"))
-        rev_f = stack.enter_context(open(rev_path, "r", encoding="utf-8"))
-        priors_tuple = eflomal.calculate_priors(src_input, trg_input, fwd_f, rev_f)
-        logger.info(f"Writing priors to {priors_output_path}...")
-        priors_output = stack.enter_context(open(priors_output_path, "w", encoding="utf-8"))
-        eflomal.write_priors(priors_output, *priors_tuple)
+    logger.info(f"Writing priors to {priors_output_path}...")
+    with open(priors_output_path, "w", encoding="utf-8") as priors_output:
+        eflomal.write_priors(priors_output, *priors)
 
 
 def remap(
-    src_path: str,
-    trg_path: str,
-    tok_src_path: str,
-    tok_trg_path: str,
+    src_word_indices_path: str,
+    trg_word_indices_path: str,
     aln_path: str,
     output_aln_path: str,
 ) -> None:
     """
     Remaps alignments that were calculated for tokenized corpus to whitespace-tokenized ones.
-    :param src_path: path to whitespace-tokenized sentences in source language
-    :param trg_path: path to whitespace-tokenized sentences in target language
-    :param tok_src_path: path to tokenized sentences in source language
-    :param tok_trg_path: path to tokenized sentences in target language
+    :param src_word_indices_path: path to the word indices of the source tokens
+    :param trg_word_indices_path: path to the word indices of the target tokens
     :param aln_path: path to the alignments calculated for tokenized corpus
     :param output_aln_path: path to output alignments file remapped to whitespace-tokenized corpus
+
+    The word indices are written by the tokenizer, see `tokenize_with_word_indices`.
     """
     logger.info("Remapping alignments to whitespace tokenization")
 
@@ -282,34 +551,58 @@ def remap(
         output = stack.enter_context(open(output_aln_path, "w", buffering=500000))
 
         lines = zip(
-            stack.enter_context(open(src_path)),
-            stack.enter_context(open(trg_path)),
-            stack.enter_context(open(tok_src_path)),
-            stack.enter_context(open(tok_trg_path)),
+            stack.enter_context(read_lines(src_word_indices_path)),
+            stack.enter_context(read_lines(trg_word_indices_path)),
             stack.enter_context(open(aln_path)),
         )
+        batches = iter(lambda: list(islice(lines, REMAP_BATCH_LINES)), [])
 
-        # send lines to worker processes in chunks
-        for aln in tqdm(pool.imap(remap_line, lines, chunksize=10000), mininterval=10):
-            output.write(aln)
+        # send batches of lines to worker processes
+        pbar = tqdm(mininterval=10)
+        for batch_lines, remapped in pool.imap(remap_batch, batches):
+            output.write(remapped)
+            pbar.update(batch_lines)
 
 
-def remap_line(params):
+def remap_batch(batch: list[tuple[str, str, str]]) -> tuple[int, str]:
     """
-    Remaps alignments for a single line in a corpus
+    Remaps the alignments for a batch of lines. The alignment pairs of all of the lines are
+    gathered through the word indices at once, and the duplicate pairs are removed while
+    keeping the order of the first occurrences.
     """
-    src, trg, tok_src, tok_trg, aln = params
-    src_map = map_indices(tok_src, src)
-    trg_map = map_indices(tok_trg, trg)
+    src_lines, trg_lines, aln_lines = zip(*batch)
+    src_indices, src_counts = parse_ints(src_lines)
+    trg_indices, trg_counts = parse_ints(trg_lines)
+    pairs, pair_counts = parse_alignments(aln_lines)
+
+    line_ids = np.repeat(np.arange(len(batch)), pair_counts)
+    if np.any(pairs[:, 0] >= src_counts[line_ids]) or np.any(pairs[:, 1] >= trg_counts[line_ids]):
+        raise Exception("The alignments don't match the word indices of the tokenized corpus")
+
+    src_offsets = np.concatenate(([0], np.cumsum(src_counts)[:-1]))
+    trg_offsets = np.concatenate(([0], np.cumsum(trg_counts)[:-1]))
+    remapped = np.stack(
+        [
+            line_ids,
+            src_indices[src_offsets[line_ids] + pairs[:, 0]],
+            trg_indices[trg_offsets[line_ids] + pairs[:, 1]],
+        ],
+        axis=1,
+    )
+    # Whitespace tokens don't belong to any word.
+    remapped = remapped[(remapped[:, 1] >= 0) & (remapped[:, 2] >= 0)]
+
+    _, first_occurrences = np.unique(remapped, axis=0, return_index=True)
+    remapped = remapped[np.sort(first_occurrences)]
 
-    remapped_aln = []
-    for pair in aln.split():
-        src_idx, trg_idx = map(int, pair.split("-"))
-        new_pair = (src_map[src_idx], trg_map[trg_idx])
-        if new_pair not in remapped_aln:
-            remapped_aln.append(new_pair)
+    pair_strings = [f"{src_idx}-{trg_idx}" for _, src_idx, trg_idx in remapped.tolist()]
+    output = []
+    start = 0
+    for line_pairs in np.bincount(remapped[:, 0], minlength=len(batch)).tolist():
+        output.append(" ".join(pair_strings[start : start + line_pairs]) + "\n")
+        start += line_pairs
 
-    return " ".join([f"{idx1}-{idx2}" for idx1, idx2 in remapped_aln]) + "\n"
+    return len(batch), "".join(output)
 
 
 def map_indices(tok_sentence: str, orig_sentence: str) -> Dict[int, int]:
@@ -318,29 +611,14 @@ def map_indices(tok_sentence: str, orig_sentence: str) -> Dict[int, int]:
     :param tok_sentence: tokenized sentence
     :param orig_sentence: original sentence
     :return: Dictionary of indices that maps tokenized words to original words
-    """
-    tok_words = tok_sentence.split()
-    orig_words = orig_sentence.split()
-    tok_to_orig_indices = {}
-    orig_idx = 0
-    tok_idx = 0
-
-    # For 'Hello, world!'
-    # Map ['Hello', ',', 'world', '!'] [0, 1, 2, 3]
-    # To ['Hello,', 'world!'] [0, 1]
-    # tok -> orig: {0: 0, 1: 0, 2: 1, 3: 1}
 
-    while orig_idx < len(orig_words):
-        orig_word = orig_words[orig_idx]
-        word = ""
-        while tok_idx < len(tok_words) and word != orig_word:
-            word += tok_words[tok_idx]
-            tok_to_orig_indices[tok_idx] = orig_idx
-            tok_idx += 1
-
-        orig_idx += 1
-
-    return tok_to_orig_indices
+    For 'Hello, world!'
+    Map ['Hello', ',', 'world', '!'] [0, 1, 2, 3]
+    To ['Hello,', 'world!'] [0, 1]
+    tok -> orig: {0: 0, 1: 0, 2: 1, 3: 1}
+    """
+    word_indices = get_word_indices(tok_sentence.split(), orig_sentence)
+    return {tok_idx: orig_idx for tok_idx, orig_idx in enumerate(word_indices) if orig_idx >= 0}
 
 
 def main() -> None:
@@ -414,6 +692,38 @@ def main() -> None:
         help="Split corpus to chunks of N lines to calculate alignments on them separately. "
         "This helps with reducing the memory footprint. 100M by default.",
     )
+    parser.add_argument(
+        "--num_workers",
+        metavar="NUM_WORKERS",
+        type=int,
+        default=None,
+        help="The number of chunks to align in parallel. By default this is determined from "
+        "the number of CPUs and how many chunks fit in the available memory.",
+    )
+    parser.add_argument(
+        "--tokenization_cache",
+        metavar="TOKENIZATION_CACHE",
+        type=str,
+        default=None,
+        help="A directory of previously tokenized chunks of text to reuse. Newly tokenized "
+        "chunks are added to it.",
+    )
+    parser.add_argument(
+        "--checkpoint_dir",
+        metavar="CHECKPOINT_DIR",
+        type=str,
+        default=None,
+        help="Save the aligned chunks to this directory, and resume from the chunks that are "
+        "already there. On Taskcluster, the checkpoint of a previous run of the task is reused.",
+    )
+    parser.add_argument(
+        "--symmetrizer",
+        metavar="SYMMETRIZER",
+        type=Symmetrizer,
+        choices=list(Symmetrizer),
+        default=Symmetrizer.atools,
+        help="Symmetrize the alignments with `$BIN/atools` from fast_align, or with NumPy.",
+    )
     args = parser.parse_args()
     logger.info("Starting generating alignments.")
     run(
@@ -425,6 +735,10 @@ def main() -> None:
         output_tokenized=args.output_tokenized,
         priors_input_path=args.priors_input_path,
         priors_output_path=args.priors_output_path,
+        num_workers=args.num_workers,
+        tokenization_cache=args.tokenization_cache,
+        checkpoint_dir=args.checkpoint_dir,
+        symmetrizer=args.symmetrizer,
     )
     logger.info("Finished generating alignments.")
 
@@ -0,0 +1,142 @@
+"""
+Checkpoints for the chunks of a long alignment run, so that a task that was preempted resumes
+from the chunks that were already aligned instead of starting over.
+
+The alignments (and priors) of every chunk are saved compressed to the checkpoint directory,
+and a manifest records which files belong to which chunk, along with the digests of the chunk
+inputs. A chunk is only reused when its inputs have the same digests.
+
+    artifacts/checkpoint
+    ├── alignments-checkpoint.json
+    ├── aln.fwd.0.zst
+    ├── aln.rev.0.zst
+    ├── priors.0.pkl
+    └── ...
+
+On Taskcluster, the checkpoint directory is part of the artifacts, so a retried task downloads
+the checkpoint of the previous run, the same way that the training is continued.
+"""
+
+import json
+import os
+import pickle
+from typing import Iterable, Optional
+
+from zstandard import ZstdCompressor, ZstdDecompressor
+
+from pipeline.common.downloads import (
+    atomic_write,
+    download_previous_run_checkpoint,
+    get_file_digest,
+)
+from pipeline.common.logging import get_logger
+
+logger = get_logger("alignments")
+
+MANIFEST_NAME = "alignments-checkpoint.json"
+MANIFEST_VERSION = 1
+
+
+def get_chunk_paths(checkpoint_dir: str, suffix: str) -> tuple[str, str, str]:
+    """The paths of the forward and reverse alignments, and the priors of a chunk."""
+    return (
+        os.path.join(checkpoint_dir, f"aln.fwd.{suffix}.zst"),
+        os.path.join(checkpoint_dir, f"aln.rev.{suffix}.zst"),
+        os.path.join(checkpoint_dir, f"priors.{suffix}.pkl"),
+    )
+
+
+def save_chunk(checkpoint_dir: str, suffix: str, fwd_path: str, rev_path: str, priors) -> None:
+    """
+    Compress the alignments of a chunk into the checkpoint, and pickle its priors. This runs in
+    the worker that aligned the chunk, and the chunk is only recorded in the manifest afterwards.
+    """
+    fwd, rev, priors_path = get_chunk_paths(checkpoint_dir, suffix)
+    compressor = ZstdCompressor()
+    for path, checkpoint_path in (fwd_path, fwd), (rev_path, rev):
+        with open(path, "rb") as infile, open(f"{checkpoint_path}.tmp", "wb") as outfile:
+            compressor.copy_stream(infile, outfile)
+        os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
+    if priors:
+        atomic_write(priors_path, pickle.dumps(priors))
+
+
+class AlignmentCheckpoint:
+    """
+    The manifest of the aligned chunks. It is only written by the main process, as the chunks
+    are merged in order.
+    """
+
+    def __init__(self, checkpoint_dir: str, priors_input_path: Optional[str]) -> None:
+        self.checkpoint_dir = checkpoint_dir
+        self.manifest_path = os.path.join(checkpoint_dir, MANIFEST_NAME)
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        # The alignments of a chunk depend on the priors, so they are a part of the key.
+        self.priors_input_digest = (
+            get_file_digest(priors_input_path) if priors_input_path else None
+        )
+        self.chunks: dict[str, dict] = {}
+
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as file:
+                manifest = json.load(file)
+            if (
+                manifest.get("version") == MANIFEST_VERSION
+                and manifest.get("priors_input_digest") == self.priors_input_digest
+            ):
+                self.chunks = manifest["chunks"]
+                logger.info(f"Loaded a checkpoint with {len(self.chunks)} aligned chunks")
+            else:
+                logger.info("The checkpoint was made with different settings, ignoring it")
+
+    def find(self, suffix: str, src_digest: str, trg_digest: str, with_priors: bool) -> bool:
+        """Check if a chunk with the same inputs was already aligned."""
+        chunk = self.chunks.get(suffix)
+        if (
+            not chunk
+            or chunk["src_digest"] != src_digest
+            or chunk["trg_digest"] != trg_digest
+            or (with_priors and not chunk["priors"])
+        ):
+            return False
+        fwd, rev, priors = get_chunk_paths(self.checkpoint_dir, suffix)
+        paths = [fwd, rev, priors] if with_priors else [fwd, rev]
+        return all(os.path.exists(path) for path in paths)
+
+    def add(self, suffix: str, src_digest: str, trg_digest: str, with_priors: bool) -> None:
+        """Record a chunk once its files are saved, and write out the manifest atomically."""
+        fwd, rev, priors = get_chunk_paths(self.checkpoint_dir, suffix)
+        self.chunks[suffix] = {
+            "src_digest": src_digest,
+            "trg_digest": trg_digest,
+            "fwd": os.path.basename(fwd),
+            "rev": os.path.basename(rev),
+            "priors": os.path.basename(priors) if with_priors else None,
+        }
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "priors_input_digest": self.priors_input_digest,
+            "chunks": self.chunks,
+        }
+        atomic_write(self.manifest_path, json.dumps(manifest, indent=2).encode("utf-8"))
+
+    def load_chunk(self, suffix: str, fwd_out, rev_out):
+        """Write out the alignments of a chunk from the checkpoint, and return its priors."""
+        fwd, rev, priors_path = get_chunk_paths(self.checkpoint_dir, suffix)
+        for path, out in (fwd, fwd_out), (rev, rev_out):
+            with open(path, "rb") as infile:
+                ZstdDecompressor().copy_stream(infile, out)
+        if not self.chunks[suffix]["priors"]:
+            return None
+        with open(priors_path, "rb") as file:
+            return pickle.load(file)
+
+
+def fetch_previous_checkpoint(checkpoint_dir: str) -> None:
+    """Download the checkpoint of a previous run when the Taskcluster task is retried."""
+
+    def get_file_names(manifest: dict) -> Iterable[str]:
+        for chunk in manifest["chunks"].values():
+            yield from (name for name in (chunk["fwd"], chunk["rev"], chunk["priors"]) if name)
+
+    download_previous_run_checkpoint(checkpoint_dir, MANIFEST_NAME, get_file_names)
@@ -2,16 +2,18 @@
 ##
 # Generates a lexical shortlist for a corpus.
 #
+# The corpus is encoded with SentencePiece and aligned, and the lexical probabilities are
+# extracted with $BIN/extract_lex and pruned, see shortlist.py
 #
-# It also generate SentencePiece tokenized alignments that are required for extract_lex
+# Set EXTRACT_LEX to another extract_lex binary, or to an empty string to count and prune the
+# probabilities in Python instead. The Python counting stays opt-in until it is verified against
+# extract_lex, see test_count_and_prune_matches_extract_lex.
 #
 
 set -x
 set -euo pipefail
 
 echo "###### Generating alignments and shortlist"
-[[ -z "${MARIAN}" ]] && echo "MARIAN is empty"
-[[ -z "${BIN}" ]] && echo "BIN is empty"
 [[ -z "${SRC}" ]] && echo "SRC is empty"
 [[ -z "${TRG}" ]] && echo "TRG is empty"
 
@@ -27,51 +29,20 @@ fi
 cd "$(dirname "${0}")"
 
 mkdir -p "${output_dir}"
-dir="${output_dir}/tmp_shortlist"
-mkdir -p "${dir}"
 
-corpus_src="${corpus_prefix}.${SRC}.zst"
-corpus_trg="${corpus_prefix}.${TRG}.zst"
-
-
-echo "### Subword segmentation with SentencePiece"
-zstdmt -dc "${corpus_src}" |
-  parallel --no-notice --pipe -k -j "${threads}" --block 50M "${MARIAN}/spm_encode" --model "${vocab_path}" \
-   >"${dir}/corpus.spm.${SRC}"
-
-zstdmt -dc "${corpus_trg}" |
-  parallel --no-notice --pipe -k -j "${threads}" --block 50M "${MARIAN}/spm_encode" --model "${vocab_path}" \
-   >"${dir}/corpus.spm.${TRG}"
-
-python3 align.py \
-  --corpus_src="${dir}/corpus.spm.${SRC}" \
-  --corpus_trg="${dir}/corpus.spm.${TRG}" \
-  --output_path="${output_dir}/corpus.aln"
-
-echo "### Creating shortlist"
-"${BIN}/extract_lex" \
-  "${dir}/corpus.spm.${TRG}" \
-  "${dir}/corpus.spm.${SRC}" \
-  "${output_dir}/corpus.aln" \
-  "${dir}/lex.s2t" \
-  "${dir}/lex.t2s"
-
-if [ -f "${dir}/lex.s2t" ]; then
-  zstdmt "${dir}/lex.s2t"
+extract_lex="${EXTRACT_LEX-${BIN}/extract_lex}"
+extract_lex_args=()
+if [ -n "${extract_lex}" ]; then
+  extract_lex_args=(--extract_lex="${extract_lex}")
 fi
 
-rm "${dir}/corpus.spm.${TRG}"
-rm "${dir}/corpus.spm.${SRC}"
-rm "${output_dir}/corpus.aln"
-
-echo "### Shortlist pruning"
-"${MARIAN}/spm_export_vocab" --model="${vocab_path}" --output="${dir}/vocab.txt"
-zstdmt -dc "${dir}/lex.s2t.zst" |
-  grep -v NULL |
-  python3 "prune_shortlist.py" 100 "${dir}/vocab.txt" |
-  zstdmt >"${output_dir}/lex.s2t.pruned.zst"
-
-echo "### Deleting tmp dir"
-rm -rf "${dir}"
+python3 shortlist.py \
+  --corpus_src="${corpus_prefix}.${SRC}.zst" \
+  --corpus_trg="${corpus_prefix}.${TRG}.zst" \
+  --vocab_path="${vocab_path}" \
+  --top_k=100 \
+  --num_workers="${threads}" \
+  --output_path="${output_dir}/lex.s2t.pruned.zst" \
+  "${extract_lex_args[@]}"
 
 echo "###### Done: Generating alignments and shortlist"
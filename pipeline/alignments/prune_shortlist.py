@@ -1,51 +1,347 @@
 #!/usr/bin/env python3
-# -*- coding: utf-8 -*-
+"""
+Prunes the lexical shortlist that extract_lex generates. For every source token, the top_k most
+probable target tokens are kept, along with the first top_k + 2 tokens of the vocabulary.
 
-import sys
+The tokens are mapped to integer ids from the exported SentencePiece vocab, so the candidates
+are held in NumPy arrays rather than in dictionaries of strings. The lexicon is streamed in
+batches, and after every batch only the top_k candidates of each source token are kept, which
+bounds the memory to the size of the vocab times top_k.
 
-MAX = int(sys.argv[1])
-TOP = sys.argv[2]
+Example:
+    python pipeline/alignments/prune_shortlist.py \
+        --lex_path=tmp/lex.s2t.zst \
+        --vocab_path=tmp/vocab.txt \
+        --top_k=100 \
+        --output_path=artifacts/lex.s2t.pruned.zst
+"""
 
-tops = []
+import argparse
+from itertools import islice
+from typing import NamedTuple, Optional
 
-with open(TOP, "r") as f:
-    for line in f:
-        tops.append(line.strip().split()[0])
+import numpy as np
 
-tops = tops[: MAX + 2]
+from pipeline.common.downloads import read_lines, write_lines
+from pipeline.common.logging import get_logger
 
-vocabTrg = []
-vocabSrc = []
-pairs = {}
+logger = get_logger("prune_shortlist")
 
-for line in sys.stdin:
-    try:
-        trg, src, prob = line.strip().split()
-    # some lines include empty items for zh-en, 63 from ~400k
-    except ValueError:
-        continue
+# The number of lines of the lexicon that are parsed at once.
+BATCH_LINES = 1_000_000
 
-    if trg == "NULL" or src == "NULL":
-        continue
+# The header of the binary shortlist that marian-conv writes with --dump-shortlist.
+BINARY_SHORTLIST_MAGIC = 0xF11A48D5013417F5
+UINT64_MASK = (1 << 64) - 1
 
-    # sys.stderr.write("{} {} {} \n".format(trg, src, prob))
 
-    vocabTrg.append(trg)
-    vocabSrc.append(src)
+class Vocab:
+    """
+    Maps the tokens to the ids of the vocab exported by spm_export_vocab, where the id is the
+    line number. Tokens that are missing from the vocab get ids after the end of the vocab.
+    """
 
-    prob = float(prob)
-    if src in pairs:
-        pairs[src][trg] = prob
-    else:
-        pairs[src] = {trg: prob}
+    def __init__(self, tokens: list[str]) -> None:
+        self.tokens = list(tokens)
+        self.size = len(self.tokens)
+        self.ids = {token: index for index, token in enumerate(self.tokens)}
 
-vocabTrg = set(vocabTrg)
-vocabSrc = set(vocabSrc)
+    @staticmethod
+    def load(vocab_path: str) -> "Vocab":
+        with read_lines(vocab_path) as lines:
+            return Vocab([line.rstrip("\n").split("\t")[0] for line in lines])
 
-for src in vocabSrc:
-    d = pairs[src]
-    topSrc = list(sorted(d, key=d.get, reverse=True)[:MAX])
-    for trg in topSrc + tops:
-        if trg in d:
-            prob = d[trg]
-            print("{} {} {:.8f}".format(trg, src, prob))
+    def get_id(self, token: str) -> int:
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = len(self.tokens)
+            self.ids[token] = token_id
+            self.tokens.append(token)
+        return token_id
+
+
+class Candidates(NamedTuple):
+    """The (source, target, probability) triples, and the line they were read from."""
+
+    src: np.ndarray
+    trg: np.ndarray
+    prob: np.ndarray
+    order: np.ndarray
+
+    @staticmethod
+    def empty() -> "Candidates":
+        return Candidates(
+            np.zeros(0, np.int64),
+            np.zeros(0, np.int64),
+            np.zeros(0, np.float64),
+            np.zeros(0, np.int64),
+        )
+
+    def concat(self, other: "Candidates") -> "Candidates":
+        return Candidates(*(np.concatenate(pair) for pair in zip(self, other)))
+
+    def take(self, indices: np.ndarray) -> "Candidates":
+        return Candidates(*(array[indices] for array in self))
+
+
+def parse_batch(lines: list[str], vocab: Vocab, offset: int) -> Candidates:
+    """
+    Parse lines of "trg src prob". The lines with a NULL token are skipped, along with the
+    lines that don't have exactly three items, which extract_lex writes for some corpora.
+    """
+    src_ids = []
+    trg_ids = []
+    probs = []
+    orders = []
+    get_id = vocab.get_id
+    for index, line in enumerate(lines, start=offset):
+        items = line.split()
+        if len(items) != 3:
+            continue
+        trg, src, prob = items
+        if trg == "NULL" or src == "NULL":
+            continue
+        src_ids.append(get_id(src))
+        trg_ids.append(get_id(trg))
+        probs.append(float(prob))
+        orders.append(index)
+
+    return Candidates(
+        np.array(src_ids, dtype=np.int64),
+        np.array(trg_ids, dtype=np.int64),
+        np.array(probs, dtype=np.float64),
+        np.array(orders, dtype=np.int64),
+    )
+
+
+def group_ranks(sorted_keys: np.ndarray) -> np.ndarray:
+    """The rank of every element within its run of equal keys, e.g. [3, 3, 5] -> [0, 1, 0]"""
+    return np.arange(len(sorted_keys)) - np.searchsorted(sorted_keys, sorted_keys, side="left")
+
+
+def select_top_k(candidates: Candidates, top_k: int) -> Candidates:
+    """
+    Keep the top_k most probable targets for every source. It's the same as a bounded heap per
+    source, but done for all of the sources at once. The ties are broken by the line order,
+    which matches a stable sort of the whole list of candidates.
+
+    The returned candidates are sorted by the source, and then by the rank.
+    """
+    # When a pair is repeated, the later line overwrites the probability, but the pair keeps
+    # its place in the order.
+    pair_keys = (candidates.src << 32) | candidates.trg
+    by_pair = np.lexsort((candidates.order, pair_keys))
+    _, first = np.unique(pair_keys[by_pair], return_index=True)
+    last = np.append(first[1:], len(by_pair)) - 1
+    candidates = Candidates(
+        candidates.src[by_pair[first]],
+        candidates.trg[by_pair[first]],
+        candidates.prob[by_pair[last]],
+        candidates.order[by_pair[first]],
+    )
+
+    ranked = candidates.take(np.lexsort((candidates.order, -candidates.prob, candidates.src)))
+    return ranked.take(np.flatnonzero(group_ranks(ranked.src) < top_k))
+
+
+def prune_lexicon(
+    lex_path: str, vocab: Vocab, top_k: int, num_tops: int
+) -> tuple[Candidates, np.ndarray]:
+    """
+    Stream the lexicon, returning the top_k candidates of every source, and the probabilities
+    of the num_tops most frequent vocab tokens that are always kept.
+    """
+    num_tops = min(num_tops, vocab.size)
+    # The probability of every source to each of the most frequent tokens, or NaN.
+    top_probs = np.full((vocab.size, num_tops), np.nan)
+    kept = Candidates.empty()
+    offset = 0
+
+    with read_lines(lex_path) as lines:
+        for batch_lines in iter(lambda: list(islice(lines, BATCH_LINES)), []):
+            batch = parse_batch(batch_lines, vocab, offset)
+            offset += len(batch_lines)
+
+            if len(vocab.tokens) > len(top_probs):
+                grown = np.full((len(vocab.tokens), num_tops), np.nan)
+                grown[: len(top_probs)] = top_probs
+                top_probs = grown
+
+            is_top = batch.trg < num_tops
+            top_probs[batch.src[is_top], batch.trg[is_top]] = batch.prob[is_top]
+
+            kept = select_top_k(kept.concat(batch), top_k)
+            logger.info(f"Processed {offset:,} lines")
+
+    return kept, top_probs
+
+
+def write_shortlist(
+    output_path: str, vocab: Vocab, kept: Candidates, top_probs: np.ndarray
+) -> None:
+    """
+    Write out the top_k candidates of every source, followed by the most frequent vocab tokens
+    that the source has a probability for. A token can appear in both lists. The sources are
+    written in the order of the vocab.
+    """
+    sources = np.unique(kept.src).tolist()
+    starts = np.searchsorted(kept.src, sources, side="left").tolist()
+    ends = np.searchsorted(kept.src, sources, side="right").tolist()
+    trg_ids = kept.trg.tolist()
+    probs = kept.prob.tolist()
+    tokens = vocab.tokens
+
+    with write_lines(output_path) as output:
+        for src_id, start, end in zip(sources, starts, ends):
+            src = tokens[src_id]
+            for trg_id, prob in zip(trg_ids[start:end], probs[start:end]):
+                output.write(f"{tokens[trg_id]} {src} {prob:.8f}\n")
+            row = top_probs[src_id]
+            for trg_id in np.flatnonzero(~np.isnan(row)).tolist():
+                output.write(f"{tokens[trg_id]} {src} {row[trg_id]:.8f}\n")
+
+
+def hash_words(words: np.ndarray) -> int:
+    """
+    The checksum of the binary shortlist, which is Marian's `util::hashMem` over uint64s.
+
+    Every step depends on the previous seed through the shifts and the carries of the addition,
+    so the words can't be hashed as whole arrays. They are read through a memoryview rather
+    than copied into a list of ints.
+    """
+    seed = 0
+    for word in memoryview(np.ascontiguousarray(words, dtype=np.uint64)).cast("B").cast("Q"):
+        seed = (seed ^ (word + 0x9E3779B9 + (seed << 6) + (seed >> 2))) & UINT64_MASK
+    return seed
+
+
+def write_binary_shortlist(
+    output_path: str, vocab: Vocab, kept: Candidates, first_num: int, best_num: int
+) -> None:
+    """
+    Write the shortlist in the binary format that Marian loads, which skips the conversion with
+    `marian-conv --shortlist lex.s2t first_num best_num 0 --dump-shortlist lex.s2t.bin`. For
+    every source in the vocab, the best_num most probable target ids are stored in ascending order.
+
+    The layout is a header of uint64 (magic, checksum, first_num, best_num, the number of
+    offsets, the number of target ids), the uint64 offsets of every source into the target ids,
+    and the uint32 target ids.
+    """
+    # Tokens that are missing from the vocab can't be looked up by Marian.
+    known = kept.take(np.flatnonzero((kept.src < vocab.size) & (kept.trg < vocab.size)))
+    # Marian breaks the ties with the larger target id.
+    ranked = known.take(np.lexsort((-known.trg, -known.prob, known.src)))
+    best = ranked.take(np.flatnonzero(group_ranks(ranked.src) < best_num))
+    best = best.take(np.lexsort((best.trg, best.src)))
+
+    offsets = np.zeros(vocab.size + 1, dtype=np.uint64)
+    offsets[1:] = np.cumsum(np.bincount(best.src, minlength=vocab.size))
+    short_lists = best.trg.astype(np.uint32)
+
+    blob = np.concatenate(
+        [
+            np.array([first_num, best_num, len(offsets), len(short_lists)], dtype=np.uint64).view(
+                np.uint8
+            ),
+            offsets.view(np.uint8),
+            short_lists.view(np.uint8),
+        ]
+    )
+    # The checksum covers the whole uint64 words after the magic and the checksum.
+    checksum = hash_words(blob[: len(blob) // 8 * 8].view(np.uint64))
+
+    with open(output_path, "wb") as output:
+        output.write(np.array([BINARY_SHORTLIST_MAGIC, checksum], dtype=np.uint64).tobytes())
+        output.write(blob.tobytes())
+
+
+def prune_shortlist(
+    lex_path: str,
+    vocab_path: str,
+    output_path: Optional[str],
+    top_k: int,
+    binary_output_path: Optional[str] = None,
+    binary_first_num: int = 50,
+    binary_best_num: int = 50,
+) -> None:
+    vocab = Vocab.load(vocab_path)
+    logger.info(f"Pruning {lex_path} to the top {top_k} targets with {vocab.size:,} vocab tokens")
+    kept_k = max(top_k, binary_best_num) if binary_output_path else top_k
+    kept, top_probs = prune_lexicon(lex_path, vocab, kept_k, num_tops=top_k + 2)
+
+    if output_path:
+        if kept_k > top_k:
+            kept_text = kept.take(np.flatnonzero(group_ranks(kept.src) < top_k))
+        else:
+            kept_text = kept
+        logger.info(f"Writing the shortlist to {output_path}")
+        write_shortlist(output_path, vocab, kept_text, top_probs)
+
+    if binary_output_path:
+        logger.info(f"Writing the binary shortlist to {binary_output_path}")
+        write_binary_shortlist(binary_output_path, vocab, kept, binary_first_num, binary_best_num)
+
+
+def main(args: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        # Preserves whitespace in the help text.
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "--lex_path",
+        type=str,
+        required=True,
+        help='The lexicon from extract_lex with lines of "trg src prob", optionally compressed',
+    )
+    parser.add_argument(
+        "--vocab_path",
+        type=str,
+        required=True,
+        help="The vocab exported with spm_export_vocab, the line number is the token id",
+    )
+    parser.add_argument(
+        "--top_k", type=int, default=100, help="The number of targets to keep per source"
+    )
+    parser.add_argument(
+        "--output_path",
+        type=str,
+        default=None,
+        help="The pruned shortlist, compressed if the path ends with .zst",
+    )
+    parser.add_argument(
+        "--binary_output_path",
+        type=str,
+        default=None,
+        help="Also write the shortlist in Marian's binary format",
+    )
+    parser.add_argument(
+        "--binary_first_num",
+        type=int,
+        default=50,
+        help="The first_num that is stored in the binary shortlist",
+    )
+    parser.add_argument(
+        "--binary_best_num",
+        type=int,
+        default=50,
+        help="The number of targets per source in the binary shortlist",
+    )
+    parsed_args = parser.parse_args(args)
+
+    if not parsed_args.output_path and not parsed_args.binary_output_path:
+        parser.error("Either --output_path or --binary_output_path is required")
+
+    prune_shortlist(
+        lex_path=parsed_args.lex_path,
+        vocab_path=parsed_args.vocab_path,
+        output_path=parsed_args.output_path,
+        top_k=parsed_args.top_k,
+        binary_output_path=parsed_args.binary_output_path,
+        binary_first_num=parsed_args.binary_first_num,
+        binary_best_num=parsed_args.binary_best_num,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+"""
+Generates a pruned lexical shortlist for a corpus in a single stage, replacing spm_encode,
+extract_lex, and the separate pruning step.
+
+1. The corpus is encoded to SentencePiece ids in a process pool, and written compressed.
+2. The ids are aligned with eflomal and symmetrized, see align.py.
+3. The workers count how often the tokens are aligned in batches of lines. The counts are
+   hash-partitioned by the source token, so every partition holds the full rows of its sources.
+4. The partitions are turned into lexical probabilities and pruned in parallel, and the top_k
+   targets of every source are written out like prune_shortlist.py does.
+
+The lexical probabilities are the same as the ones extract_lex computes for lex.s2t. p(trg|src)
+is the number of times src was aligned to trg, divided by the number of times src was aligned
+to anything, where the unaligned source tokens count as being aligned to NULL.
+
+With --extract_lex, the extract_lex binary is used instead of the counting, and its lex.s2t is
+pruned with prune_shortlist.py. generate-shortlist.sh does this by default until the counting is
+verified against extract_lex, see test_count_and_prune_matches_extract_lex.
+
+Example:
+    python pipeline/alignments/shortlist.py \
+        --corpus_src=fetches/corpus.en.zst \
+        --corpus_trg=fetches/corpus.ru.zst \
+        --vocab_path=fetches/vocab.spm \
+        --output_path=artifacts/lex.s2t.pruned.zst
+"""
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import subprocess
+from contextlib import ExitStack
+from itertools import islice
+from multiprocessing.pool import Pool
+from typing import Any, Iterable, Optional
+
+import numpy as np
+from tqdm import tqdm
+from zstandard import ZstdCompressor
+
+from pipeline.alignments.align import align, symmetrize
+from pipeline.alignments.prune_shortlist import (
+    Candidates,
+    Vocab,
+    prune_lexicon,
+    select_top_k,
+    write_shortlist,
+)
+from pipeline.alignments.symmetrize import parse_alignments, parse_ints
+from pipeline.common.downloads import read_lines
+from pipeline.common.logging import get_logger
+
+logger = get_logger("shortlist")
+
+# The number of lines that are sent to a worker at once, both for encoding and counting.
+BATCH_LINES = 100_000
+
+# The number of pending counts a partition buffers before the duplicates are summed up.
+COMPACT_PAIRS = 10_000_000
+
+_worker_processor: Optional[Any] = None
+_worker_init_error: Optional[Exception] = None
+
+
+def _init_worker(vocab_path: str) -> None:
+    global _worker_processor, _worker_init_error
+    try:
+        import sentencepiece
+
+        _worker_processor = sentencepiece.SentencePieceProcessor(model_file=vocab_path)
+    except Exception as exception:
+        # A pool keeps restarting workers that fail to initialize, so report the error
+        # from the first task instead.
+        _worker_init_error = exception
+
+
+def _encode_lines(lines: list[str]) -> tuple[int, bytes]:
+    """Encode a batch of lines to space separated SentencePiece ids in a worker process."""
+    if _worker_init_error:
+        raise _worker_init_error
+    assert _worker_processor, "The worker was not initialized"
+
+    ids = _worker_processor.encode([line.rstrip("\n") for line in lines], out_type=int)
+    encoded = "".join(" ".join(map(str, line_ids)) + "\n" for line_ids in ids)
+    return len(lines), encoded.encode("utf-8")
+
+
+def encode_corpus(pool: Pool, corpus_path: str, output_path: str) -> None:
+    logger.info(f"Encoding {corpus_path} with SentencePiece")
+    with ExitStack() as stack:
+        lines = stack.enter_context(read_lines(corpus_path))
+        output = stack.enter_context(
+            ZstdCompressor(threads=-1).stream_writer(stack.enter_context(open(output_path, "wb")))
+        )
+        batches = iter(lambda: list(islice(lines, BATCH_LINES)), [])
+        pbar = tqdm(mininterval=10)
+        for lines_count, block in pool.imap(_encode_lines, batches):
+            output.write(block)
+            pbar.update(lines_count)
+
+
+def count_batch(
+    params: tuple[int, int, list[str], list[str], list[str]],
+) -> tuple[int, list[tuple[np.ndarray, np.ndarray]]]:
+    """
+    Count the aligned token pairs of a batch of lines. The pairs are encoded as the key
+    src * (vocab_size + 1) + trg, where the id vocab_size is NULL. Along with the number of
+    lines, the unique keys and their counts are returned for every partition.
+    """
+    vocab_size, num_partitions, src_lines, trg_lines, aln_lines = params
+    null_id = vocab_size
+
+    src_ids, src_counts = parse_ints(src_lines)
+    trg_ids, trg_counts = parse_ints(trg_lines)
+    pairs, pair_counts = parse_alignments(aln_lines)
+
+    line_ids = np.repeat(np.arange(len(src_lines)), pair_counts)
+    # extract_lex skips the alignments that are out of the bounds of the sentence.
+    in_bounds = (pairs[:, 0] < src_counts[line_ids]) & (pairs[:, 1] < trg_counts[line_ids])
+    pairs = pairs[in_bounds]
+    line_ids = line_ids[in_bounds]
+
+    src_offsets = np.concatenate(([0], np.cumsum(src_counts)[:-1]))
+    trg_offsets = np.concatenate(([0], np.cumsum(trg_counts)[:-1]))
+    src_positions = src_offsets[line_ids] + pairs[:, 0]
+    trg_positions = trg_offsets[line_ids] + pairs[:, 1]
+
+    is_aligned = np.zeros(len(src_ids), dtype=bool)
+    is_aligned[src_positions] = True
+    unaligned_src = src_ids[~is_aligned]
+
+    src = np.concatenate((src_ids[src_positions], unaligned_src))
+    trg = np.concatenate((trg_ids[trg_positions], np.full(len(unaligned_src), null_id)))
+    keys, counts = np.unique(src * (vocab_size + 1) + trg, return_counts=True)
+
+    partitions = (keys // (vocab_size + 1)) % num_partitions
+    by_partition = np.argsort(partitions, kind="stable")
+    bounds = np.cumsum(np.bincount(partitions, minlength=num_partitions))[:-1]
+    return len(src_lines), list(
+        zip(np.split(keys[by_partition], bounds), np.split(counts[by_partition], bounds))
+    )
+
+
+def sum_counts(keys: np.ndarray, counts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Sum the counts of the duplicate keys, returning the sorted unique keys."""
+    if not len(keys):
+        return keys, counts
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    starts = get_group_starts(keys)
+    return keys[starts], np.add.reduceat(counts[order], starts)
+
+
+def get_group_starts(sorted_keys: np.ndarray) -> np.ndarray:
+    """The indices where the runs of equal keys start, e.g. [3, 3, 5] -> [0, 2]"""
+    return np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+
+
+class CountPartition:
+    """The co-occurrence counts for the sources that hash to a partition."""
+
+    def __init__(self) -> None:
+        self.keys: list[np.ndarray] = []
+        self.counts: list[np.ndarray] = []
+        self.pending = 0
+        self.compacted = 0
+
+    def add(self, keys: np.ndarray, counts: np.ndarray) -> None:
+        self.keys.append(keys)
+        self.counts.append(counts)
+        self.pending += len(keys)
+        # Wait for the buffer to grow past the compacted counts, so that the compactions
+        # don't get more frequent as the number of unique pairs grows.
+        if self.pending > max(COMPACT_PAIRS, 2 * self.compacted):
+            self.compact()
+
+    def compact(self) -> tuple[np.ndarray, np.ndarray]:
+        if not self.keys:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64)
+        keys, counts = sum_counts(np.concatenate(self.keys), np.concatenate(self.counts))
+        self.keys = [keys]
+        self.counts = [counts]
+        self.pending = len(keys)
+        self.compacted = len(keys)
+        return keys, counts
+
+
+def prune_partition(
+    params: tuple[int, int, int, np.ndarray, np.ndarray],
+) -> tuple[Candidates, Candidates]:
+    """
+    Compute the lexical probabilities of a partition, and return the top_k targets of every
+    source, along with the probabilities of the num_tops most frequent vocab tokens.
+    """
+    vocab_size, top_k, num_tops, keys, counts = params
+    if not len(keys):
+        return Candidates.empty(), Candidates.empty()
+    src = keys // (vocab_size + 1)
+    trg = keys % (vocab_size + 1)
+
+    # The keys are sorted, so the counts of every source are next to each other.
+    starts = get_group_starts(src)
+    totals = np.add.reduceat(counts, starts)
+    probs = counts / np.repeat(totals, np.diff(np.append(starts, len(keys))))
+
+    # NULL is only used for the totals.
+    is_token = trg != vocab_size
+    # The ties are broken by the target id.
+    candidates = Candidates(src, trg, probs, trg).take(np.flatnonzero(is_token))
+    tops = candidates.take(np.flatnonzero(candidates.trg < num_tops))
+    return select_top_k(candidates, top_k), tops
+
+
+def _read_batches(
+    vocab_size: int, num_partitions: int, *lines_iters: Iterable[str]
+) -> Iterable[tuple]:
+    lines = zip(*lines_iters)
+    while batch := list(islice(lines, BATCH_LINES)):
+        src_lines, trg_lines, aln_lines = zip(*batch)
+        yield vocab_size, num_partitions, src_lines, trg_lines, aln_lines
+
+
+def count_and_prune(
+    src_path: str,
+    trg_path: str,
+    aln_path: str,
+    vocab: Vocab,
+    output_path: str,
+    top_k: int,
+    num_workers: int,
+) -> None:
+    num_partitions = num_workers
+    partitions = [CountPartition() for _ in range(num_partitions)]
+    num_tops = min(top_k + 2, vocab.size)
+
+    with ExitStack() as stack:
+        pool = stack.enter_context(multiprocessing.Pool(processes=num_workers))
+        src_lines = stack.enter_context(read_lines(src_path))
+        trg_lines = stack.enter_context(read_lines(trg_path))
+        aln_lines = stack.enter_context(read_lines(aln_path))
+
+        logger.info("Counting the aligned tokens")
+        pbar = tqdm(mininterval=10)
+        batches = _read_batches(vocab.size, num_partitions, src_lines, trg_lines, aln_lines)
+        for lines_count, batch_counts in pool.imap(count_batch, batches):
+            for partition, (keys, counts) in zip(partitions, batch_counts):
+                partition.add(keys, counts)
+            pbar.update(lines_count)
+
+        logger.info(f"Pruning the shortlist to the top {top_k} targets")
+        results = pool.map(
+            prune_partition,
+            [(vocab.size, top_k, num_tops, *partition.compact()) for partition in partitions],
+        )
+
+    kept_parts, top_parts = zip(*results)
+    kept = kept_parts[0]
+    tops = top_parts[0]
+    for kept_part, top_part in zip(kept_parts[1:], top_parts[1:]):
+        kept = kept.concat(kept_part)
+        tops = tops.concat(top_part)
+    # Every source is in a single partition, so a stable sort keeps the ranks in order.
+    kept = kept.take(np.argsort(kept.src, kind="stable"))
+
+    top_probs = np.full((vocab.size, num_tops), np.nan)
+    top_probs[tops.src, tops.trg] = tops.prob
+
+    logger.info(f"Writing the shortlist to {output_path}")
+    write_shortlist(output_path, vocab, kept, top_probs)
+
+
+def extract_lex_and_prune(
+    extract_lex_path: str,
+    src_path: str,
+    trg_path: str,
+    aln_path: str,
+    vocab: Vocab,
+    output_path: str,
+    top_k: int,
+    tmp_dir: str,
+) -> None:
+    """
+    The fallback to count_and_prune, which runs the extract_lex binary on the SentencePiece
+    ids, and prunes its lex.s2t with prune_shortlist.py.
+    """
+    # extract_lex reads plain text.
+    text_paths = []
+    for path in (src_path, trg_path, aln_path):
+        text_path = os.path.join(tmp_dir, os.path.basename(path).removesuffix(".zst"))
+        with read_lines(path) as lines, open(text_path, "w", encoding="utf-8") as output:
+            output.writelines(lines)
+        text_paths.append(text_path)
+    src_text_path, trg_text_path, aln_text_path = text_paths
+
+    lex_s2t_path = os.path.join(tmp_dir, "lex.s2t")
+    lex_t2s_path = os.path.join(tmp_dir, "lex.t2s")
+    logger.info("Extracting the lexical probabilities with extract_lex")
+    subprocess.check_call(
+        [
+            extract_lex_path,
+            trg_text_path,
+            src_text_path,
+            aln_text_path,
+            lex_s2t_path,
+            lex_t2s_path,
+        ]
+    )
+
+    # The tokens of the lexicon are the ids, which are mapped back to the pieces when writing.
+    id_vocab = Vocab([str(index) for index in range(vocab.size)])
+    logger.info(f"Pruning the shortlist to the top {top_k} targets")
+    kept, top_probs = prune_lexicon(lex_s2t_path, id_vocab, top_k, num_tops=top_k + 2)
+    logger.info(f"Writing the shortlist to {output_path}")
+    write_shortlist(output_path, vocab, kept, top_probs)
+
+
+def load_vocab(vocab_path: str) -> Vocab:
+    """The pieces of the SentencePiece model, in the order of their ids."""
+    import sentencepiece
+
+    processor = sentencepiece.SentencePieceProcessor(model_file=vocab_path)
+    return Vocab([processor.id_to_piece(index) for index in range(processor.get_piece_size())])
+
+
+def generate_shortlist(
+    corpus_src: str,
+    corpus_trg: str,
+    vocab_path: str,
+    output_path: str,
+    top_k: int,
+    chunk_lines: int,
+    num_workers: Optional[int] = None,
+    extract_lex_path: Optional[str] = None,
+) -> None:
+    num_workers = num_workers or multiprocessing.cpu_count()
+    tmp_dir = os.path.join(os.path.dirname(output_path), "tmp_shortlist")
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    vocab = load_vocab(vocab_path)
+    src_ids_path = os.path.join(tmp_dir, "corpus.spm.src.zst")
+    trg_ids_path = os.path.join(tmp_dir, "corpus.spm.trg.zst")
+    aln_path = os.path.join(tmp_dir, "corpus.aln.zst")
+
+    with multiprocessing.Pool(
+        processes=num_workers, initializer=_init_worker, initargs=(vocab_path,)
+    ) as pool:
+        encode_corpus(pool, corpus_src, src_ids_path)
+        encode_corpus(pool, corpus_trg, trg_ids_path)
+
+    # The ids are aligned as if they were words.
+    fwd_path, rev_path = align(
+        corpus_src=src_ids_path,
+        corpus_trg=trg_ids_path,
+        tmp_dir=tmp_dir,
+        chunk_lines=chunk_lines,
+        priors_input_path=None,
+    )
+    symmetrize(fwd_path=fwd_path, rev_path=rev_path, output_path=aln_path)
+    os.remove(fwd_path)
+    os.remove(rev_path)
+
+    if extract_lex_path:
+        extract_lex_and_prune(
+            extract_lex_path,
+            src_ids_path,
+            trg_ids_path,
+            aln_path,
+            vocab,
+            output_path,
+            top_k,
+            tmp_dir,
+        )
+    else:
+        count_and_prune(
+            src_ids_path, trg_ids_path, aln_path, vocab, output_path, top_k, num_workers
+        )
+    shutil.rmtree(tmp_dir)
+
+
+def main(args: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        # Preserves whitespace in the help text.
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument("--corpus_src", type=str, required=True, help="The source corpus")
+    parser.add_argument("--corpus_trg", type=str, required=True, help="The target corpus")
+    parser.add_argument(
+        "--vocab_path", type=str, required=True, help="The SentencePiece model, e.g. vocab.spm"
+    )
+    parser.add_argument(
+        "--output_path",
+        type=str,
+        required=True,
+        help="The pruned shortlist, compressed if the path ends with .zst",
+    )
+    parser.add_argument(
+        "--top_k", type=int, default=100, help="The number of targets to keep per source"
+    )
+    parser.add_argument(
+        "--chunk_lines",
+        type=int,
+        # use env to override from tests
+        default=int(os.getenv("ALN_CHUNK_LINES", "50000000")),
+        help="Split the corpus to chunks of N lines to align them separately.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=None,
+        help="The number of processes for encoding and counting, defaults to the number of CPUs",
+    )
+    parser.add_argument(
+        "--extract_lex",
+        type=str,
+        default=None,
+        help="Count the lexical probabilities with this extract_lex binary instead",
+    )
+    parsed_args = parser.parse_args(args)
+
+    generate_shortlist(
+        corpus_src=parsed_args.corpus_src,
+        corpus_trg=parsed_args.corpus_trg,
+        vocab_path=parsed_args.vocab_path,
+        output_path=parsed_args.output_path,
+        top_k=parsed_args.top_k,
+        chunk_lines=parsed_args.chunk_lines,
+        num_workers=parsed_args.num_workers,
+        extract_lex_path=parsed_args.extract_lex,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Symmetrizes forward and reverse word alignments, replacing `atools -c <heuristic>` from
+fast_align.
+
+Alignments are generated in two directions, source to target, and target to source. The
+heuristics combine them so that both directions share the same alignment information. The
+batches of lines are parsed into integer arrays, and the intersection and union of the
+directions are computed with NumPy for the whole batch. Only the sentences where the
+directions disagree go through the sequential grow-diag step.
+
+The pipeline still symmetrizes with atools by default (see --symmetrizer in align.py) until
+this is verified against it with test_symmetrize_matches_atools. The atools binary can be run
+from here too with --atools.
+
+Example:
+    python pipeline/alignments/symmetrize.py \
+        --fwd_path=tmp/aln.fwd \
+        --rev_path=tmp/aln.rev \
+        --output_path=artifacts/corpus.aln.zst \
+        --heuristic=grow-diag-final-and
+"""
+
+import argparse
+import heapq
+import multiprocessing
+import subprocess
+from contextlib import ExitStack
+from enum import Enum
+from itertools import islice
+from typing import Iterable, Optional
+
+import numpy as np
+from tqdm import tqdm
+from zstandard import ZstdCompressor
+
+from pipeline.common.downloads import read_lines
+from pipeline.common.logging import get_logger
+
+logger = get_logger("symmetrize")
+
+# The number of lines that are sent to a worker at once.
+BATCH_LINES = 100_000
+
+# The pairs are packed into a single integer key of (line, src, trg) to compare them with NumPy.
+INDEX_BITS = 20
+INDEX_MASK = (1 << INDEX_BITS) - 1
+
+# The order matches atools, since the points that are added depend on the order of the checks.
+NEIGHBORS = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+DIAGONAL_NEIGHBORS = NEIGHBORS + [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+
+class Heuristic(Enum):
+    intersect = "intersect"
+    union = "union"
+    grow_diag = "grow-diag"
+    grow_diag_final = "grow-diag-final"
+    grow_diag_final_and = "grow-diag-final-and"
+
+
+def parse_ints(lines: Iterable[str], separator: str = " ") -> tuple[np.ndarray, np.ndarray]:
+    """
+    Parse lines of space separated integers in one go, returning the integers and the number
+    of integers on each line.
+    """
+    stripped = [line.strip() for line in lines]
+    counts = np.array(
+        [line.count(separator) + 1 if line else 0 for line in stripped], dtype=np.int64
+    )
+    text = " ".join(line for line in stripped if line)
+    if separator != " ":
+        text = text.replace(separator, " ")
+    values = np.fromstring(text, dtype=np.int64, sep=" ") if text else np.zeros(0, np.int64)
+    return values, counts
+
+
+def parse_alignments(lines: Iterable[str]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Parse lines of alignments like "0-0 1-2" into an array of (src, trg) pairs, and the number
+    of pairs on each line.
+    """
+    values, counts = parse_ints([line.replace(" ", "-") for line in lines], "-")
+    return values.reshape(-1, 2), counts // 2
+
+
+def _to_keys(pairs: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    line_ids = np.repeat(np.arange(len(counts), dtype=np.int64), counts)
+    if len(pairs) and pairs.max() > INDEX_MASK:
+        raise ValueError(f"The alignment indices must be less than {INDEX_MASK}")
+    return (line_ids << (2 * INDEX_BITS)) | (pairs[:, 0] << INDEX_BITS) | pairs[:, 1]
+
+
+def _split_keys(keys: np.ndarray, num_lines: int) -> list[list[tuple[int, int]]]:
+    """Split the sorted keys back into the (src, trg) pairs of each line."""
+    line_ids = keys >> (2 * INDEX_BITS)
+    boundaries = np.searchsorted(line_ids, np.arange(num_lines + 1))
+    src = ((keys >> INDEX_BITS) & INDEX_MASK).tolist()
+    trg = (keys & INDEX_MASK).tolist()
+    return [
+        list(zip(src[start:end], trg[start:end]))
+        for start, end in zip(boundaries[:-1].tolist(), boundaries[1:].tolist())
+    ]
+
+
+def grow_diag(
+    intersection: list[tuple[int, int]],
+    union: set[tuple[int, int]],
+    final: bool = False,
+    final_and: bool = False,
+) -> list[tuple[int, int]]:
+    """
+    Grow the intersection with the neighboring points from the union, as long as they align a
+    word that is not aligned yet. This follows the loops of atools, which visit the aligned
+    points in row-major order, including the points added earlier in the same pass.
+    """
+    aligned = set(intersection)
+    src_aligned = {src for src, _ in intersection}
+    trg_aligned = {trg for _, trg in intersection}
+
+    added = True
+    while added:
+        added = False
+        # A sorted list is a valid heap, and newly added points that are ahead of the current
+        # point are visited in this pass.
+        heap = sorted(aligned)
+        while heap:
+            point = heapq.heappop(heap)
+            src, trg = point
+            for d_src, d_trg in DIAGONAL_NEIGHBORS:
+                neighbor = (src + d_src, trg + d_trg)
+                if neighbor in union and (
+                    neighbor[0] not in src_aligned or neighbor[1] not in trg_aligned
+                ):
+                    aligned.add(neighbor)
+                    src_aligned.add(neighbor[0])
+                    trg_aligned.add(neighbor[1])
+                    added = True
+                    if neighbor > point:
+                        heapq.heappush(heap, neighbor)
+
+    if final:
+        for point in sorted(union):
+            src, trg = point
+            if point in aligned:
+                continue
+            if final_and:
+                is_unaligned = src not in src_aligned and trg not in trg_aligned
+            else:
+                is_unaligned = src not in src_aligned or trg not in trg_aligned
+            if is_unaligned:
+                aligned.add(point)
+                src_aligned.add(src)
+                trg_aligned.add(trg)
+
+    return sorted(aligned)
+
+
+def symmetrize_batch(params: tuple[Heuristic, list[str], list[str]]) -> tuple[int, bytes]:
+    """
+    Symmetrize a batch of lines of forward and reverse alignments, returning the encoded lines.
+    """
+    heuristic, fwd_lines, rev_lines = params
+    num_lines = len(fwd_lines)
+    if len(rev_lines) != num_lines:
+        raise ValueError("The forward and reverse alignments have a different number of lines")
+
+    fwd_keys = np.unique(_to_keys(*parse_alignments(fwd_lines)))
+    rev_keys = np.unique(_to_keys(*parse_alignments(rev_lines)))
+    intersection_keys = np.intersect1d(fwd_keys, rev_keys, assume_unique=True)
+    union_keys = np.union1d(fwd_keys, rev_keys)
+
+    if heuristic == Heuristic.intersect:
+        lines = _split_keys(intersection_keys, num_lines)
+    elif heuristic == Heuristic.union:
+        lines = _split_keys(union_keys, num_lines)
+    else:
+        final = heuristic in (Heuristic.grow_diag_final, Heuristic.grow_diag_final_and)
+        final_and = heuristic == Heuristic.grow_diag_final_and
+        intersections = _split_keys(intersection_keys, num_lines)
+        unions = _split_keys(union_keys, num_lines)
+        lines = [
+            # When both directions agree, there is nothing to grow.
+            (
+                intersection
+                if len(intersection) == len(union)
+                else grow_diag(intersection, set(union), final, final_and)
+            )
+            for intersection, union in zip(intersections, unions)
+        ]
+
+    output = "".join(
+        " ".join(f"{src}-{trg}" for src, trg in line_pairs) + "\n" for line_pairs in lines
+    )
+    return num_lines, output.encode("utf-8")
+
+
+def symmetrize(
+    fwd_path: str,
+    rev_path: str,
+    output_path: str,
+    heuristic: Heuristic = Heuristic.grow_diag_final_and,
+    num_workers: Optional[int] = None,
+) -> None:
+    """
+    Symmetrize the alignments in parallel, the output is compressed if it ends with .zst
+    """
+    logger.info(f"Symmetrizing alignments with {heuristic.value}")
+
+    with ExitStack() as stack:
+        pool = stack.enter_context(
+            multiprocessing.Pool(processes=num_workers or multiprocessing.cpu_count())
+        )
+        output = stack.enter_context(open(output_path, "wb"))
+        if output_path.endswith(".zst"):
+            output = stack.enter_context(ZstdCompressor(threads=-1).stream_writer(output))
+
+        fwd_lines = stack.enter_context(read_lines(fwd_path))
+        rev_lines = stack.enter_context(read_lines(rev_path))
+
+        pbar = tqdm(mininterval=10)
+        batches = _read_batches(heuristic, fwd_lines, rev_lines)
+        for lines_count, block in pool.imap(symmetrize_batch, batches):
+            output.write(block)
+            pbar.update(lines_count)
+
+
+def symmetrize_with_atools(
+    atools_path: str,
+    fwd_path: str,
+    rev_path: str,
+    output_path: str,
+    heuristic: Heuristic = Heuristic.grow_diag_final_and,
+) -> None:
+    """
+    Symmetrize the alignments with the single threaded `atools` binary from fast_align. This
+    is kept as a fallback until the output of `symmetrize` is checked against a golden fixture.
+    """
+    logger.info(f"Symmetrizing alignments with atools -c {heuristic.value}")
+
+    with ExitStack() as stack:
+        output = stack.enter_context(open(output_path, "wb"))
+        if output_path.endswith(".zst"):
+            output = stack.enter_context(ZstdCompressor(threads=-1).stream_writer(output))
+
+        with subprocess.Popen(
+            [atools_path, "-i", fwd_path, "-j", rev_path, "-c", heuristic.value],
+            stdout=subprocess.PIPE,
+        ) as proc:
+            for line in proc.stdout:
+                output.write(line)
+
+        # Check for any errors in the subprocess execution
+        if proc.returncode != 0:
+            logger.error(f"atools exit code: {proc.returncode}")
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+def _read_batches(heuristic: Heuristic, fwd_lines: Iterable[str], rev_lines: Iterable[str]):
+    while True:
+        fwd_batch = list(islice(fwd_lines, BATCH_LINES))
+        rev_batch = list(islice(rev_lines, BATCH_LINES))
+        if not fwd_batch and not rev_batch:
+            return
+        yield heuristic, fwd_batch, rev_batch
+
+
+def main(args: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        # Preserves whitespace in the help text.
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument("--fwd_path", type=str, required=True, help="The forward alignments")
+    parser.add_argument("--rev_path", type=str, required=True, help="The reverse alignments")
+    parser.add_argument(
+        "--output_path",
+        type=str,
+        required=True,
+        help="The symmetrized alignments, compressed if the path ends with .zst",
+    )
+    parser.add_argument(
+        "--heuristic",
+        type=Heuristic,
+        choices=list(Heuristic),
+        default=Heuristic.grow_diag_final_and,
+        help="The symmetrization heuristic, the same as the atools -c option",
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=None, help="Defaults to the number of CPUs"
+    )
+    parser.add_argument(
+        "--atools",
+        type=str,
+        default=None,
+        help="Symmetrize with this atools binary from fast_align instead",
+    )
+    parsed_args = parser.parse_args(args)
+
+    if parsed_args.atools:
+        symmetrize_with_atools(
+            atools_path=parsed_args.atools,
+            fwd_path=parsed_args.fwd_path,
+            rev_path=parsed_args.rev_path,
+            output_path=parsed_args.output_path,
+            heuristic=parsed_args.heuristic,
+        )
+        return
+
+    symmetrize(
+        fwd_path=parsed_args.fwd_path,
+        rev_path=parsed_args.rev_path,
+        output_path=parsed_args.output_path,
+        heuristic=parsed_args.heuristic,
+        num_workers=parsed_args.num_workers,
+    )
+
+
+if __name__ == "__main__":
+    main()
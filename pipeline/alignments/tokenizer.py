@@ -6,6 +6,8 @@ Example:
   python pipeline/alignments/tokenizer.py --input_path=data/datasets/news.2023.en.shuffled.deduped \
     --output_path=data/datasets/news.2023.en.shuffled.deduped.tok-icu --lang=en --chunk_size=500000 --tokenizer=icu
 
+The input and output files are read and written compressed if they end with .zst.
+
 Using C++ opus-fast-mosestokenizer sometimes requires specifying LD_LIBRARY_PATH before starting the Python process
 see https://github.com/Helsinki-NLP/opus-fast-mosestokenizer/issues/6
 export LD_LIBRARY_PATH=.../<you-python-env>/lib/python3.10/site-packages/mosestokenizer/lib
@@ -16,19 +18,37 @@ see more installation instructions here: https://pypi.org/project/PyICU/
 Whitespaces are ignored by Moses based tokenizers and preserved and replaced with a special token "▁" by ICU tokenizer
 which allows lossless reconstruction of the original text on detokenization.
 
+Optionally, the index of the whitespace separated word that each token belongs to can be written out with
+--word_indices_path. It has a line of space separated indices for each sentence, where -1 marks a whitespace token.
+This is used for remapping alignments back to the whitespace tokenization.
+
 """
 import argparse
+import hashlib
+import html
+import importlib.metadata
 import multiprocessing
+import os
+import zlib
 from abc import ABC, abstractmethod
+from contextlib import ExitStack
 from enum import Enum
-from typing import List
+from typing import BinaryIO, List, Optional, Tuple
 
 from tqdm import tqdm
+from zstandard import ZstdCompressor, ZstdDecompressor
 
+from pipeline.common.downloads import read_lines
 from pipeline.common.logging import get_logger
 
 logger = get_logger("tokenizer")
 
+# Bump this when the tokenization output changes, to invalidate the TokenizationCache.
+CACHE_VERSION = "1"
+
+# The average number of lines in a content defined chunk of the TokenizationCache.
+CACHE_CHUNK_LINES = 10_000
+
 
 class TokenizerType(Enum):
     fast_moses = "fast_moses"
@@ -48,6 +68,14 @@ class Tokenizer(ABC):
     def detokenize(self, tokens: List[str]) -> str:
         pass
 
+    def tokenize_with_word_indices(self, text: str) -> Tuple[List[str], List[int]]:
+        """
+        Tokenize the text, and return the index of the whitespace separated word in the
+        original text for each token.
+        """
+        tokens = self.tokenize(text)
+        return tokens, get_word_indices(tokens, text)
+
 
 class FastMosesTokenizer(Tokenizer):
     """
@@ -104,53 +132,278 @@ class IcuTokenizer(Tokenizer):
     # Same character is used by SentencePiece
     SPACE_TOKEN = "▁"
 
-    def tokenize(self, text: str) -> List[str]:
+    def __init__(self, lang):
+        super().__init__(lang)
         from icu import BreakIterator, Locale
 
-        bi = BreakIterator.createWordInstance(Locale(self.lang))
+        # Creating the break iterator is expensive, so it's re-used for every sentence.
+        self.break_iterator = BreakIterator.createWordInstance(Locale(lang))
+
+    def tokenize(self, text: str) -> List[str]:
+        tokens, _ = self.tokenize_with_word_indices(text)
+        return tokens
+
+    def tokenize_with_word_indices(self, text: str) -> Tuple[List[str], List[int]]:
+        """
+        The word indices are computed directly from the word boundaries. Whitespace tokens don't
+        belong to any word and get the index -1.
+        """
+        bi = self.break_iterator
         bi.setText(text)
 
         tokens = []
+        word_indices = []
+        word_index = -1
+        after_space = True
         start = bi.first()
         for end in bi:
             token = text[start:end]
             if (
                 token and token != "\n"
             ):  # exclude empty tokens, but leave whitespaces and replace them with a special token
+                if token.isspace():
+                    after_space = True
+                    word_indices.append(-1)
+                else:
+                    # Tokens can also have surrounding whitespace, e.g. "🤣 "
+                    if after_space or token[0].isspace():
+                        word_index += 1
+                    after_space = token[-1].isspace()
+                    word_indices.append(word_index)
                 tokens.append(token.replace(" ", self.SPACE_TOKEN))
             start = end
-        return tokens
+        return tokens, word_indices
 
     def detokenize(self, tokens: List[str]) -> str:
         return "".join(tokens).replace(self.SPACE_TOKEN, " ")
 
 
 def _read_file_in_chunks(file_path, chunk_size):
-    with open(file_path, "r", encoding="utf-8") as file:
-        while True:
-            lines = file.readlines(chunk_size)
-            if not lines:
-                break
-            yield [line.rstrip() for line in lines]
+    """
+    Read the lines of a plain or compressed file in chunks of about chunk_size characters.
+    """
+    with read_lines(file_path) as lines:
+        chunk = []
+        chunk_chars = 0
+        for line in lines:
+            chunk.append(line.rstrip())
+            chunk_chars += len(line)
+            if chunk_chars >= chunk_size:
+                yield chunk
+                chunk = []
+                chunk_chars = 0
+        if chunk:
+            yield chunk
+
+
+def _read_file_in_content_defined_chunks(file_path):
+    """
+    Read the lines of a file in chunks where the boundaries are determined by the content of the
+    lines rather than their position. A chunk ends after a line whose hash is divisible by
+    CACHE_CHUNK_LINES, so the same run of lines produces the same chunks in different files,
+    e.g. when a corpus is included in a larger one. This allows the chunks to be cached.
+    """
+    with read_lines(file_path) as lines:
+        chunk = []
+        for line in lines:
+            stripped_line = line.rstrip()
+            chunk.append(stripped_line)
+            if (
+                zlib.crc32(stripped_line.encode("utf-8")) % CACHE_CHUNK_LINES == 0
+                or len(chunk) >= CACHE_CHUNK_LINES * 8
+            ):
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
 
-def _tokenize_lines(params) -> List[str]:
-    lines, lang, tok_type = params
+class TokenizationCache:
+    """
+    A content addressed cache of tokenized chunks, stored in a local directory. The chunks are
+    keyed by the tokenizer type, language, tokenizer version, and the digest of the lines, and
+    are stored compressed with their word indices, e.g.
+
+        tokenization-cache/
+          ├── 3f2a...c1.tok.zst
+          └── 3f2a...c1.idx.zst
+
+    In Taskcluster, the directory is published as an artifact so that later alignment tasks
+    can fetch it and only tokenize the chunks that are missing.
+    """
+
+    def __init__(self, cache_dir: str, tokenizer_type: TokenizerType, lang: str) -> None:
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.key_prefix = "\n".join(
+            [
+                CACHE_VERSION,
+                tokenizer_type.value,
+                lang,
+                get_tokenizer_version(tokenizer_type),
+                "",
+            ]
+        ).encode("utf-8")
+
+    def get_key(self, lines: List[str]) -> str:
+        digest = hashlib.sha256(self.key_prefix)
+        for line in lines:
+            digest.update(line.encode("utf-8"))
+            digest.update(b"\n")
+        return digest.hexdigest()
+
+    def _get_paths(self, key: str) -> Tuple[str, str]:
+        return (
+            os.path.join(self.cache_dir, f"{key}.tok.zst"),
+            os.path.join(self.cache_dir, f"{key}.idx.zst"),
+        )
+
+    def get(self, key: str) -> Optional[Tuple[bytes, bytes]]:
+        """Returns the tokenized lines and the word indices, if the chunk is in the cache."""
+        tokenized_path, indices_path = self._get_paths(key)
+        if not os.path.exists(indices_path):
+            return None
+        decompressor = ZstdDecompressor()
+        with open(tokenized_path, "rb") as tokenized, open(indices_path, "rb") as indices:
+            return (
+                decompressor.stream_reader(tokenized).read(),
+                decompressor.stream_reader(indices).read(),
+            )
+
+    def put(self, key: str, tokenized_block: bytes, indices_block: bytes) -> None:
+        # The indices are written last, and the files are renamed into place, so that a
+        # chunk is never read partially written.
+        compressor = ZstdCompressor()
+        for path, block in zip(self._get_paths(key), (tokenized_block, indices_block)):
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as file:
+                file.write(compressor.compress(block))
+            os.replace(tmp_path, path)
+
+
+def get_tokenizer_version(tokenizer_type: TokenizerType) -> str:
+    package = {
+        TokenizerType.fast_moses: "opus-fast-mosestokenizer",
+        TokenizerType.sacre_moses: "sacremoses",
+        TokenizerType.icu: "PyICU",
+    }[tokenizer_type]
+    try:
+        return importlib.metadata.version(package)
+    except importlib.metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def get_word_indices(tokens: List[str], text: str) -> List[int]:
+    """
+    Map the tokens of a sentence to the indices of the whitespace separated words in the
+    original text. Tokens that can't be matched to a word get the index -1.
 
+    For 'Hello, world!'
+    Map ['Hello', ',', 'world', '!']
+    To ['Hello,', 'world!']
+    Result: [0, 0, 1, 1]
+    """
+    word_indices = [-1] * len(tokens)
+    token_index = 0
+    for word_index, word in enumerate(text.split()):
+        # Tokens are consumed until they cover the word, comparing lengths rather than
+        # concatenating the strings. Moses escapes special characters, e.g. "'" -> "&apos;".
+        covered = 0
+        while token_index < len(tokens) and covered < len(word):
+            token = tokens[token_index]
+            covered += len(html.unescape(token) if "&" in token else token)
+            word_indices[token_index] = word_index
+            token_index += 1
+    return word_indices
+
+
+def _create_tokenizer(tok_type: TokenizerType, lang: str) -> Tokenizer:
     if tok_type == TokenizerType.fast_moses:
-        tokenizer = FastMosesTokenizer(lang)
-    elif tok_type == TokenizerType.sacre_moses:
-        tokenizer = SacreMosesTokenizer(lang)
-    elif tok_type == TokenizerType.icu:
-        tokenizer = IcuTokenizer(lang)
-    else:
-        raise ValueError(f"Unknown tokenizer type: {tok_type}")
+        return FastMosesTokenizer(lang)
+    if tok_type == TokenizerType.sacre_moses:
+        return SacreMosesTokenizer(lang)
+    if tok_type == TokenizerType.icu:
+        return IcuTokenizer(lang)
+    raise ValueError(f"Unknown tokenizer type: {tok_type}")
+
+
+# The tokenizer of a worker process, which is created once by the pool initializer.
+_worker_tokenizer: Optional[Tokenizer] = None
+_worker_init_error: Optional[Exception] = None
+_worker_with_word_indices = False
+_worker_cache: Optional[TokenizationCache] = None
+
 
+def _init_worker(
+    tok_type: TokenizerType, lang: str, with_word_indices: bool, cache_dir: Optional[str]
+) -> None:
+    global _worker_tokenizer, _worker_init_error, _worker_with_word_indices, _worker_cache
+    _worker_with_word_indices = with_word_indices
+    try:
+        if cache_dir:
+            _worker_cache = TokenizationCache(cache_dir, tok_type, lang)
+        _worker_tokenizer = _create_tokenizer(tok_type, lang)
+    except Exception as exception:
+        # A pool keeps restarting workers that fail to initialize, so report the error
+        # from the first task instead.
+        _worker_init_error = exception
+
+
+def _tokenize_lines(lines: List[str]) -> Tuple[int, bytes, Optional[bytes], bool]:
+    """
+    Tokenize a chunk of lines in a worker process. The lines are returned already joined and
+    encoded, so the main process only needs to write them out. The last value reports whether
+    the chunk was found in the cache.
+    """
+    if _worker_init_error:
+        raise _worker_init_error
+    tokenizer = _worker_tokenizer
+    assert tokenizer, "The worker was not initialized"
+
+    cache_key = None
+    if _worker_cache:
+        cache_key = _worker_cache.get_key(lines)
+        cached = _worker_cache.get(cache_key)
+        if cached:
+            tokenized_block, indices_block = cached
+            return (
+                len(lines),
+                tokenized_block,
+                indices_block if _worker_with_word_indices else None,
+                True,
+            )
+
+    # The word indices are always stored in the cache, so that any task can use them.
+    with_word_indices = _worker_with_word_indices or bool(_worker_cache)
     tokenized = []
+    word_indices = []
     for line in lines:
-        tokens = tokenizer.tokenize(line)
+        if with_word_indices:
+            tokens, indices = tokenizer.tokenize_with_word_indices(line)
+            word_indices.append(" ".join(map(str, indices)))
+        else:
+            tokens = tokenizer.tokenize(line)
         tokenized.append(" ".join(tokens))
-    return tokenized
+
+    tokenized_block = ("\n".join(tokenized) + "\n").encode("utf-8")
+    indices_block = ("\n".join(word_indices) + "\n").encode("utf-8") if word_indices else None
+    if _worker_cache and cache_key:
+        _worker_cache.put(cache_key, tokenized_block, indices_block or b"")
+
+    return (
+        len(lines),
+        tokenized_block,
+        indices_block if _worker_with_word_indices else None,
+        False,
+    )
+
+
+def _open_output(stack: ExitStack, path: str) -> BinaryIO:
+    """Open a binary output file, which is compressed if the path ends with .zst"""
+    file = stack.enter_context(open(path, "wb"))
+    if path.endswith(".zst"):
+        return stack.enter_context(ZstdCompressor(threads=-1).stream_writer(file))
+    return file
 
 
 def tokenize(
@@ -159,21 +412,53 @@ def tokenize(
     lang: str,
     tokenizer: TokenizerType,
     sentences_per_chunk: int = 100000,
+    word_indices_path: Optional[str] = None,
+    cache_dir: Optional[str] = None,
 ) -> None:
-    logger.info(f"Tokenizing {input_path} with Moses tokenizer")
+    """
+    Tokenize a file in parallel. The input and outputs can be .zst files. If a
+    word_indices_path is provided, the indices of the words in the original text are written
+    there for each token, which is done in the same pass.
 
-    with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
-        with open(output_path, "w") as output_file:
+    With a cache_dir, the file is split into content defined chunks, and only the chunks that
+    are missing from the TokenizationCache are tokenized.
+    """
+    logger.info(f"Tokenizing {input_path} with {tokenizer.value} tokenizer")
+
+    with ExitStack() as stack:
+        pool = stack.enter_context(
+            multiprocessing.Pool(
+                processes=multiprocessing.cpu_count(),
+                initializer=_init_worker,
+                initargs=(tokenizer, lang, bool(word_indices_path), cache_dir),
+            )
+        )
+        output_file = _open_output(stack, output_path)
+        indices_file = _open_output(stack, word_indices_path) if word_indices_path else None
+        if cache_dir:
+            logger.info(f"Using the tokenization cache: {cache_dir}")
+            chunks = _read_file_in_content_defined_chunks(input_path)
+        else:
             chunks = _read_file_in_chunks(input_path, chunk_size=sentences_per_chunk)
 
-            pbar = tqdm(mininterval=10)
-            # ~100K sentences per second on a single core
-            for tokenized_chunk in pool.imap(
-                _tokenize_lines,
-                ((ch, lang, tokenizer) for ch in chunks),
-            ):
-                output_file.write("\n".join(tokenized_chunk) + "\n")
-                pbar.update(len(tokenized_chunk))
+        cache_hits = 0
+        cache_misses = 0
+        pbar = tqdm(mininterval=10)
+        # ~100K sentences per second on a single core
+        for lines_count, tokenized_block, indices_block, cache_hit in pool.imap(
+            _tokenize_lines, chunks
+        ):
+            output_file.write(tokenized_block)
+            if indices_file:
+                indices_file.write(indices_block)
+            pbar.update(lines_count)
+            if cache_hit:
+                cache_hits += 1
+            else:
+                cache_misses += 1
+
+        if cache_dir:
+            logger.info(f"Tokenization cache hits: {cache_hits}, misses: {cache_misses}")
 
 
 if __name__ == "__main__":
@@ -217,6 +502,20 @@ if __name__ == "__main__":
         default=TokenizerType.icu,
         help="Tokenization method",
     )
+    parser.add_argument(
+        "--word_indices_path",
+        metavar="WORD_INDICES_PATH",
+        type=str,
+        default=None,
+        help="Output file for the indices of the whitespace separated words of the tokens",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        metavar="CACHE_DIR",
+        type=str,
+        default=None,
+        help="A directory to reuse the tokenized chunks from, and to store them in",
+    )
     args = parser.parse_args()
     tokenize(
         input_path=args.input_path,
@@ -224,4 +523,6 @@ if __name__ == "__main__":
         lang=args.lang,
         sentences_per_chunk=args.chunk_size,
         tokenizer=args.tokenizer,
+        word_indices_path=args.word_indices_path,
+        cache_dir=args.cache_dir,
     )
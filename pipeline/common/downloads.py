@@ -1,12 +1,16 @@
 import gzip
+import hashlib
 import io
 import json
 import os
+import shutil
 import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import ExitStack, contextmanager
 from io import BufferedReader
 from pathlib import Path
-from typing import Callable, Generator, Literal, Optional, Union
+from typing import Callable, Generator, Iterable, Literal, Optional, Union
 from zipfile import ZipFile
 
 import requests
@@ -33,6 +37,85 @@ def stream_download_to_file(url: str, destination: Union[str, Path]) -> None:
             file.write(chunk)
 
 
+def get_file_digest(path: Union[str, Path]) -> str:
+    """The sha256 of a file, which is read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def atomic_write(path: Union[str, Path], data: bytes) -> None:
+    """Write to a temporary file first, so that a preempted task never leaves a partial file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+TASKCLUSTER_ARTIFACTS_URL = "{root_url}/api/queue/v1/task/{task_id}/runs/{run_id}/artifacts"
+
+
+def download_previous_run_checkpoint(
+    checkpoint_dir: Union[str, Path],
+    manifest_name: str,
+    get_file_names: Callable[[dict], Iterable[str]],
+) -> bool:
+    """
+    When a Taskcluster task is retried, download a checkpoint from the artifacts of the latest
+    previous run that has one, the same way that the training is continued. The JSON manifest
+    is downloaded first, and get_file_names returns the names of the files that it refers to.
+
+    Any failure only means that the task starts from the beginning. Returns True when a
+    checkpoint was downloaded.
+    """
+    run_id = int(os.environ.get("RUN_ID", "0"))
+    task_id = os.environ.get("TASK_ID")
+    root_url = os.environ.get("TASKCLUSTER_ROOT_URL")
+    if run_id == 0 or not task_id or not root_url:
+        return False
+    if os.path.exists(os.path.join(checkpoint_dir, manifest_name)):
+        logger.info("Using the existing checkpoint")
+        return True
+
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    for prev_run_id in range(run_id - 1, -1, -1):
+        artifacts_url = TASKCLUSTER_ARTIFACTS_URL.format(
+            root_url=root_url, task_id=task_id, run_id=prev_run_id
+        )
+        try:
+            response = requests.get(artifacts_url)
+            response.raise_for_status()
+            artifacts = {
+                os.path.basename(artifact["name"]): artifact["name"]
+                for artifact in response.json()["artifacts"]
+            }
+            if manifest_name not in artifacts:
+                logger.info(f"Run {prev_run_id} has no checkpoint")
+                continue
+
+            def download(name: str) -> None:
+                path = os.path.join(checkpoint_dir, name)
+                stream_download_to_file(f"{artifacts_url}/{artifacts[name]}", f"{path}.tmp")
+                os.replace(f"{path}.tmp", path)
+
+            download(manifest_name)
+            with open(os.path.join(checkpoint_dir, manifest_name), "r", encoding="utf-8") as file:
+                manifest = json.load(file)
+            for name in get_file_names(manifest):
+                # A missing file is caught when the checkpoint is loaded.
+                if name in artifacts:
+                    download(name)
+            logger.info(f"Resuming from the checkpoint of run {prev_run_id}")
+            return True
+        except Exception:
+            logger.exception(f"Failed to download the checkpoint of run {prev_run_id}")
+            shutil.rmtree(checkpoint_dir)
+            os.makedirs(checkpoint_dir)
+    return False
+
+
 def get_mocked_downloads_file_path(url: str) -> Optional[str]:
     """If there is a mocked download, get the path to the file, otherwise return None"""
     if not os.environ.get("MOCKED_DOWNLOADS"):
@@ -482,13 +565,15 @@ def read_lines(
 
 
 @contextmanager
-def write_lines(path: Path | str, encoding="utf-8"):
+def write_lines(path: Path | str, encoding="utf-8", zstd_threads: int = 0):
     """
     A smart function to create a context to write lines to a file. It works on .zst, .gz, and
     raw text files. It reads the extension to determine the file type. If writing out a raw
     text file, for instance a sample of a dataset that is just used for viewing, include a
     "byte order mark" so that the browser can properly detect the encoding.
 
+    A .zst file can be compressed with zstd_threads, where -1 uses all of the cores.
+
     with write_lines("output.txt.gz") as output:
         output.write("writing a line\n")
         output.write("writing a second lines\n")
@@ -500,7 +585,9 @@ def write_lines(path: Path | str, encoding="utf-8"):
 
         if path.endswith(".zst"):
             file = stack.enter_context(open(path, "wb"))
-            compressor = stack.enter_context(ZstdCompressor().stream_writer(file))
+            compressor = stack.enter_context(
+                ZstdCompressor(threads=zstd_threads).stream_writer(file)
+            )
             yield stack.enter_context(io.TextIOWrapper(compressor, encoding=encoding))
         elif path.endswith(".gz"):
             yield stack.enter_context(gzip.open(path, "wt", encoding=encoding))
@@ -511,6 +598,77 @@ def write_lines(path: Path | str, encoding="utf-8"):
         stack.close()
 
 
+class ParallelGzipWriter:
+    """
+    Write a gzip file like pigz does, by compressing blocks of the data on a pool of threads.
+    Each block is written out as its own gzip member, which gzip and zlib readers decompress as
+    one stream. zlib releases the GIL while compressing, so the blocks compress in parallel.
+
+    A threads value of -1 uses all of the cores.
+
+    with ParallelGzipWriter("corpus.tsv.gz") as output:
+        output.write(b"source\ttarget\n")
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        threads: int = -1,
+        block_size: int = 4 * 1024 * 1024,
+        compresslevel: int = 6,
+    ) -> None:
+        self.threads = (os.cpu_count() or 1) if threads == -1 else max(threads, 1)
+        self.block_size = block_size
+        self.compresslevel = compresslevel
+        self.file = open(path, "wb")
+        self.executor = ThreadPoolExecutor(self.threads)
+        self.pending: deque[Future] = deque()
+        self.buffer: list[bytes] = []
+        self.buffer_size = 0
+        self.blocks = 0
+
+    def __enter__(self) -> "ParallelGzipWriter":
+        return self
+
+    def __exit__(self, exc_type, _exc_val, _exc_tb) -> None:
+        if exc_type:
+            self.executor.shutdown(cancel_futures=True)
+            self.file.close()
+        else:
+            self.close()
+
+    def write(self, data: bytes) -> None:
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= self.block_size:
+            self._compress_buffer()
+
+    def close(self) -> None:
+        self._compress_buffer()
+        if not self.blocks:
+            # gzip fails on an empty file, so write out an empty member.
+            self.file.write(gzip.compress(b"", self.compresslevel, mtime=0))
+        while self.pending:
+            self.file.write(self.pending.popleft().result())
+        self.executor.shutdown()
+        self.file.close()
+
+    def _compress_buffer(self) -> None:
+        if not self.buffer_size:
+            return
+        block = b"".join(self.buffer)
+        self.buffer = []
+        self.buffer_size = 0
+        self.blocks += 1
+        # The mtime is fixed so that the output is reproducible.
+        self.pending.append(
+            self.executor.submit(gzip.compress, block, self.compresslevel, mtime=0)
+        )
+        # Only a few blocks per thread are held in memory.
+        while len(self.pending) > self.threads * 2:
+            self.file.write(self.pending.popleft().result())
+
+
 def count_lines(path: Path | str) -> int:
     """
     Similar to wc -l, this counts the lines in a file. However, this command does so regardless
@@ -1,12 +1,15 @@
+from collections import deque
+import json
 import logging
+import os
 from pathlib import Path
 import subprocess
 import threading
 import time
+from typing import Optional
 
 logging.basicConfig(level=logging.INFO, format="[%(name)s] %(message)s")
 
-STOP_BYTE_COUNT_LOGGER = False
 STOP_GPU_LOGGER = False
 
 
@@ -64,64 +67,143 @@ def start_gpu_logging(logger: logging.Logger, interval_seconds: int):
     thread.start()
 
 
-def _log_byte_rate(logger: logging.Logger, interval_seconds: int, file_path: Path):
-    global STOP_BYTE_COUNT_LOGGER
-    previous_byte_count = 0
-    previous_time = time.time()
-    is_zst = file_path.suffix == ".zst"
+# The number of reports that the moving average of the throughput is taken over.
+MOVING_AVERAGE_REPORTS = 6
 
-    while True:
-        time.sleep(interval_seconds)
-        if STOP_BYTE_COUNT_LOGGER:
-            STOP_BYTE_COUNT_LOGGER = False
-            return
-
-        try:
-            if is_zst:
-                # This takes ~1 second to run on 5 million sentences.
-                current_byte_count = 0
-                cmd = ["zstd", "-dc", str(file_path)]
-                with subprocess.Popen(
-                    cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-                ) as process:
-                    for chunk in iter(lambda: process.stdout.read(8192), b""):
-                        current_byte_count += len(chunk)
-            else:
-                # This is pretty much instantaneous.
-                result = subprocess.run(
-                    ["wc", "-c", str(file_path)], capture_output=True, text=True, check=True
-                )
-                current_byte_count = int(result.stdout.split()[0])
-
-            bytes_added = current_byte_count - previous_byte_count
-
-            current_secs = time.time()
-            elapsed_secs = current_secs - previous_time
-            byte_rate = bytes_added / elapsed_secs if bytes_added > 0 else 0
 
-            logger.info(f"[bytes] Added: {bytes_added:,}")
-            logger.info(f"[bytes] Total: {current_byte_count:,}")
-            logger.info(f"[bytes] Rate: {byte_rate:,.2f} bytes/second")
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
 
-            previous_byte_count = current_byte_count
-            previous_time = time.time()
-        except Exception as e:
-            logger.error(f"Failed to monitor byte count: {e}")
 
-
-def stop_byte_count_logger():
-    global STOP_BYTE_COUNT_LOGGER
-    STOP_BYTE_COUNT_LOGGER = True
-
-
-def start_byte_count_logger(logger: logging.Logger, interval_seconds: int, file_path: Path):
+class ProgressCounters:
     """
-    Monitors the rate of bytes being added to a file, logging the number of bytes
-    added per second over the interval.
+    Counters of the lines, tokens and bytes that were processed, which the writers increment
+    directly. While it runs, a background thread logs the rates, a moving average of the line
+    throughput and the ETA on an interval, and writes them to a JSON file.
+
+    with ProgressCounters(logger, 300, Path("artifacts/file.1.progress.json")) as progress:
+        progress.total_lines = 1_000
+        for line in lines:
+            ...
+            progress.add(lines=1, bytes=len(line))
     """
 
-    assert not STOP_BYTE_COUNT_LOGGER, "A line count logger should not already be running"
-    thread = threading.Thread(
-        target=_log_byte_rate, args=(logger, interval_seconds, file_path), daemon=True
-    )
-    thread.start()
+    def __init__(
+        self,
+        logger: logging.Logger,
+        interval_seconds: int,
+        json_path: Optional[Path] = None,
+        initial_lines: int = 0,
+    ) -> None:
+        self.logger = logger
+        self.interval_seconds = interval_seconds
+        self.json_path = json_path
+        # The lines that were processed before, for instance by a previous run.
+        self.initial_lines = initial_lines
+        self.lines = initial_lines
+        self.tokens = 0
+        self.bytes = 0
+        # The total is optional, and can be set later, as it is only needed for the ETA.
+        self.total_lines: Optional[int] = None
+        # When the first lines were processed, for the time to the first output.
+        self.first_output_time: Optional[float] = None
+
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.start_time = time.time()
+        self.samples: deque[tuple[float, int]] = deque(maxlen=MOVING_AVERAGE_REPORTS + 1)
+        self.thread: Optional[threading.Thread] = None
+
+    def add(self, lines: int = 0, tokens: int = 0, bytes: int = 0) -> None:
+        with self.lock:
+            if lines and self.first_output_time is None:
+                self.first_output_time = time.time()
+            self.lines += lines
+            self.tokens += tokens
+            self.bytes += bytes
+
+    def start(self) -> None:
+        self.start_time = time.time()
+        self.samples.append((self.start_time, self.lines))
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stop the reporter, and write out the final report."""
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.report()
+
+    def __enter__(self) -> "ProgressCounters":
+        self.start()
+        return self
+
+    def __exit__(self, *_exc) -> None:
+        self.stop()
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.interval_seconds):
+            try:
+                self.report()
+            except Exception as e:
+                self.logger.error(f"Failed to report the progress: {e}")
+
+    def get_stats(self) -> dict:
+        """The counts and the rates, which also adds a sample to the moving average."""
+        now = time.time()
+        with self.lock:
+            lines, tokens, num_bytes = self.lines, self.tokens, self.bytes
+        elapsed_secs = max(now - self.start_time, 1e-6)
+        sample_time, sample_lines = self.samples[0]
+        self.samples.append((now, lines))
+
+        stats = {
+            "elapsed_seconds": round(elapsed_secs, 1),
+            "lines": lines,
+            "tokens": tokens,
+            "bytes": num_bytes,
+            "lines_per_second": (lines - self.initial_lines) / elapsed_secs,
+            "moving_lines_per_second": (lines - sample_lines) / max(now - sample_time, 1e-6),
+            "tokens_per_second": tokens / elapsed_secs,
+            "bytes_per_second": num_bytes / elapsed_secs,
+            "first_output_seconds": (
+                round(self.first_output_time - self.start_time, 3)
+                if self.first_output_time
+                else None
+            ),
+            "total_lines": self.total_lines,
+            "percent": None,
+            "eta_seconds": None,
+        }
+        if self.total_lines:
+            stats["percent"] = round(100 * lines / self.total_lines, 2)
+            if stats["moving_lines_per_second"] > 0:
+                stats["eta_seconds"] = round(
+                    max(self.total_lines - lines, 0) / stats["moving_lines_per_second"], 1
+                )
+        return stats
+
+    def report(self) -> None:
+        stats = self.get_stats()
+        message = f"[progress] {stats['lines']:,} lines"
+        if stats["percent"] is not None:
+            message += f" of {stats['total_lines']:,} ({stats['percent']}%)"
+        message += (
+            f", {stats['lines_per_second']:,.1f} lines/second"
+            f" (moving average {stats['moving_lines_per_second']:,.1f})"
+        )
+        if stats["tokens"]:
+            message += f", {stats['tokens_per_second']:,.1f} tokens/second"
+        message += f", {stats['bytes_per_second']:,.0f} bytes/second"
+        if stats["eta_seconds"] is not None:
+            message += f", ETA {format_duration(stats['eta_seconds'])}"
+        self.logger.info(message)
+
+        if self.json_path:
+            tmp_path = self.json_path.parent / f"{self.json_path.name}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump(stats, file, indent=2)
+            os.replace(tmp_path, self.json_path)
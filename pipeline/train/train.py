@@ -3,16 +3,19 @@ Run training using Marian and OpusTrainer.
 """
 
 import argparse
-from contextlib import ExitStack
+from contextlib import ExitStack, contextmanager
 from enum import Enum
+from itertools import islice
 import os
 from pathlib import Path
+from queue import Empty, Queue
 import random
 import shutil
 import tempfile
-from typing import Any, Generator, Optional
+from threading import Event, Thread
+from typing import Any, Generator, Iterator, Optional
 
-from pipeline.common.downloads import read_lines, write_lines
+from pipeline.common.downloads import ParallelGzipWriter, read_lines
 from pipeline.common.logging import get_logger
 from pipeline.common.command_runner import apply_command_args, run_command_pipeline
 
@@ -22,6 +25,15 @@ train_dir = Path(__file__).parent
 
 CJK_LANGS = ["zh", "ja", "ko"]
 
+# The number of lines that are decompressed and merged into the TSV at a time.
+TSV_BATCH_LINES = 10_000
+
+# The gzip level of the TSV. Higher levels are several times slower for a slightly smaller file.
+TSV_COMPRESSION_LEVEL = 3
+
+# The number of the discarded lines with empty alignments that are logged.
+EMPTY_ALIGNMENT_SAMPLES = 50
+
 
 class ModelType(Enum):
     student = "student"
@@ -59,17 +71,87 @@ class BestModelMetric(Enum):
     #   bleu_segmented = "bleu-segmented"
 
 
+class Reservoir:
+    """A uniform random sample of a stream of items, which only holds the sample in memory."""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.count = 0
+        self.samples: list[Any] = []
+
+    def add(self, item: Any) -> None:
+        self.count += 1
+        if len(self.samples) < self.size:
+            self.samples.append(item)
+        else:
+            index = random.randrange(self.count)
+            if index < self.size:
+                self.samples[index] = item
+
+
+@contextmanager
+def read_line_batches_in_thread(
+    path: Path, maxsize: int = 4
+) -> Generator[Iterator[list[str]], None, None]:
+    """
+    Decompress and decode the lines of a file on a background thread with read_lines, and yield
+    them in batches through a bounded queue. Any exception of the reader is raised by the
+    consumer.
+    """
+    queue: Queue = Queue(maxsize)
+    stop = Event()
+    done = object()
+
+    def read() -> None:
+        try:
+            with read_lines(path) as lines:
+                while not stop.is_set():
+                    batch = list(islice(lines, TSV_BATCH_LINES))
+                    if not batch:
+                        break
+                    queue.put((batch, None))
+            queue.put((done, None))
+        except Exception as exception:
+            queue.put((None, exception))
+
+    def iterate() -> Iterator[list[str]]:
+        while True:
+            batch, exception = queue.get()
+            if exception:
+                raise exception
+            if batch is done:
+                return
+            yield batch
+
+    thread = Thread(target=read, daemon=True)
+    thread.start()
+    try:
+        yield iterate()
+    finally:
+        stop.set()
+        # The reader may be blocked on a full queue when the batches weren't all consumed.
+        while thread.is_alive():
+            try:
+                queue.get(timeout=0.1)
+            except Empty:
+                pass
+
+
 def build_dataset_tsv(
     dataset_prefix: str,
     src: str,
     trg: str,
     alignments_file: Optional[Path] = None,
+    threads: int = -1,
 ) -> Path:
     """
-    Takes as input a dataset prefix, and combines the datasets into a TSV, removing
+    Takes as input a dataset prefix, and combines the datasets into a gzipped TSV, removing
     the original files. If an alignments file is provided, any empty alignments will
     be discarded.
 
+    The inputs are decompressed on their own threads, and the TSV is compressed in blocks on
+    a pool of threads, where -1 uses all of the cores.
+
     For instance:
         Prefix:
           - path/to/corpus
@@ -80,49 +162,54 @@ def build_dataset_tsv(
           - path/to/corpus.aln.zst
 
         And then builds:
-          - path/to/corpus.enfr.tsv
+          - path/to/corpus.enfr.tsv.gz
     """
     src_path = Path(f"{dataset_prefix}.{src}.zst")
     trg_path = Path(f"{dataset_prefix}.{trg}.zst")
     # OpusTrainer supports only tsv and gzip
-    # TODO: pigz is not installed on the generic Taskcluster worker, so we use datasets in decompressed mode for now
-    tsv_path = Path(f"{dataset_prefix}.{src}{trg}.tsv")  # .gz
+    tsv_path = Path(f"{dataset_prefix}.{src}{trg}.tsv.gz")
 
     with ExitStack() as stack:
-        tsv_outfile = stack.enter_context(write_lines(tsv_path))
-        src_lines: Generator[str, Any, Any] = stack.enter_context(read_lines(src_path))
-        trg_lines: Generator[str, Any, Any] = stack.enter_context(read_lines(trg_path))
+        tsv_outfile = stack.enter_context(
+            ParallelGzipWriter(tsv_path, threads, compresslevel=TSV_COMPRESSION_LEVEL)
+        )
+        src_batches = stack.enter_context(read_line_batches_in_thread(src_path))
+        trg_batches = stack.enter_context(read_line_batches_in_thread(trg_path))
 
         logger.info(f"Generating tsv dataset: {tsv_path}")
 
         if alignments_file:
             logger.info(f"Using alignments file: {alignments_file}")
 
-            aln_lines: Generator[str, Any, Any] = stack.enter_context(
-                read_lines(f"{alignments_file}")
-            )
-            empty_alignments = []
-
-            for src_line, trg_line, aln_line in zip(src_lines, trg_lines, aln_lines):
-                if aln_line.strip():
-                    tsv_outfile.write(
-                        f"{src_line.strip()}\t{trg_line.strip()}\t{aln_line.strip()}\n"
-                    )
-                else:
-                    # do not write lines with empty alignments to TSV, Marian will complain and skip those
-                    empty_alignments.append((src_line, trg_line))
-
-            if empty_alignments:
-                logger.info(f"Number of empty alignments is {len(empty_alignments)}")
+            aln_batches = stack.enter_context(read_line_batches_in_thread(alignments_file))
+            empty_alignments = Reservoir(EMPTY_ALIGNMENT_SAMPLES)
+
+            for src_batch, trg_batch, aln_batch in zip(src_batches, trg_batches, aln_batches):
+                rows = []
+                for src_line, trg_line, aln_line in zip(src_batch, trg_batch, aln_batch):
+                    alignment = aln_line.strip()
+                    if alignment:
+                        rows.append(f"{src_line.strip()}\t{trg_line.strip()}\t{alignment}\n")
+                    else:
+                        # do not write lines with empty alignments to TSV, Marian will complain and skip those
+                        empty_alignments.add((src_line, trg_line))
+                tsv_outfile.write("".join(rows).encode("utf-8"))
+
+            if empty_alignments.count:
+                logger.info(f"Number of empty alignments is {empty_alignments.count}")
                 logger.info("Sample of empty alignments:")
-                random.shuffle(empty_alignments)
-                for src_line, trg_line in empty_alignments[:50]:
+                for src_line, trg_line in empty_alignments.samples:
                     logger.info(f"  src: {src_line.strip()}")
                     logger.info(f"  trg: {trg_line.strip()}")
 
         else:
-            for src_line, trg_line in zip(src_lines, trg_lines):
-                tsv_outfile.write(f"{src_line.strip()}\t{trg_line.strip()}\n")
+            for src_batch, trg_batch in zip(src_batches, trg_batches):
+                tsv_outfile.write(
+                    "".join(
+                        f"{src_line.strip()}\t{trg_line.strip()}\n"
+                        for src_line, trg_line in zip(src_batch, trg_batch)
+                    ).encode("utf-8")
+                )
 
     logger.info("Freeing up disk space after TSV merge.")
     logger.info(f"Removing {src_path}")
@@ -220,12 +307,12 @@ class TrainCLI:
     def build_datasets(self) -> None:
         # Start by building the training datasets, e.g.
         #
-        #  corpus.enfr.tsv from:
+        #  corpus.enfr.tsv.gz from:
         #   - fetches/corpus.en.zst
         #   - fetches/corpus.fr.zst
         #   - fetches/corpus.aln.zst
         #
-        #  mono.enfr.tsv from:
+        #  mono.enfr.tsv.gz from:
         #   - fetches/mono.en.zst
         #   - fetches/mono.fr.zst
         #   - fetches/mono.aln.zst
@@ -244,7 +331,7 @@ class TrainCLI:
 
         # Then build out the validation set, for instance:
         #
-        # devset.enfr.tsv from:
+        # devset.enfr.tsv.gz from:
         #  - fetches/devset.en.zst
         #  - fetches/devset.fr.zst
         self.validation_set = build_dataset_tsv(self.validation_set_prefix, self.src, self.trg)
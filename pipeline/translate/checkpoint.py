@@ -0,0 +1,189 @@
+"""
+Checkpoints of a translation chunk, so that a task that was preempted resumes in the middle of
+the file instead of translating the whole chunk again.
+
+The output is written in numbered, compressed segments, and a manifest records the input lines
+that were translated, the output lines that were written, and the offset into the decompressed
+input. Each segment and the manifest are written atomically, so the manifest always describes
+the segments that were finished.
+
+    artifacts/checkpoint
+    ├── translate-checkpoint.json
+    ├── file.1.nbest.00000.zst
+    ├── file.1.nbest.00001.zst
+    └── ...
+
+On resume, the input is read from the offset, and only the remaining lines are translated. The
+output is then the concatenation of the segments, as zstd frames can be concatenated.
+
+On Taskcluster, the checkpoint directory is part of the artifacts, so a retried task downloads
+the checkpoint of the previous run, the same way that the training is continued.
+"""
+
+import io
+import json
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Generator, Iterable, Iterator, Union
+
+from zstandard import ZstdCompressor, ZstdDecompressor
+
+from pipeline.common.downloads import (
+    atomic_write,
+    download_previous_run_checkpoint,
+    get_file_digest,
+)
+from pipeline.common.logging import get_logger
+from pipeline.translate.collect import ChunkStats
+
+logger = get_logger(__file__)
+
+MANIFEST_NAME = "translate-checkpoint.json"
+MANIFEST_VERSION = 1
+
+# The number of input lines of a segment. A preempted task loses at most this many lines.
+SEGMENT_LINES = 100_000
+
+
+class TranslationCheckpoint:
+    """
+    The output of the translation of an input file, which is written to numbered segments. The
+    manifest is only reused for the same input file and output name.
+    """
+
+    def __init__(self, checkpoint_dir: Path, input_zst: Path, output_zst: Path) -> None:
+        self.checkpoint_dir = checkpoint_dir
+        self.output_zst = output_zst
+        self.input_digest = get_file_digest(input_zst)
+        self.segments: list[dict] = []
+
+        # The translations that are not written to a segment yet.
+        self.buffer: list[bytes] = []
+        self.buffer_input_lines = 0
+        self.buffer_output_lines = 0
+        self.buffer_input_bytes = 0
+
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        manifest_path = checkpoint_dir / MANIFEST_NAME
+        if not manifest_path.exists():
+            return
+        with open(manifest_path, "r", encoding="utf-8") as file:
+            manifest = json.load(file)
+        if (
+            manifest.get("version") != MANIFEST_VERSION
+            or manifest["input_digest"] != self.input_digest
+            or manifest["output"] != output_zst.name
+        ):
+            logger.info("The checkpoint is for a different input, starting over")
+            return
+        for segment in manifest["segments"]:
+            if not (checkpoint_dir / segment["name"]).exists():
+                logger.info(f"The checkpoint segment {segment['name']} is missing")
+                break
+            self.segments.append(segment)
+
+        logger.info(
+            f"Resuming from the checkpoint after {self.input_lines:,} lines "
+            f"in {len(self.segments)} segments"
+        )
+
+    @property
+    def input_lines(self) -> int:
+        """The number of input lines that were translated."""
+        return sum(segment["input_lines"] for segment in self.segments)
+
+    @property
+    def output_lines(self) -> int:
+        return sum(segment["output_lines"] for segment in self.segments)
+
+    @property
+    def input_offset(self) -> int:
+        """The offset into the decompressed input of the first line that is not translated."""
+        return sum(segment["input_bytes"] for segment in self.segments)
+
+    def write(
+        self, data: Union[str, bytes], input_lines: int, output_lines: int, input_bytes: int
+    ) -> None:
+        """
+        Write out the translations of the next input_lines, which are input_bytes long in the
+        input, either as text or as the records of the binary n-best format. A segment is
+        written once enough lines are buffered.
+        """
+        self.buffer.append(data.encode("utf-8") if isinstance(data, str) else data)
+        self.buffer_input_lines += input_lines
+        self.buffer_output_lines += output_lines
+        self.buffer_input_bytes += input_bytes
+        if self.buffer_input_lines >= SEGMENT_LINES:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered translations to the next segment, and record it in the manifest."""
+        if not self.buffer_input_lines:
+            return
+        name = f"{self.output_zst.name.removesuffix('.zst')}.{len(self.segments):05d}.zst"
+        atomic_write(
+            self.checkpoint_dir / name,
+            ZstdCompressor().compress(b"".join(self.buffer)),
+        )
+        self.segments.append(
+            {
+                "name": name,
+                "input_lines": self.buffer_input_lines,
+                "output_lines": self.buffer_output_lines,
+                "input_bytes": self.buffer_input_bytes,
+            }
+        )
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "input_digest": self.input_digest,
+            "output": self.output_zst.name,
+            "segments": self.segments,
+        }
+        atomic_write(
+            self.checkpoint_dir / MANIFEST_NAME, json.dumps(manifest, indent=2).encode("utf-8")
+        )
+        logger.info(f"Wrote the checkpoint segment {name} after {self.input_lines:,} lines")
+        self.buffer = []
+        self.buffer_input_lines = 0
+        self.buffer_output_lines = 0
+        self.buffer_input_bytes = 0
+
+    def finish(self) -> None:
+        """
+        Concatenate the segments into the output, record its line counts, and remove the
+        checkpoint.
+        """
+        self.flush()
+        logger.info(f"Writing the {len(self.segments)} segments to {self.output_zst}")
+        with open(self.output_zst, "wb") as outfile:
+            for segment in self.segments:
+                with open(self.checkpoint_dir / segment["name"], "rb") as infile:
+                    shutil.copyfileobj(infile, outfile)
+        ChunkStats(
+            self.output_zst, input_lines=self.input_lines, output_lines=self.output_lines
+        ).save_json()
+        shutil.rmtree(self.checkpoint_dir)
+
+
+@contextmanager
+def read_lines_from_offset(input_zst: Path, offset: int) -> Generator[Iterator[bytes], None, None]:
+    """
+    Read the lines of the compressed input as bytes, starting at an offset into the
+    decompressed input. The lines are not decoded, so that their lengths add up to the offset.
+    """
+    with open(input_zst, "rb") as file, ZstdDecompressor().stream_reader(
+        file, read_across_frames=True
+    ) as reader:
+        # Skipping forward decompresses the skipped part, but nothing is translated again.
+        reader.seek(offset)
+        yield io.BufferedReader(reader)
+
+
+def fetch_previous_checkpoint(checkpoint_dir: Path) -> None:
+    """Download the checkpoint of a previous run when the Taskcluster task is retried."""
+
+    def get_file_names(manifest: dict) -> Iterable[str]:
+        return [segment["name"] for segment in manifest["segments"]]
+
+    download_previous_run_checkpoint(checkpoint_dir, MANIFEST_NAME, get_file_names)
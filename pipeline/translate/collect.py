@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Collects chunked translation data of the form "file.N.out.zst" where N is a number.
+The datasets are chunked earlier in the pipeline by splitter.py so that tasks can work on
+smaller sets of data to better parallelize the work. After processing, any chunked data is
+reassembled with this script.
+
+The zstd format allows multiple frames to be concatenated into a single file, so compressed
+chunks are copied into the output as-is without re-compressing them. Uncompressed chunks
+(e.g. "file.N.nbest.out" from extract-best) are compressed into their own frame.
+
+The line counts of the chunks are verified using the "file.N.out.stats.json" files that
+translate.py writes next to its output. Their total is compared against the line counts that
+the splitter recorded in "file.N.stats.json", which translate.py publishes too. These also
+record the number of chunks, which catches missing final chunks. Without the splitter's
+counts the input lines of the chunks are used instead. Only when the stats are missing are
+the files decompressed and counted, which is done in parallel.
+
+Example usage:
+
+    python pipeline/translate/collect.py     \
+      --chunks_dir fetches                   \
+      --output_path artifacts/mono.en.zst    \
+      --mono_path $MOZ_FETCHES_DIR/mono.ca.zst
+"""
+
+import argparse
+import json
+import multiprocessing
+import re
+import shutil
+from pathlib import Path
+from typing import Optional, Union
+
+from zstandard import ZstdCompressor, ZstdDecompressor
+
+from pipeline.common.datasets import Statistics
+from pipeline.common.logging import get_logger
+from pipeline.translate.splitter import SplitStats
+
+logger = get_logger(__file__)
+
+# Matches "file.1.out", "file.1.out.zst", "file.1.nbest.out", etc.
+CHUNK_PATTERN = re.compile(r"^file\.(\d+)\.(?:.*\.)?out(?:\.zst)?$")
+
+
+class ChunkStats(Statistics):
+    """
+    The line counts of a translated chunk. This is written out by translate.py so that the
+    collect step doesn't need to decompress everything to verify the line counts.
+
+    For instance ChunkStats("artifacts/file.1.out.zst") saves "artifacts/file.1.out.stats.json".
+    """
+
+    def __init__(
+        self,
+        dataset_path: Optional[Union[Path, str]] = None,
+        input_lines: int = 0,
+        output_lines: int = 0,
+    ) -> None:
+        super().__init__(dataset_path)
+        self.input_lines = input_lines
+        self.output_lines = output_lines
+
+    @staticmethod
+    def get_path(chunk_path: Path) -> Path:
+        name = chunk_path.name
+        if name.endswith(".zst"):
+            name = name[: -len(".zst")]
+        return chunk_path.parent / f"{name}.stats.json"
+
+    @staticmethod
+    def load(chunk_path: Path) -> Optional["ChunkStats"]:
+        """Load the stats for a chunk, or return None if they were not recorded."""
+        stats_path = ChunkStats.get_path(chunk_path)
+        if not stats_path.exists():
+            return None
+        with stats_path.open("r", encoding="utf-8") as file:
+            data = json.load(file)
+        return ChunkStats(
+            input_lines=int(data["input_lines"]), output_lines=int(data["output_lines"])
+        )
+
+    def save_json(self) -> Path:
+        # The chunks are named like "file.1.out.zst", so don't rely on the default `stem`
+        # behavior, which would drop different suffixes for compressed and plain files.
+        if not self._dataset_path:
+            raise Exception("A dataset_path is required when saving to JSON.")
+
+        path = ChunkStats.get_path(self._dataset_path)
+        with open(path, "w", encoding="utf-8") as json_file:
+            json.dump(self.as_json(), json_file, indent=2)
+            json_file.write("\n")
+        return path
+
+
+def find_chunks(chunks_dir: Path) -> list[Path]:
+    """
+    Find the chunks, sorted by their number, e.g. "file.1.out.zst", "file.2.out.zst", ...
+    """
+    chunks: dict[int, Path] = {}
+    for path in chunks_dir.iterdir():
+        match = CHUNK_PATTERN.match(path.name)
+        if not match:
+            continue
+        index = int(match.group(1))
+        if index in chunks:
+            raise Exception(f"Chunk {index} was found twice: {chunks[index]} and {path}")
+        chunks[index] = path
+
+    if not chunks:
+        raise Exception(f"No translated chunks were found in {chunks_dir}")
+
+    indexes = sorted(chunks.keys())
+    missing = sorted(set(range(1, indexes[-1] + 1)) - set(indexes))
+    if missing:
+        raise Exception(f"Chunks are missing from {chunks_dir}: {missing}")
+
+    return [chunks[index] for index in indexes]
+
+
+def get_split_path(chunk: Path) -> Path:
+    """The split input of a chunk, e.g. "file.1.zst" for "file.1.out.zst"."""
+    match = CHUNK_PATTERN.match(chunk.name)
+    assert match, f"Not a chunk: {chunk}"
+    return chunk.parent / f"file.{match.group(1)}.zst"
+
+
+def count_lines(path: Union[Path, str]) -> int:
+    """
+    Count the lines in a file like `wc -l`, decompressing .zst files on the fly. Unlike `wc -l`,
+    a final line without a newline is counted too. This is faster than
+    `pipeline.common.downloads.count_lines` as the text is never decoded.
+    """
+    path = Path(path)
+    count = 0
+    last_byte = b"\n"
+    with path.open("rb") as file:
+        if path.suffix == ".zst":
+            chunks = ZstdDecompressor().read_to_iter(file, read_size=2**20, write_size=2**20)
+        else:
+            chunks = iter(lambda: file.read(2**20), b"")
+        for chunk in chunks:
+            if chunk:
+                count += chunk.count(b"\n")
+                last_byte = chunk[-1:]
+    if last_byte != b"\n":
+        count += 1
+    return count
+
+
+def count_lines_parallel(paths: list[Path]) -> list[int]:
+    """Count the lines in several files at once."""
+    with multiprocessing.Pool(processes=min(len(paths), multiprocessing.cpu_count())) as pool:
+        return pool.map(count_lines, paths)
+
+
+def concatenate_chunks(chunks: list[Path], output_path: Path) -> None:
+    """
+    Write the chunks into a single zst file. Compressed chunks are copied as zstd frames,
+    while plain text chunks are compressed into a new frame.
+    """
+    compressor = ZstdCompressor(threads=-1)
+    with output_path.open("wb") as outfile:
+        for chunk in chunks:
+            logger.info(f"Collecting {chunk}")
+            with chunk.open("rb") as infile:
+                if chunk.suffix == ".zst":
+                    shutil.copyfileobj(infile, outfile, length=2**20)
+                else:
+                    compressor.copy_stream(infile, outfile)
+
+
+def collect(chunks_dir: Path, output_path: Path, mono_path: Path) -> None:
+    chunks = find_chunks(chunks_dir)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    logger.info("Collecting translations")
+    concatenate_chunks(chunks, output_path)
+
+    logger.info("Comparing the number of sentences in the source and the translations")
+    chunk_stats = [ChunkStats.load(chunk) for chunk in chunks]
+    split_stats = [SplitStats.load(get_split_path(chunk)) for chunk in chunks]
+    src_len: Optional[int] = None
+    trg_len: Optional[int] = None
+
+    if any(stats and stats.round_robin for stats in split_stats):
+        raise Exception(
+            f"The chunks in {chunks_dir} were split round-robin, so concatenating them would "
+            "not preserve the order of the source lines"
+        )
+
+    if all(split_stats):
+        logger.info("Using the line counts recorded by the splitter")
+        total_chunks = split_stats[0].total_chunks
+        if total_chunks and len(chunks) != total_chunks:
+            raise Exception(
+                f"The source was split into {total_chunks} chunks, "
+                f"but {len(chunks)} chunks were found in {chunks_dir}"
+            )
+        src_len = sum(stats.lines for stats in split_stats)
+
+    if all(chunk_stats):
+        logger.info("Using the line counts recorded by the translate step")
+        for chunk, stats in zip(chunks, chunk_stats):
+            if stats.input_lines != stats.output_lines:
+                raise Exception(
+                    f"The chunk {chunk} had {stats.input_lines:,} input lines, "
+                    f"but {stats.output_lines:,} output lines"
+                )
+        if src_len is None:
+            # The input lines can't tell if the final chunks are missing, unlike the splitter's
+            # counts, but this avoids reading the whole source.
+            src_len = sum(stats.input_lines for stats in chunk_stats)
+        trg_len = sum(stats.output_lines for stats in chunk_stats)
+
+    if src_len is None or trg_len is None:
+        logger.info("Line counts were not recorded, counting the lines")
+        counts = count_lines_parallel(
+            ([mono_path] if src_len is None else []) + (chunks if trg_len is None else [])
+        )
+        if src_len is None:
+            src_len = counts.pop(0)
+        if trg_len is None:
+            trg_len = sum(counts)
+
+    if src_len != trg_len:
+        raise Exception(
+            f"The length of {mono_path} ({src_len:,}) is different from "
+            f"{output_path} ({trg_len:,}) collected from {len(chunks)} chunks"
+        )
+
+    logger.info(f"Collected {trg_len:,} lines into {output_path}")
+
+
+def main(args: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        # Preserves whitespace in the help text.
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "--chunks_dir",
+        type=Path,
+        required=True,
+        help='The directory with the chunks of the form "fetches/file.N.out.zst"',
+    )
+    parser.add_argument(
+        "--output_path",
+        type=Path,
+        required=True,
+        help='The path to the output compressed file, e.g. "artifacts/mono.en.zst"',
+    )
+    parser.add_argument(
+        "--mono_path",
+        type=Path,
+        required=True,
+        help='The path to the data to compare against, e.g. "$MOZ_FETCHES_DIR/mono.hu.zst"',
+    )
+
+    parsed_args = parser.parse_args(args)
+
+    collect(
+        chunks_dir=parsed_args.chunks_dir,
+        output_path=parsed_args.output_path,
+        mono_path=parsed_args.mono_path,
+    )
+
+
+if __name__ == "__main__":
+    main()
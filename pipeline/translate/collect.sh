@@ -11,10 +11,8 @@
 #   translate-mono-src-en-ca-1/10
 #   translate-mono-trg-en-ca-1/10
 #
-# Kinds:
-#   taskcluster/ci/collect-mono-trg/kind.yml
-#   taskcluster/ci/collect-mono-src/kind.yml
-#   taskcluster/ci/collect-corpus/kind.yml
+# This script is used by Snakemake. Taskcluster uses pipeline/translate/collect.py, which
+# avoids re-compressing the chunks and re-counting the lines.
 #
 # Example usage:
 #
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Convert a teacher model to CTranslate2 once, so that the translate chunk tasks can fetch the
+conversion instead of each converting the same model.
+
+The conversion is archived as "ctranslate2-model.tar.zst", which contains the directory that
+translate_ctranslate2.convert_model looks up in its model cache. A chunk task extracts the
+archive and passes the directory as --ctranslate2_model_cache. The cache is keyed by the
+digests of the model and the vocab, the quantization and the CTranslate2 version, so if
+anything differs the chunk task still converts the model itself.
+
+When the teacher decoder is Marian an empty archive is written, so that the fetches of the
+chunk tasks still resolve.
+
+Example usage:
+
+    python pipeline/translate/convert_model.py      \
+      --models_glob "$MOZ_FETCHES_DIR/*.npz"        \
+      --vocab       "$MOZ_FETCHES_DIR/vocab.spm"    \
+      --artifacts   "$TASK_WORKDIR/artifacts"       \
+      --decoder     ctranslate2                     \
+      -- --beam-size 8
+"""
+
+import argparse
+import tarfile
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+from zstandard import ZstdCompressor
+
+from pipeline.common.logging import get_logger
+from pipeline.translate.translate_ctranslate2 import DecoderConfig, convert_model, get_model
+
+logger = get_logger(__file__)
+
+ARCHIVE_NAME = "ctranslate2-model.tar.zst"
+
+
+def write_archive(archive_path: Path, model_dir: Optional[Path]) -> None:
+    """Archive the converted model directory, or write an empty archive without one."""
+    with open(archive_path, "wb") as file, ZstdCompressor(threads=-1).stream_writer(
+        file
+    ) as compressor, tarfile.open(fileobj=compressor, mode="w|") as tar:
+        if model_dir:
+            tar.add(model_dir, arcname=model_dir.name)
+
+
+def main(args_list: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        # Preserves whitespace in the help text.
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "--models_glob",
+        type=str,
+        nargs="+",
+        required=True,
+        help="A glob pattern to the Marian model",
+    )
+    parser.add_argument("--vocab", type=Path, required=True, help="Path to vocab file")
+    parser.add_argument(
+        "--artifacts", type=Path, required=True, help="The directory for the archive"
+    )
+    parser.add_argument(
+        "--decoder",
+        type=str,
+        choices=["marian", "ctranslate2"],
+        default="ctranslate2",
+        help="The teacher decoder. Only CTranslate2 needs a converted model.",
+    )
+    parser.add_argument(
+        "extra_marian_args",
+        nargs=argparse.REMAINDER,
+        help="The Marian decoder args of the translate tasks, which set the precision",
+    )
+    args = parser.parse_args(args_list)
+
+    extra_marian_args: list[str] = args.extra_marian_args
+    if extra_marian_args and extra_marian_args[0] != "--":
+        logger.error(" ".join(extra_marian_args))
+        raise Exception("Expected the extra marian args to be after a --")
+
+    args.artifacts.mkdir(parents=True, exist_ok=True)
+    archive_path = args.artifacts / ARCHIVE_NAME
+
+    if args.decoder != "ctranslate2":
+        logger.info(f"The {args.decoder} decoder doesn't use a converted model")
+        write_archive(archive_path, None)
+        return
+
+    model = get_model(args.models_glob)
+    # The translate tasks pass the vocab once, which is used for both languages.
+    vocab = [str(args.vocab)]
+    precision = DecoderConfig(extra_marian_args[1:]).precision
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        model_dir = convert_model(model, vocab, precision, Path(cache_dir))
+        logger.info(f"Archiving the converted model to {archive_path}")
+        write_archive(archive_path, model_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,141 +1,247 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+"""
+Select the best translation of each sentence from the n-best translations, by scoring every
+hypothesis against the reference.
 
-from __future__ import absolute_import, division, print_function
+The hypotheses are streamed in chunks of sentences to a pool of worker processes, and the
+selections are written out in order. The n-grams of a reference are extracted once per
+sentence rather than once per hypothesis. The inputs and the output can be zstd compressed.
+"""
 
 import argparse
 import collections
+import io
 import math
+import os
 import re
 import sys
+from contextlib import contextmanager
+from itertools import islice
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Generator, Iterable, Iterator, Optional, TextIO
+
+from zstandard import ZstdCompressor
+
+from pipeline.common.logging import get_logger
+from pipeline.translate.nbest import (
+    is_binary_nbest,
+    open_decompressed,
+    parse_text_nbest,
+    read_nbest,
+)
+
+logger = get_logger(__file__)
+
+# The number of sentences that are sent to a worker process at a time.
+CHUNK_SENTENCES = 1_000
+
+# The number of chunks that are queued per worker, which bounds the memory of the read ahead.
+PENDING_CHUNKS_PER_WORKER = 4
+
+LOG_SENTENCES = 100_000
+
+# A sentence's references and the texts of its hypotheses.
+Sentence = tuple[list[str], list[str]]
 
 
 def main():
     args = parse_args()
 
-    if args.metric == "bleu":
-        score_function = compute_bleu
-    elif args.metric == "sacrebleu":
-        global sacrebleu
-        import sacrebleu
+    with open_text(args.references, "r") as references, open_text(
+        args.output, "w"
+    ) as output, read_hypotheses(args.nbest, args.toolkit) as hypotheses:
+        chunks = iter_chunks(pair_with_references(references, hypotheses))
+        for i, (best_txt, scores) in enumerate(
+            (selection for chunk in select_best_in_pool(chunks, args) for selection in chunk)
+        ):
+            output.write("{}\n".format(best_txt))
+            if args.debug:
+                sys.stderr.write("{}: {}\n".format(i, scores))
+            if i % LOG_SENTENCES == 0 and i > 0:
+                logger.info(f"Selected the best translations of {i:,} sentences")
+
+
+@contextmanager
+def open_text(path: str, mode: str) -> Generator[TextIO, None, None]:
+    """
+    Open a text file, or stdin and stdout for "-". A .zst output is compressed, and a compressed
+    input is detected by its magic bytes. The extract-best task only installs sacrebleu, so this
+    doesn't use pipeline.common.downloads.
+    """
+    if path == "-":
+        yield sys.stdin if mode == "r" else sys.stdout
+    elif mode == "r":
+        with open_decompressed(Path(path)) as stream:
+            yield io.TextIOWrapper(stream, encoding="utf-8")
+    elif path.endswith(".zst"):
+        with open(path, "wb") as file, ZstdCompressor(threads=-1).stream_writer(
+            file
+        ) as compressor:
+            text = io.TextIOWrapper(compressor, encoding="utf-8")
+            yield text
+            text.flush()
+    else:
+        with open(path, "w", encoding="utf-8") as file:
+            yield file
+
+
+@contextmanager
+def read_hypotheses(path: str, toolkit: str) -> Generator[Iterator[list[str]], None, None]:
+    """
+    Read the texts of the hypotheses of each sentence. The binary n-best format is grouped by
+    sentence, so it doesn't depend on the toolkit. Otherwise the text is either Marian's lines
+    of "0 ||| hypothesis ||| scores", or T2T's tab separated hypotheses.
+    """
+    if path != "-" and is_binary_nbest(Path(path)):
+        with read_nbest(Path(path)) as sentences:
+            yield ([text for text, _score in hypotheses] for hypotheses in sentences)
+        return
+
+    with open_text(path, "r") as lines:
+        if toolkit == "marian":
+            yield ([text for text, _score in hypotheses] for hypotheses in parse_text_nbest(lines))
+        elif toolkit == "t2t":
+            yield (line.strip().split("\t") for line in lines)
+        else:
+            raise ValueError(f"Unrecognized toolkit: {toolkit}")
+
 
-        score_function = compute_sacrebleu
-    elif args.metric == "chrf":
-        global sacrebleu
-        import sacrebleu
+def pair_with_references(
+    references: Iterable[str], hypotheses: Iterator[list[str]]
+) -> Iterator[Sentence]:
+    for ref_line in references:
+        texts = next(hypotheses, None)
+        if texts is None:
+            raise ValueError("The n-best has fewer sentences than the references")
+        yield [ref_line.strip()], texts
+    if next(hypotheses, None) is not None:
+        raise ValueError("The n-best has more sentences than the references")
 
-        score_function = compute_chrf
-    else:
-        sys.stderr.write("Unrecognized metric: {}\n".format(args.metric))
-        pass
 
-    if args.toolkit == "marian":
-        marian_best_bleu(args, score_function)
-    elif args.toolkit == "t2t":
-        t2t_best_bleu(args, score_function)
-        pass
+def iter_chunks(sentences: Iterator[Sentence]) -> Iterator[list[Sentence]]:
+    return iter(lambda: list(islice(sentences, CHUNK_SENTENCES)), [])
+
+
+class BleuScorer:
+    """The BLEU of the hypotheses, with the reference n-grams counted once for all of them."""
+
+    def score(self, refs: list[str], texts: list[str]) -> list[float]:
+        reference = BleuReference([r.split() for r in refs])
+        return [reference.compute_bleu(t.split()) for t in texts]
+
+
+class SacrebleuScorer:
+    """
+    The sentence BLEU or chrF of the hypotheses through sacrebleu's statistics.
+
+    sacrebleu.sentence_bleu and sacrebleu.sentence_chrf construct the metric and extract the
+    reference n-grams for every hypothesis. Instead the metric is constructed once, and the
+    reference n-grams are cached once per sentence, which gives the same scores.
+    """
+
+    def __init__(self, metric: str) -> None:
+        # Only load sacrebleu when it's needed.
+        from sacrebleu.metrics import BLEU, CHRF
 
+        # These are the defaults of sacrebleu.sentence_bleu and sacrebleu.sentence_chrf.
+        self.metric = BLEU(effective_order=True) if metric == "sacrebleu" else CHRF()
 
-def t2t_best_bleu(args, score_function):
-    for i, ref_line in enumerate(args.references):
-        refs = ref_line.strip().split("\n")
-        if args.debpe:
+    def score(self, refs: list[str], texts: list[str]) -> list[float]:
+        (ref_kwargs,) = self.metric._cache_references([[" ".join(r.split())] for r in refs])
+        scores = []
+        for text in texts:
+            hypothesis = self.metric._preprocess_segment(" ".join(text.split()))
+            stats = self.metric._compute_segment_statistics(hypothesis, ref_kwargs)
+            scores.append(self.metric._aggregate_and_compute([stats]).score)
+        return scores
+
+
+class BestSelector:
+    def __init__(self, metric: str, debpe: bool) -> None:
+        if metric == "bleu":
+            self.scorer = BleuScorer()
+        elif metric in ("sacrebleu", "chrf"):
+            self.scorer = SacrebleuScorer(metric)
+        else:
+            raise ValueError(f"Unrecognized metric: {metric}")
+        self.debpe = debpe
+
+    def select(self, chunk: list[Sentence]) -> list[tuple[str, list[float]]]:
+        """Select the best text of each sentence, and return it with the scores."""
+        return [self.select_sentence(refs, texts) for refs, texts in chunk]
+
+    def select_sentence(self, refs: list[str], texts: list[str]) -> tuple[str, list[float]]:
+        if self.debpe:
             refs = [re.sub(r"@@ +", "", r) for r in refs]
-            pass
-        texts = next(args.nbest).strip().split("\t")
-        if args.debpe:
             texts = [re.sub(r"@@ +", "", t) for t in texts]
-            pass
-        refs = [r.split() for r in refs]
-        scores = [score_function(refs, t.split()) for t in texts]
-        best_txt = texts[scores.index(max(scores))]
-
-        args.output.write("{}\n".format(best_txt))
-        if args.debug:
-            sys.stderr.write("{}: {}\n".format(i, scores))
-            pass
-        if i % 100000 == 0 and i > 0:
-            sys.stderr.write("[{}]\n".format(i))
-            pass
-        pass
-
-
-def marian_best_bleu(args, score_function):
-    prev_line = None
-    for i, ref_line in enumerate(args.references):
-        refs = ref_line.strip().split("\n")
-        if args.debpe:
-            refs = [re.sub(r"@@ +", "", r) for r in refs]
+        scores = self.scorer.score(refs, texts)
+        return texts[scores.index(max(scores))], scores
 
-        texts = []
-        while True:
-            if prev_line:
-                # CTranslate2 can output empty text, for example:
-                # 10181 ||| .GDFMAKERPROJECTファイルを開くには?
-                # 10181 ||| .GDMAKERPROJECTファイルを開くには?
-                # 10181 ||| .GDFMAKERPROJECTファイルを開くには?
-                # 10181 ||| .GDFMakerPROJECTファイルを開くには?
-                # 10181 ||| .GDFAKERPROJECTファイルを開くには?
-                # 10181 ||| .GDMakerPROJECTファイルを開くには?
-                # 10181 ||| .GDFMAKERPROJECTファイルを開くには。
-                # 10181 |||
-                # Marian also outputs scores, for example:
-                # 0 ||| Реформа, направленная на выдвижение условий, идет слишком медленно. ||| F0= -9.21191 F1= -11.53 ||| -1.22059
-                fields = prev_line.rstrip("\n").split(" ||| ")
-                if len(fields) == 1:
-                    # handle "10181 |||"
-                    fields = fields[0].split()[0], ""
-
-                idx = int(fields[0])
-                if idx == i:
-                    texts.append(fields[1])
-                else:
-                    break
-
-            prev_line = next(args.nbest, None)
-            if not prev_line:
-                break
-
-        if args.debpe:
-            texts = [re.sub(r"@@ +", "", t) for t in texts]
-        refs = [r.split() for r in refs]
-        scores = [score_function(refs, t.split()) for t in texts]
-        best_txt = texts[scores.index(max(scores))]
 
-        args.output.write("{}\n".format(best_txt))
-        if args.debug:
-            sys.stderr.write("{}: {}\n".format(i, scores))
+# The selector of a worker process.
+_selector: Optional[BestSelector] = None
 
-        if i % 100000 == 0 and i > 0:
-            sys.stderr.write("[{}]\n".format(i))
 
+def init_worker(metric: str, debpe: bool) -> None:
+    global _selector
+    _selector = BestSelector(metric, debpe)
 
-def compute_chrf(references, translation):
-    hypo = " ".join(translation)
-    refs = [" ".join(r) for r in references]
-    return sacrebleu.sentence_chrf(hypo, refs).score
 
+def select_in_worker(chunk: list[Sentence]) -> list[tuple[str, list[float]]]:
+    return _selector.select(chunk)
 
-def compute_sacrebleu(references, translation):
-    hypo = " ".join(translation)
-    refs = [" ".join(r) for r in references]
-    return sacrebleu.sentence_bleu(hypo, refs).score
 
+def select_best_in_pool(
+    chunks: Iterator[list[Sentence]], args: argparse.Namespace
+) -> Iterator[list[tuple[str, list[float]]]]:
+    """
+    Select the best texts of the chunks in the worker processes, and yield them in order. Only
+    a few chunks per worker are queued at a time, as Pool.imap would read the whole input ahead.
+    """
+    if args.workers <= 1:
+        selector = BestSelector(args.metric, args.debpe)
+        yield from map(selector.select, chunks)
+        return
 
-def compute_bleu(references, translation, max_order=4):
-    precisions = get_ngram_precisions(references, translation, max_order)
-    if min(precisions) > 0:
-        p_log_sum = sum((1.0 / max_order) * math.log(p) for p in precisions)
-        geo_mean = math.exp(p_log_sum)
-    else:
-        geo_mean = 0
+    with Pool(args.workers, initializer=init_worker, initargs=(args.metric, args.debpe)) as pool:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(select_in_worker, (chunk,)))
+            if len(pending) >= args.workers * PENDING_CHUNKS_PER_WORKER:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
 
-    bp = get_brevity_penalty(references, translation)
-    return geo_mean * bp
 
+class BleuReference:
+    """The n-gram counts and the length of the references of a sentence."""
 
-def get_brevity_penalty(references, translation):
-    reference_length = min(len(r) for r in references)
+    def __init__(self, references, max_order=4):
+        self.max_order = max_order
+        self.min_length = min(len(r) for r in references)
+        self.ngram_counts = collections.Counter()
+        for reference in references:
+            self.ngram_counts |= get_ngrams(reference, max_order)
+
+    def compute_bleu(self, translation):
+        precisions = get_ngram_precisions(self.ngram_counts, translation, self.max_order)
+        if min(precisions) > 0:
+            p_log_sum = sum((1.0 / self.max_order) * math.log(p) for p in precisions)
+            geo_mean = math.exp(p_log_sum)
+        else:
+            geo_mean = 0
+
+        bp = get_brevity_penalty(self.min_length, translation)
+        return geo_mean * bp
+
+
+def compute_bleu(references, translation, max_order=4):
+    return BleuReference(references, max_order).compute_bleu(translation)
+
+
+def get_brevity_penalty(reference_length, translation):
     translation_length = len(translation)
     ratio = float(translation_length) / reference_length
     if ratio > 1.0 or ratio == 0.0:
@@ -145,13 +251,10 @@ def get_brevity_penalty(references, translation):
     return bp
 
 
-def get_ngram_precisions(references, translation, max_order=4):
+def get_ngram_precisions(merged_ref_ngram_counts, translation, max_order=4):
     matches_by_order = [0] * max_order
     possible_matches_by_order = [0] * max_order
 
-    merged_ref_ngram_counts = collections.Counter()
-    for reference in references:
-        merged_ref_ngram_counts |= get_ngrams(reference, max_order)
     translation_ngram_counts = get_ngrams(translation, max_order)
     overlap = translation_ngram_counts & merged_ref_ngram_counts
     for ngram in overlap:
@@ -181,16 +284,41 @@ def get_ngrams(segment, max_order):
 
 
 def parse_args():
-    from argparse import FileType
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--nbest", type=FileType("r"), default=sys.stdin)
-    parser.add_argument("-r", "--references", type=FileType("r"), required=True)
-    parser.add_argument("-o", "--output", type=FileType("w"), default=sys.stdout)
-    parser.add_argument("-m", "--metric", default="bleu")
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        # Preserves whitespace in the help text.
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "-i",
+        "--nbest",
+        default="-",
+        help="Either the text n-best, or the binary format of pipeline/translate/nbest.py, and "
+        "optionally zstd compressed. Defaults to stdin for the text.",
+    )
+    parser.add_argument(
+        "-r",
+        "--references",
+        required=True,
+        help="The references, optionally zstd compressed.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="-",
+        help="The best translations, which are compressed for a .zst path. Defaults to stdout.",
+    )
+    parser.add_argument("-m", "--metric", default="bleu", help="bleu, sacrebleu or chrf")
     parser.add_argument("--debpe", action="store_true")
     parser.add_argument("-d", "--debug", action="store_true")
     parser.add_argument("-t", "--toolkit", default="marian", help="Toolkit: 'marian' or 't2t'")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="The number of worker processes that score the hypotheses. Defaults to the CPUs.",
+    )
     return parser.parse_args()
 
 
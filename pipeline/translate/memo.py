@@ -0,0 +1,185 @@
+"""
+A translation memo, so that every unique source sentence is only translated once.
+
+Mono and corpus data still contain many exact repeats, such as short sentences, boilerplate and
+titles. With the memo, the repeated lines and the lines that were already translated by a
+previous run are removed from the input before it is translated, and the translations are
+expanded back to the original order and number of lines afterwards.
+
+The translations are stored in a SQLite database, keyed by a hash of the source sentence and
+a key of the model and the decoding settings, so the same store can be reused by reruns of a
+chunk and by later runs of the pipeline.
+"""
+
+import hashlib
+import json
+import sqlite3
+from itertools import islice
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+from pipeline.common.downloads import get_file_digest, read_lines, write_lines
+from pipeline.common.logging import get_logger
+
+logger = get_logger(__file__)
+
+# The number of lines that are deduplicated or expanded at once.
+BATCH_LINES = 10_000
+
+# The number of keys that are looked up in one statement, which stays below SQLite's limit on
+# the number of parameters of older versions.
+LOOKUP_KEYS = 500
+
+NBEST_SEPARATOR = " ||| "
+
+
+def get_source_key(line: str) -> bytes:
+    """The stable hash of a source sentence, which is stored in the memo."""
+    return hashlib.blake2b(line.rstrip("\n").encode("utf-8"), digest_size=16).digest()
+
+
+def get_model_key(
+    models: list[Path],
+    vocab: Path,
+    decoder: str,
+    device: str,
+    is_nbest: bool,
+    decoder_config: dict[str, Any],
+    compute_type: Optional[str] = None,
+) -> str:
+    """
+    The translations are only reused with the same model files, vocab and decoding settings.
+    The decoder_config is the decoder.yml combined with the extra Marian args, and the
+    compute_type is the one that CTranslate2 translates with.
+    """
+    key = hashlib.sha256()
+    for path in [*models, vocab]:
+        key.update(get_file_digest(path).encode("utf-8"))
+    settings = {
+        "decoder": decoder,
+        "device": device,
+        "is_nbest": is_nbest,
+        "decoder_config": decoder_config,
+        "compute_type": compute_type,
+    }
+    key.update(json.dumps(settings, sort_keys=True, default=str).encode("utf-8"))
+    return key.hexdigest()
+
+
+class TranslationMemo:
+    """
+    The translations are stored with their n-best hypotheses. For n-best output, a hypothesis is
+    the whole line after the sentence index, e.g. "hypothesis ||| F0= -1.5 ||| -0.25".
+    """
+
+    def __init__(self, store_path: Path, model_key: str) -> None:
+        store_path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(store_path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS translations "
+            "(model TEXT, source BLOB, hypotheses TEXT, PRIMARY KEY (model, source)) "
+            "WITHOUT ROWID"
+        )
+        self.model_key = model_key
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def lookup(self, keys: list[bytes]) -> dict[bytes, list[str]]:
+        found = {}
+        for start in range(0, len(keys), LOOKUP_KEYS):
+            batch = keys[start : start + LOOKUP_KEYS]
+            rows = self.connection.execute(
+                "SELECT source, hypotheses FROM translations WHERE model = ? AND source IN "
+                f"({', '.join('?' * len(batch))})",
+                [self.model_key, *batch],
+            )
+            for source, hypotheses in rows:
+                found[source] = hypotheses.split("\n")
+        return found
+
+    def store(self, translations: Iterable[tuple[bytes, list[str]]]) -> None:
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO translations VALUES (?, ?, ?)",
+                ((self.model_key, key, "\n".join(hypotheses)) for key, hypotheses in translations),
+            )
+
+    def write_unique(self, input_path: Path, unique_path: Path) -> tuple[int, list[bytes]]:
+        """
+        Write out the lines that are not in the memo, without repeats. Returns the number of
+        input lines, and the keys of the unique lines in the order they were written.
+        """
+        input_lines = 0
+        seen: set[bytes] = set()
+        unique_keys: list[bytes] = []
+        with read_lines(input_path) as lines, write_lines(unique_path) as unique:
+            for batch in iter(lambda: list(islice(lines, BATCH_LINES)), []):
+                input_lines += len(batch)
+                keys = [get_source_key(line) for line in batch]
+                new_keys = list({key for key in keys if key not in seen})
+                seen.update(self.lookup(new_keys))
+                for key, line in zip(keys, batch):
+                    if key not in seen:
+                        seen.add(key)
+                        unique_keys.append(key)
+                        unique.write(line)
+
+        logger.info(
+            f"{len(unique_keys):,} of the {input_lines:,} lines need to be translated, "
+            f"the rest are repeats or were translated before"
+        )
+        return input_lines, unique_keys
+
+    def store_translations(
+        self, unique_keys: list[bytes], output_path: Path, is_nbest: bool
+    ) -> None:
+        """Store the translations of the unique lines."""
+        with read_lines(output_path) as lines:
+            if not is_nbest:
+                translations = zip(unique_keys, ([line.rstrip("\n")] for line in lines))
+            else:
+                translations = zip(unique_keys, group_nbest(lines))
+            self.store(translations)
+
+    def expand(self, input_path: Path, output_path: Path, is_nbest: bool) -> int:
+        """
+        Write out the translations of every input line in the original order. Returns the
+        number of output lines.
+        """
+        output_lines = 0
+        index = 0
+        with read_lines(input_path) as lines, write_lines(output_path) as output:
+            for batch in iter(lambda: list(islice(lines, BATCH_LINES)), []):
+                keys = [get_source_key(line) for line in batch]
+                found = self.lookup(list(set(keys)))
+                for key in keys:
+                    hypotheses = found.get(key)
+                    if hypotheses is None:
+                        raise Exception(f"The translation of line {index} is missing")
+                    for hypothesis in hypotheses:
+                        if is_nbest:
+                            output.write(f"{index}{NBEST_SEPARATOR}{hypothesis}\n")
+                        else:
+                            output.write(f"{hypothesis}\n")
+                    output_lines += len(hypotheses)
+                    index += 1
+        return output_lines
+
+
+def group_nbest(lines: Iterable[str]) -> Iterable[list[str]]:
+    """
+    Group the n-best lines of the form "0 ||| hypothesis ||| scores" by the sentence index, and
+    strip off the index.
+    """
+    group: list[str] = []
+    group_index: Optional[str] = None
+    for line in lines:
+        index, hypothesis = line.rstrip("\n").split(NBEST_SEPARATOR, 1)
+        if index != group_index and group_index is not None:
+            yield group
+            group = []
+        group_index = index
+        group.append(hypothesis)
+    if group_index is not None:
+        yield group
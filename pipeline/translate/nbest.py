@@ -0,0 +1,237 @@
+"""
+A compact binary format for the n-best translations, which extract_best.py reads directly
+instead of splitting Marian's text lines and reconciling the sentence indexes.
+
+The decompressed stream is a sequence of length-prefixed records, one per source sentence,
+which hold the hypotheses in order:
+
+    record:     <u32 payload length> <u16 hypothesis count> hypothesis...
+    hypothesis: <u32 text length> <utf-8 text> <f32 score>
+
+The numbers are little-endian. Every block of records starts with the 8 byte header, and is
+compressed as its own zstd frame. A header is allowed before any record, so the outputs of
+chunks or checkpoint segments can be concatenated like any other zstd file. The reader also
+accepts the decompressed stream, which is what the extract-best task fetches.
+
+To convert Marian's text n-best, for instance of a previous run:
+
+    python pipeline/translate/nbest.py --input file.1.nbest.zst --output file.1.nbest.bin.zst
+"""
+
+import argparse
+import io
+import struct
+from contextlib import contextmanager
+from enum import Enum
+from pathlib import Path
+from typing import BinaryIO, Generator, Iterable, Iterator, Optional
+
+from zstandard import ZstdCompressor, ZstdDecompressor
+
+from pipeline.common.logging import get_logger
+
+logger = get_logger(__file__)
+
+# The magic bytes and the version of the format.
+HEADER = b"NBEST\x00\x00\x01"
+
+# The number of sentences that are converted into a compressed frame at a time.
+BLOCK_SENTENCES = 10_000
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+class NbestFormat(Enum):
+    # Marian's text lines, e.g. "0 ||| Translation attempt ||| F0= -9.21191 ||| -1.22059"
+    text = "text"
+    binary = "binary"
+
+
+_count = struct.Struct("<H")
+_length = struct.Struct("<I")
+_score = struct.Struct("<f")
+
+# A hypothesis and its score, which is 0.0 when the decoder didn't output one.
+Hypothesis = tuple[str, float]
+
+
+def encode_records(sentences: Iterable[list[Hypothesis]]) -> bytes:
+    """Encode the hypotheses of the sentences as a block of records, starting with the header."""
+    chunks = [HEADER]
+    for hypotheses in sentences:
+        payload = [_count.pack(len(hypotheses))]
+        for text, score in hypotheses:
+            encoded = text.encode("utf-8")
+            payload.append(_length.pack(len(encoded)))
+            payload.append(encoded)
+            payload.append(_score.pack(score))
+        payload_bytes = b"".join(payload)
+        chunks.append(_length.pack(len(payload_bytes)))
+        chunks.append(payload_bytes)
+    return b"".join(chunks)
+
+
+def decode_record(payload: bytes) -> list[Hypothesis]:
+    (count,) = _count.unpack_from(payload)
+    offset = _count.size
+    hypotheses = []
+    for _ in range(count):
+        (length,) = _length.unpack_from(payload, offset)
+        offset += _length.size
+        text = payload[offset : offset + length].decode("utf-8")
+        offset += length
+        (score,) = _score.unpack_from(payload, offset)
+        offset += _score.size
+        hypotheses.append((text, score))
+    return hypotheses
+
+
+def iter_records(stream: BinaryIO) -> Iterator[list[Hypothesis]]:
+    """Yield the hypotheses of each sentence in a decompressed stream."""
+    while True:
+        prefix = stream.read(_length.size)
+        if not prefix:
+            return
+        # A record would need to be over a gigabyte to start like the header.
+        if prefix == HEADER[: _length.size]:
+            if stream.read(len(HEADER) - _length.size) != HEADER[_length.size :]:
+                raise ValueError("The n-best file has an unsupported version")
+            continue
+        if len(prefix) < _length.size:
+            raise ValueError("The n-best file is truncated")
+        (length,) = _length.unpack(prefix)
+        payload = stream.read(length)
+        if len(payload) < length:
+            raise ValueError("The n-best file is truncated")
+        yield decode_record(payload)
+
+
+@contextmanager
+def open_decompressed(path: Path) -> Generator[BinaryIO, None, None]:
+    """Open a file for reading, and decompress it on the fly when it is a zstd file."""
+    with open(path, "rb") as file:
+        is_zst = file.read(len(ZSTD_MAGIC)) == ZSTD_MAGIC
+        file.seek(0)
+        if not is_zst:
+            yield file
+            return
+        with ZstdDecompressor().stream_reader(file, read_across_frames=True) as reader:
+            yield io.BufferedReader(reader)
+
+
+def is_binary_nbest(path: Path) -> bool:
+    """Whether the file, either compressed or not, is in the binary n-best format."""
+    with open_decompressed(path) as stream:
+        return stream.read(len(HEADER)) == HEADER
+
+
+@contextmanager
+def read_nbest(path: Path) -> Generator[Iterator[list[Hypothesis]], None, None]:
+    """Read the hypotheses of each sentence of a binary n-best file, either compressed or not."""
+    with open_decompressed(path) as stream:
+        yield iter_records(stream)
+
+
+class NbestWriter:
+    """Write the blocks of records to a compressed file, with each block as a zstd frame."""
+
+    def __init__(self, path: Path, zstd_threads: int = 0) -> None:
+        self.path = path
+        self.compressor = ZstdCompressor(threads=zstd_threads)
+        self.file: Optional[BinaryIO] = None
+
+    def __enter__(self) -> "NbestWriter":
+        self.file = open(self.path, "wb")
+        return self
+
+    def __exit__(self, *_exc) -> None:
+        self.file.close()
+
+    def write(self, block: bytes) -> None:
+        """Write a block from encode_records."""
+        self.file.write(self.compressor.compress(block))
+
+
+def parse_text_nbest(lines: Iterable[str]) -> Iterator[list[Hypothesis]]:
+    """
+    Group Marian's text n-best lines by the sentence index, and parse the scores. For example:
+
+    0 ||| Translation attempt ||| F0= -9.21191 F1= -11.53 ||| -1.22059
+    0 ||| An attempt at translation ||| F0= -10.1025 F1= -11.1262 ||| -1.24908
+    1 |||
+
+    Only the total score is kept. CTranslate2's text output has no scores, and an empty
+    hypothesis can lose the separator's trailing space.
+    """
+    hypotheses: list[Hypothesis] = []
+    group_index: Optional[str] = None
+    for line in lines:
+        fields = line.rstrip("\n").split(" ||| ")
+        if len(fields) == 1:
+            # Handle "10181 |||"
+            fields = [fields[0].split()[0], ""]
+        index = fields[0]
+        if index != group_index and group_index is not None:
+            yield hypotheses
+            hypotheses = []
+        group_index = index
+        score = float(fields[3]) if len(fields) >= 4 else 0.0
+        hypotheses.append((fields[1], score))
+    if group_index is not None:
+        yield hypotheses
+
+
+def iter_blocks(sentences: Iterable[list[Hypothesis]]) -> Iterator[tuple[int, int, bytes]]:
+    """
+    Encode the sentences in blocks of records, yielding the number of sentences and hypotheses
+    of each block along with it.
+    """
+    sentences = iter(sentences)
+    while True:
+        block: list[list[Hypothesis]] = []
+        for hypotheses in sentences:
+            block.append(hypotheses)
+            if len(block) == BLOCK_SENTENCES:
+                break
+        if not block:
+            return
+        yield len(block), sum(len(hypotheses) for hypotheses in block), encode_records(block)
+
+
+def convert_text_nbest(input_path: Path, output_path: Path) -> tuple[int, int]:
+    """
+    Convert Marian's text n-best into the binary format, and return the numbers of sentences and
+    hypotheses. The output path can be the same as the input.
+    """
+    sentences = 0
+    hypotheses = 0
+    tmp_path = output_path.with_name(f"{output_path.name}.tmp")
+    with open_decompressed(input_path) as stream, NbestWriter(tmp_path, zstd_threads=-1) as writer:
+        lines = io.TextIOWrapper(stream, encoding="utf-8")
+        for block_sentences, block_hypotheses, block in iter_blocks(parse_text_nbest(lines)):
+            writer.write(block)
+            sentences += block_sentences
+            hypotheses += block_hypotheses
+    tmp_path.replace(output_path)
+    logger.info(f"Converted {sentences:,} sentences with {hypotheses:,} hypotheses")
+    return sentences, hypotheses
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        # Preserves whitespace in the help text.
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "--input", type=Path, required=True, help="Marian's text n-best, optionally compressed."
+    )
+    parser.add_argument(
+        "--output", type=Path, required=True, help="The compressed binary n-best to write."
+    )
+    args = parser.parse_args()
+    convert_text_nbest(args.input, args.output)
+
+
+if __name__ == "__main__":
+    main()
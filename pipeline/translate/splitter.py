@@ -2,26 +2,191 @@
 """
 Splits a dataset to chunks. Generates files in format file.00.zst, file.01.zst etc.
 
+A parallel corpus can be split in a single pass by providing the target side with --ref_path
+and optionally the alignments with --aln_path. The chunk boundaries are chosen from the main
+file, and all of the files are split on the same lines.
+
+The number of lines of every chunk is saved next to it, e.g. "file.1.stats.json" for
+"file.1.zst", so that translate.py can report an ETA without reading the chunk twice.
+
 Example:
     python splitter.py \
         --output_dir=test_data \
         --num_parts=10 \
         --output_suffix=.ref \
         test_data/corpus.en.zst
+
+    python splitter.py \
+        --output_dir=test_data \
+        --num_parts=10 \
+        --budget=bytes \
+        --ref_path=test_data/corpus.ru.zst \
+        test_data/corpus.en.zst
 """
 
 import argparse
+import json
 import os
+from pathlib import Path
 from contextlib import ExitStack
-from typing import Optional
+from enum import Enum
+from itertools import zip_longest
+from typing import Callable, Iterable, Iterator, Optional, TextIO, Union
 
-from pipeline.common.downloads import count_lines, read_lines, write_lines
+from zstandard import ZstdDecompressor
+
+from pipeline.common.datasets import Statistics
+from pipeline.common.downloads import read_lines, write_lines
 from pipeline.common.logging import get_logger
 
 logger = get_logger(__file__)
 
 
-def split_file(mono_path: str, output_dir: str, num_parts: int, output_suffix: str = ""):
+class Budget(Enum):
+    """How the work in a chunk is measured when choosing the chunk boundaries."""
+
+    # Every chunk gets the same number of lines.
+    lines = "lines"
+    # Every chunk gets the same number of (uncompressed) bytes.
+    bytes = "bytes"
+    # Every chunk gets the same number of whitespace separated tokens.
+    tokens = "tokens"
+
+
+# How much of a file is read from the disk to estimate its total budget.
+SAMPLE_BYTES = 64 * 2**20
+
+
+class SplitStats(Statistics):
+    """
+    The number of lines of a chunk that the splitter wrote, and how many chunks there are in
+    total, which lets the collect step verify the line counts without reading the source. The
+    collect step can't reassemble chunks that were split round-robin, so this is recorded too.
+
+    For instance SplitStats("artifacts/file.1.zst") saves "artifacts/file.1.stats.json".
+    """
+
+    def __init__(
+        self,
+        dataset_path: Optional[Union[Path, str]] = None,
+        lines: int = 0,
+        total_chunks: int = 0,
+        round_robin: bool = False,
+    ) -> None:
+        super().__init__(dataset_path)
+        self.lines = lines
+        self.total_chunks = total_chunks
+        self.round_robin = round_robin
+
+    @staticmethod
+    def get_path(chunk_path: Path) -> Path:
+        return chunk_path.parent / f"{chunk_path.stem}.stats.json"
+
+    @staticmethod
+    def load(chunk_path: Path) -> Optional["SplitStats"]:
+        """Load the stats for a chunk, or return None if they were not recorded."""
+        stats_path = SplitStats.get_path(chunk_path)
+        if not stats_path.exists():
+            return None
+        with stats_path.open("r", encoding="utf-8") as file:
+            data = json.load(file)
+        # Older splits only recorded the lines.
+        return SplitStats(
+            lines=int(data["lines"]),
+            total_chunks=int(data.get("total_chunks", 0)),
+            round_robin=bool(data.get("round_robin", False)),
+        )
+
+    @staticmethod
+    def load_lines(chunk_path: Path) -> Optional[int]:
+        """The number of lines of a chunk, or None if they were not recorded."""
+        stats = SplitStats.load(chunk_path)
+        return stats.lines if stats else None
+
+
+def get_line_cost(budget: Budget) -> Callable[[str], int]:
+    if budget == Budget.lines:
+        return lambda _line: 1
+    if budget == Budget.bytes:
+        return lambda line: len(line.encode("utf-8"))
+    if budget == Budget.tokens:
+        return lambda line: len(line.split())
+    raise ValueError(f"Unknown budget: {budget}")
+
+
+def _measure_bytes(chunks: Iterable[bytes], budget: Budget) -> int:
+    """
+    Measure decompressed bytes according to the budget. Lines and bytes are counted on the raw
+    bytes, which is much faster than decoding the text.
+    """
+    total = 0
+    for chunk in chunks:
+        if budget == Budget.lines:
+            total += chunk.count(b"\n")
+        elif budget == Budget.bytes:
+            total += len(chunk)
+        else:
+            # A token can be cut in two at the edge of a chunk, which is negligible.
+            total += len(chunk.split())
+    return total
+
+
+def measure_file(path: str, budget: Budget) -> int:
+    """Measure the total size of a file according to the budget, by reading all of it."""
+    with open(path, "rb") as file:
+        if path.endswith(".zst"):
+            chunks = ZstdDecompressor().read_to_iter(file, read_size=2**20, write_size=2**20)
+        else:
+            chunks = iter(lambda: file.read(2**20), b"")
+        return _measure_bytes(chunks, budget)
+
+
+def estimate_file(path: str, budget: Budget) -> int:
+    """
+    Estimate the total size of a file according to the budget, without reading all of it.
+    Files up to SAMPLE_BYTES on disk are measured exactly. For larger files only the first
+    SAMPLE_BYTES are read, and their measure is scaled up by the size of the file on disk.
+    """
+    file_size = os.path.getsize(path)
+    if file_size <= SAMPLE_BYTES:
+        return measure_file(path, budget)
+
+    with open(path, "rb") as file:
+        compressed = iter(lambda: file.read(min(2**20, SAMPLE_BYTES - file.tell())), b"")
+        if path.endswith(".zst"):
+            decompressor = ZstdDecompressor().decompressobj()
+            chunks = (decompressor.decompress(chunk) for chunk in compressed)
+        else:
+            chunks = compressed
+        sample_total = _measure_bytes(chunks, budget)
+    return sample_total * file_size // SAMPLE_BYTES
+
+
+def zip_parallel_lines(paths: list[str], lines_iters: list[Iterable[str]]) -> Iterator[tuple]:
+    """Zip the lines of parallel files, ensuring that they all have the same length."""
+    for line_tuple in zip_longest(*lines_iters):
+        if None in line_tuple:
+            short_path = paths[line_tuple.index(None)]
+            raise Exception(f"The file {short_path} has a different number of lines than {paths}")
+        yield line_tuple
+
+
+def get_chunk_paths(
+    output_dir: str, file_index: int, suffixes: list[str], output_suffix: str
+) -> list[str]:
+    return [f"{output_dir}/file.{file_index}{output_suffix}{suffix}.zst" for suffix in suffixes]
+
+
+def split_file(
+    mono_path: str,
+    output_dir: str,
+    num_parts: int,
+    output_suffix: str = "",
+    ref_path: Optional[str] = None,
+    aln_path: Optional[str] = None,
+    budget: Budget = Budget.lines,
+    round_robin: bool = False,
+):
     """
     Split a file into fixed number of chunks.
 
@@ -41,37 +206,139 @@ def split_file(mono_path: str, output_dir: str, num_parts: int, output_suffix: s
             ├── file.3.ref.zst
             ├── ...
             └── file.20.ref.zst
+
+    When a ref_path (and aln_path) are provided, they are split in the same pass into
+    "file.N.ref.zst" (and "file.N.aln.zst") with the same lines as "file.N.zst".
+
+    The chunk boundaries are chosen so that each chunk gets an equal share of the budget, e.g.
+    the bytes or tokens, which balances the work of the tasks that process the chunks. The files
+    are only read once: the total budget of the main file is estimated from a sample of its
+    beginning and its size on disk (see estimate_file), so the shares of large files are only
+    as even as the sample is representative. Small files are measured exactly.
+
+    With round_robin, the lines are dealt out to the chunks one at a time, so no total is
+    needed. This does not preserve the order of the lines when the chunks are concatenated
+    back together, so collect.py refuses to collect them.
     """
     os.makedirs(output_dir, exist_ok=True)
 
-    total_lines = count_lines(mono_path)
-    lines_per_part = (total_lines + num_parts - 1) // num_parts
-    logger.info(f"Splitting {mono_path} to {num_parts} chunks x {total_lines:,} lines")
+    input_paths = [mono_path]
+    suffixes = [""]
+    if ref_path:
+        input_paths.append(ref_path)
+        suffixes.append(".ref")
+    if aln_path:
+        if not ref_path:
+            raise ValueError("Alignments can only be split along with a ref_path")
+        input_paths.append(aln_path)
+        suffixes.append(".aln")
 
-    line_writer = None
-    line_count = 0
-    file_index = 1
+    with ExitStack() as stack:
+        lines_iters = [stack.enter_context(read_lines(path)) for path in input_paths]
+        line_tuples = zip_parallel_lines(input_paths, lines_iters)
 
-    with read_lines(mono_path) as lines:
-        with ExitStack() as chunk_stack:
-            for line in lines:
-                if not line_writer or line_count >= lines_per_part:
-                    # The current file is full or doesn't exist, start a new one.
-                    if line_writer:
-                        chunk_stack.close()
+        if round_robin:
+            logger.info(f"Splitting {input_paths} to {num_parts} chunks round-robin")
+            chunk_lines = _split_round_robin(
+                line_tuples, output_dir, num_parts, suffixes, output_suffix
+            )
+        else:
+            total = estimate_file(mono_path, budget)
+            logger.info(
+                f"Splitting {input_paths} to {num_parts} chunks of ~{total:,} {budget.value}"
+            )
+            chunk_lines = _split_contiguous(
+                line_tuples,
+                output_dir,
+                num_parts,
+                suffixes,
+                output_suffix,
+                total=max(1, total),
+                line_cost=get_line_cost(budget),
+            )
 
-                    chunk_name = f"{output_dir}/file.{file_index}{output_suffix}.zst"
-                    logger.info(f"Writing to file chunk: {chunk_name}")
-                    line_writer = chunk_stack.enter_context(write_lines(chunk_name))
-                    file_index += 1
-                    line_count = 0
-
-                line_writer.write(line)
-                line_count += 1
+    for file_index, lines in enumerate(chunk_lines, start=1):
+        chunk_path = get_chunk_paths(output_dir, file_index, [""], output_suffix)[0]
+        SplitStats(chunk_path, lines, total_chunks=num_parts, round_robin=round_robin).save_json()
 
     logger.info("Done writing to files.")
 
 
+def _split_contiguous(
+    line_tuples,
+    output_dir: str,
+    num_parts: int,
+    suffixes: list[str],
+    output_suffix: str,
+    total: int,
+    line_cost: Callable[[str], int],
+) -> list[int]:
+    """
+    Write the lines to the chunks in order. A line goes to the chunk whose share of the total
+    budget its start falls in, so every chunk is within a line of its share. When the total is
+    underestimated, the last chunk takes the rest of the lines. All of the chunks are created
+    even if they end up empty. The number of lines of every chunk is returned.
+    """
+    file_index = 0
+    offset = 0
+    writers: list[TextIO] = []
+    chunk_lines = [0] * num_parts
+
+    with ExitStack() as chunk_stack:
+
+        def open_next_chunk():
+            nonlocal file_index, writers
+            chunk_stack.close()
+            file_index += 1
+            chunk_paths = get_chunk_paths(output_dir, file_index, suffixes, output_suffix)
+            logger.info(f"Writing to file chunk: {chunk_paths}")
+            writers = [chunk_stack.enter_context(write_lines(path)) for path in chunk_paths]
+
+        for line_tuple in line_tuples:
+            chunk_index = min(num_parts - 1, offset * num_parts // total)
+            while file_index <= chunk_index:
+                open_next_chunk()
+
+            for writer, line in zip(writers, line_tuple):
+                writer.write(line)
+            offset += line_cost(line_tuple[0])
+            chunk_lines[chunk_index] += 1
+
+        # Create any remaining empty chunks.
+        while file_index < num_parts:
+            open_next_chunk()
+
+    return chunk_lines
+
+
+def _split_round_robin(
+    line_tuples,
+    output_dir: str,
+    num_parts: int,
+    suffixes: list[str],
+    output_suffix: str,
+) -> list[int]:
+    """
+    Keep all of the compressed writers open, and deal out the lines one at a time. The number
+    of lines of every chunk is returned.
+    """
+    chunk_lines = [0] * num_parts
+    with ExitStack() as chunk_stack:
+        writers = [
+            [chunk_stack.enter_context(write_lines(path)) for path in chunk_paths]
+            for chunk_paths in (
+                get_chunk_paths(output_dir, file_index, suffixes, output_suffix)
+                for file_index in range(1, num_parts + 1)
+            )
+        ]
+        for line_index, line_tuple in enumerate(line_tuples):
+            for writer, line in zip(writers[line_index % num_parts], line_tuple):
+                writer.write(line)
+            chunk_lines[line_index % num_parts] += 1
+
+    return chunk_lines
+
+
 def main(args: Optional[list[str]] = None) -> None:
     parser = argparse.ArgumentParser(
         description=__doc__,
@@ -83,6 +350,31 @@ def main(args: Optional[list[str]] = None) -> None:
     parser.add_argument(
         "--output_suffix", type=str, help="A suffix for output files, for example .ref", default=""
     )
+    parser.add_argument(
+        "--ref_path",
+        type=str,
+        default=None,
+        help="The other side of a parallel corpus, split in the same pass to file.N.ref.zst",
+    )
+    parser.add_argument(
+        "--aln_path",
+        type=str,
+        default=None,
+        help="The alignments of a parallel corpus, split in the same pass to file.N.aln.zst",
+    )
+    parser.add_argument(
+        "--budget",
+        type=Budget,
+        choices=list(Budget),
+        default=Budget.lines,
+        help="Balance the chunks by the number of lines, bytes, or tokens",
+    )
+    parser.add_argument(
+        "--round_robin",
+        action="store_true",
+        help="Deal out the lines to the chunks without estimating the size of the file first. "
+        "The order of the lines is not preserved across the chunks, so they can't be collected.",
+    )
 
     parsed_args = parser.parse_args(args)
 
@@ -91,6 +383,10 @@ def main(args: Optional[list[str]] = None) -> None:
         output_dir=parsed_args.output_dir,
         num_parts=parsed_args.num_parts,
         output_suffix=parsed_args.output_suffix,
+        ref_path=parsed_args.ref_path,
+        aln_path=parsed_args.aln_path,
+        budget=parsed_args.budget,
+        round_robin=parsed_args.round_robin,
     )
 
 
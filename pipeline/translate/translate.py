@@ -3,29 +3,48 @@ Translate a corpus using either Marian or CTranslate2.
 """
 
 import argparse
+from collections import deque
 from enum import Enum
 from glob import glob
 import os
 from pathlib import Path
+import shutil
+import subprocess
 import tempfile
+from threading import Thread
+from typing import Callable, Optional
 
-from pipeline.common.command_runner import apply_command_args, run_command
-from pipeline.common.datasets import compress, decompress
-from pipeline.common.downloads import count_lines, is_file_empty, write_lines
+from pipeline.common.command_runner import apply_command_args
+from pipeline.common.downloads import is_file_empty, write_lines
 from pipeline.common.logging import (
+    ProgressCounters,
     get_logger,
     start_gpu_logging,
-    start_byte_count_logger,
     stop_gpu_logging,
-    stop_byte_count_logger,
 )
 from pipeline.common.marian import get_combined_config
-from pipeline.translate.translate_ctranslate2 import translate_with_ctranslate2
+from pipeline.translate.checkpoint import (
+    TranslationCheckpoint,
+    fetch_previous_checkpoint,
+    read_lines_from_offset,
+)
+from pipeline.translate.collect import ChunkStats
+from pipeline.translate.memo import NBEST_SEPARATOR, TranslationMemo, get_model_key, group_nbest
+from pipeline.translate.nbest import NbestFormat, NbestWriter, convert_text_nbest, encode_records
+from pipeline.translate.splitter import SplitStats
+from pipeline.translate.translate_ctranslate2 import (
+    TranslatorConfig,
+    get_translator_config,
+    translate_with_ctranslate2,
+)
 
 logger = get_logger(__file__)
 
 DECODER_CONFIG_PATH = Path(__file__).parent / "decoder.yml"
 
+# How often the translation progress and the GPU stats are logged.
+PROGRESS_INTERVAL_SECONDS = 300
+
 
 class Decoder(Enum):
     marian = "marian"
@@ -38,48 +57,359 @@ class Device(Enum):
 
 
 def get_beam_size(extra_marian_args: list[str]):
-    return get_combined_config(DECODER_CONFIG_PATH, extra_marian_args)["beam-size"]
+    # The extra marian args are strings, while decoder.yml has an int.
+    return int(get_combined_config(DECODER_CONFIG_PATH, extra_marian_args)["beam-size"])
 
 
 def run_marian(
     marian_dir: Path,
     models: list[Path],
     vocab: str,
-    input: Path,
-    output: Path,
+    input_zst: Path,
+    write: Callable[[str, int, int, int], None],
+    log: Path,
     gpus: list[str],
     workspace: int,
     is_nbest: bool,
     extra_args: list[str],
-):
+    input_offset: int = 0,
+    start_index: int = 0,
+    progress: Optional[ProgressCounters] = None,
+) -> tuple[int, int]:
+    """
+    Translate the input with Marian, without an uncompressed copy of the input or the output
+    on disk. The decompressed input lines are fed to Marian's stdin from the input_offset on a
+    thread, and the translations that Marian writes to stdout are passed to write as they come
+    in, along with the number of input lines, output lines and input bytes that they are for.
+    The progress counters are incremented from stdout as well.
+
+    The lines are counted in flight, and the numbers of input and output lines are returned.
+    """
     config = Path(__file__).parent / "decoder.yml"
     marian_bin = str(marian_dir / "marian-decoder")
-    log = input.parent / f"{input.name}.log"
     if is_nbest:
         extra_args = ["--n-best", *extra_args]
+    command = [
+        marian_bin,
+        *apply_command_args(
+            {
+                "config": config,
+                "models": models,
+                "vocabs": [vocab, vocab],
+                "log": log,
+                "devices": gpus,
+                "workspace": workspace,
+            }
+        ),
+        *extra_args,
+    ]
+
+    logger.info(f"Starting Marian to translate from line {start_index:,}")
+    logger.info(" ".join(command))
+    process = subprocess.Popen(
+        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env={**os.environ}
+    )
+
+    # The byte lengths of the input lines that were fed to Marian and are not translated yet.
+    input_sizes: deque[int] = deque()
+    errors: list[Exception] = []
+
+    def feed_input() -> None:
+        try:
+            with read_lines_from_offset(input_zst, input_offset) as lines:
+                for line in lines:
+                    input_sizes.append(len(line))
+                    process.stdin.write(line)
+            process.stdin.close()
+        except Exception as exception:
+            errors.append(exception)
+
+    feeder = Thread(target=feed_input, daemon=True)
+    feeder.start()
+
+    input_lines = 0
+    output_lines = 0
+    lines = (line.decode("utf-8") for line in process.stdout)
+    if is_nbest:
+        # Marian numbers the lines from the start of stdin, so renumber them from the start.
+        for index, hypotheses in enumerate(group_nbest(lines), start=start_index):
+            text = "".join(f"{index}{NBEST_SEPARATOR}{hypothesis}\n" for hypothesis in hypotheses)
+            input_bytes = input_sizes.popleft()
+            write(text, 1, len(hypotheses), input_bytes)
+            input_lines += 1
+            output_lines += len(hypotheses)
+            if progress:
+                progress.add(lines=1, bytes=input_bytes)
+    else:
+        for line in lines:
+            input_bytes = input_sizes.popleft()
+            write(line, 1, 1, input_bytes)
+            input_lines += 1
+            if progress:
+                progress.add(lines=1, bytes=input_bytes)
+        output_lines = input_lines
+
+    returncode = process.wait()
+    feeder.join()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, command)
+    if errors:
+        raise errors[0]
+    if input_sizes:
+        raise Exception(f"Marian did not translate the last {len(input_sizes)} lines")
+    return input_lines, output_lines
+
+
+def check_line_counts(
+    input_count: int, output_count: int, is_nbest: bool, extra_marian_args: list[str]
+) -> None:
+    if is_nbest:
+        beam_size = get_beam_size(extra_marian_args)
+        expected_output = input_count * beam_size
+        assert (
+            expected_output == output_count
+        ), f"The nbest output had {beam_size}x as many lines ({expected_output} vs {output_count})"
+    else:
+        assert (
+            input_count == output_count
+        ), f"The input ({input_count} and output ({output_count}) had the same number of lines"
+
+
+def translate(
+    input_zst: Path,
+    artifacts: Path,
+    marian_dir: Path,
+    models: list[Path],
+    models_globs: list[str],
+    vocab: Path,
+    gpus: list[str],
+    workspace: str,
+    decoder: Decoder,
+    device: Device,
+    is_nbest: bool,
+    extra_marian_args: list[str],
+    cpu_replicas: Optional[int] = None,
+    model_cache: Optional[Path] = None,
+    checkpoint_dir: Optional[Path] = None,
+    autotune_lines: Optional[int] = None,
+    nbest_format: NbestFormat = NbestFormat.text,
+    total_lines: Optional[int] = None,
+    translator_config: Optional[TranslatorConfig] = None,
+) -> Path:
+    """
+    Translate the input into the artifacts with either decoder, and return the output path.
+    With a checkpoint_dir, the output is checkpointed as it is written, and the translation
+    resumes after the lines that were translated before.
+
+    The progress has an ETA when the total_lines of the input are known. By default they are
+    loaded from the stats that the splitter saved for the chunk.
+
+    CTranslate2 writes the binary nbest format directly, while Marian's text nbest is converted
+    once it is written, see `pipeline/translate/nbest.py`.
+    """
+    is_binary = is_nbest and nbest_format == NbestFormat.binary
+    postfix = "nbest" if is_nbest else "out"
+    output_zst = artifacts / f"{input_zst.stem}.{postfix}.zst"
+
+    # Taskcluster can produce empty input files when chunking out translation for
+    # parallelization. In this case skip translating, and write out an empty file.
+    if is_file_empty(input_zst):
+        logger.info(f"The input is empty, create a blank output: {output_zst}")
+        if is_binary:
+            with NbestWriter(output_zst) as writer:
+                writer.write(encode_records([]))
+        else:
+            with write_lines(output_zst) as _outfile:
+                # Nothing to write, just create the file.
+                pass
+        ChunkStats(output_zst, input_lines=0, output_lines=0).save_json()
+        return output_zst
+
+    checkpoint = None
+    if checkpoint_dir:
+        fetch_previous_checkpoint(checkpoint_dir)
+        checkpoint = TranslationCheckpoint(checkpoint_dir, input_zst, output_zst)
+
+    progress = ProgressCounters(
+        logger,
+        PROGRESS_INTERVAL_SECONDS,
+        json_path=artifacts / f"{input_zst.stem}.progress.json",
+        initial_lines=checkpoint.input_lines if checkpoint else 0,
+    )
+    if total_lines is None:
+        total_lines = SplitStats.load_lines(input_zst)
+    if total_lines is None:
+        logger.info("The number of input lines is unknown, so the progress has no ETA")
+    progress.total_lines = total_lines
+    progress.start()
+
+    if decoder == Decoder.ctranslate2:
+        translate_with_ctranslate2(
+            input_zst=input_zst,
+            artifacts=artifacts,
+            extra_marian_args=extra_marian_args,
+            models_globs=models_globs,
+            is_nbest=is_nbest,
+            vocab=[str(vocab)],
+            device=device.value,
+            device_index=[int(n) for n in gpus],
+            cpu_replicas=cpu_replicas,
+            model_cache=model_cache,
+            checkpoint=checkpoint,
+            progress=progress,
+            autotune_lines=autotune_lines,
+            nbest_format=nbest_format,
+            translator_config=translator_config,
+        )
+        progress.stop()
+        return output_zst
+
+    # The device flag is for use with CTranslate, but add some assertions here so that
+    # we can be consistent in usage.
+    if device == Device.cpu:
+        assert (
+            "--cpu-threads" in extra_marian_args
+        ), "Marian's cpu should be controlled with the flag --cpu-threads"
+    else:
+        assert (
+            "--cpu-threads" not in extra_marian_args
+        ), "Requested a GPU device, but --cpu-threads was provided"
+
+    if device == Device.gpu:
+        start_gpu_logging(logger, PROGRESS_INTERVAL_SECONDS)
 
-    logger.info("Starting Marian to translate")
-
-    run_command(
-        [
-            marian_bin,
-            *apply_command_args(
-                {
-                    "config": config,
-                    "models": models,
-                    "vocabs": [vocab, vocab],
-                    "input": input,
-                    "output": output,
-                    "log": log,
-                    "devices": gpus,
-                    "workspace": workspace,
-                }
-            ),
-            *extra_args,
-        ],
-        logger=logger,
-        env={**os.environ},
+    with tempfile.TemporaryDirectory() as temp_dir_str:
+        marian_kwargs = dict(
+            marian_dir=marian_dir,
+            models=models,
+            vocab=vocab,
+            input_zst=input_zst,
+            log=Path(temp_dir_str) / f"{input_zst.stem}.log",
+            gpus=gpus,
+            workspace=workspace,
+            is_nbest=is_nbest,
+            # Take off the initial "--"
+            extra_args=extra_marian_args[1:],
+            progress=progress,
+        )
+        if checkpoint:
+            run_marian(
+                write=checkpoint.write,
+                input_offset=checkpoint.input_offset,
+                start_index=checkpoint.input_lines,
+                **marian_kwargs,
+            )
+            checkpoint.flush()
+            input_count, output_count = checkpoint.input_lines, checkpoint.output_lines
+        else:
+            # The output is compressed on the fly with all of the cores.
+            with write_lines(output_zst, zstd_threads=-1) as outfile:
+                input_count, output_count = run_marian(
+                    write=lambda text, *_counts: outfile.write(text), **marian_kwargs
+                )
+
+    stop_gpu_logging()
+    progress.stop()
+    check_line_counts(input_count, output_count, is_nbest, extra_marian_args)
+
+    if checkpoint:
+        checkpoint.finish()
+    else:
+        # Record the line counts so that the collect step doesn't need to count them again.
+        ChunkStats(output_zst, input_lines=input_count, output_lines=output_count).save_json()
+
+    if is_binary:
+        logger.info(f"Converting the nbest translations to the binary format: {output_zst}")
+        convert_text_nbest(output_zst, output_zst)
+
+    return output_zst
+
+
+def translate_with_memo(
+    memo_path: Path,
+    input_zst: Path,
+    output_zst: Path,
+    artifacts: Path,
+    models: list[Path],
+    models_globs: list[str],
+    vocab: Path,
+    gpus: list[str],
+    decoder: Decoder,
+    device: Device,
+    is_nbest: bool,
+    extra_marian_args: list[str],
+    cpu_replicas: Optional[int] = None,
+    model_cache: Optional[Path] = None,
+    autotune_lines: Optional[int] = None,
+    nbest_format: NbestFormat = NbestFormat.text,
+    **kwargs,
+) -> None:
+    """
+    Only translate the lines that are unique and not in the translation memo, and expand the
+    translations back to every line of the input, see `pipeline/translate/memo.py`. The memo
+    stores the text nbest, which is converted to the nbest_format once it is expanded.
+
+    The translations are only reused with the same decoding settings. For CTranslate2 these
+    include the compute type, so the translator config is chosen first, which runs the autotuning
+    even when every line is in the memo.
+    """
+    translator_config = None
+    if decoder == Decoder.ctranslate2:
+        translator_config = get_translator_config(
+            input_zst=input_zst,
+            artifacts=artifacts,
+            extra_marian_args=extra_marian_args,
+            models_globs=models_globs,
+            is_nbest=is_nbest,
+            vocab=[str(vocab)],
+            device=device.value,
+            device_index=[int(n) for n in gpus],
+            cpu_replicas=cpu_replicas,
+            model_cache=model_cache,
+            autotune_lines=autotune_lines,
+        )
+    model_key = get_model_key(
+        models,
+        vocab,
+        decoder=decoder.value,
+        device=device.value,
+        is_nbest=is_nbest,
+        decoder_config=get_combined_config(DECODER_CONFIG_PATH, extra_marian_args),
+        compute_type=translator_config.compute_type if translator_config else None,
     )
+    memo = TranslationMemo(memo_path, model_key)
+    with tempfile.TemporaryDirectory() as temp_dir_str:
+        # The unique lines have the same name as the input, so that the progress and the other
+        # artifacts of translating them are published under the stem of the output. Their
+        # output is the output_zst, which is replaced by the expanded translations after.
+        unique_zst = Path(temp_dir_str) / input_zst.name
+        input_lines, unique_keys = memo.write_unique(input_zst, unique_zst)
+
+        unique_output = translate(
+            input_zst=unique_zst,
+            artifacts=artifacts,
+            models=models,
+            models_globs=models_globs,
+            vocab=vocab,
+            gpus=gpus,
+            decoder=decoder,
+            device=device,
+            is_nbest=is_nbest,
+            extra_marian_args=extra_marian_args,
+            cpu_replicas=cpu_replicas,
+            model_cache=model_cache,
+            total_lines=len(unique_keys),
+            translator_config=translator_config,
+            **kwargs,
+        )
+        memo.store_translations(unique_keys, unique_output, is_nbest)
+
+    logger.info(f"Expanding the translations to {output_zst}")
+    output_lines = memo.expand(input_zst, output_zst, is_nbest)
+    memo.close()
+    ChunkStats(output_zst, input_lines=input_lines, output_lines=output_lines).save_json()
+    if is_nbest and nbest_format == NbestFormat.binary:
+        convert_text_nbest(output_zst, output_zst)
 
 
 def main() -> None:
@@ -103,6 +433,13 @@ def main() -> None:
         "--artifacts", type=Path, required=True, help="Output path to the artifacts."
     )
     parser.add_argument("--nbest", action="store_true", help="Whether to use the nbest")
+    parser.add_argument(
+        "--nbest_format",
+        type=NbestFormat,
+        default=NbestFormat.text,
+        help="Write the nbest as Marian's text lines, or in the compact binary format that "
+        "extract_best.py reads, see pipeline/translate/nbest.py.",
+    )
     parser.add_argument(
         "--marian_dir", type=Path, required=True, help="The path the Marian binaries"
     )
@@ -131,6 +468,44 @@ def main() -> None:
         default=Device.gpu,
         help="Either use the normal marian decoder, or opt for CTranslate2.",
     )
+    parser.add_argument(
+        "--cpu_replicas",
+        type=int,
+        default=None,
+        help="The number of CTranslate2 translator replicas on CPU, which share the --cpu-threads "
+        "of the Marian args (or all of the CPUs). By default each replica gets 4 threads.",
+    )
+    parser.add_argument(
+        "--ctranslate2_model_cache",
+        type=Path,
+        default=None,
+        help="A directory of converted CTranslate2 models that is shared between tasks. By "
+        "default the model is converted next to the Marian model.",
+    )
+    parser.add_argument(
+        "--ctranslate2_autotune",
+        type=int,
+        default=None,
+        metavar="LINES",
+        help="Before translating with CTranslate2, measure the throughput of the batch sizes, "
+        "compute types and thread splits on this many lines from the start of the input, and "
+        "translate with the fastest. The trials are saved to the artifacts.",
+    )
+    parser.add_argument(
+        "--translation_memo",
+        type=Path,
+        default=None,
+        help="A SQLite store of translations. Only the unique lines that are not in it are "
+        "translated, and the new translations are added to it.",
+    )
+    parser.add_argument(
+        "--checkpoint_dir",
+        type=Path,
+        default=None,
+        help="Write the output in segments to this directory as it is translated, and resume "
+        "after the lines that were translated before. On Taskcluster, the checkpoint of a "
+        "previous run of the task is downloaded.",
+    )
     parser.add_argument(
         "extra_marian_args",
         nargs=argparse.REMAINDER,
@@ -174,82 +549,54 @@ def main() -> None:
     logger.info(f"Input file: {input_zst}")
     logger.info(f"Output file: {output_zst}")
 
-    # Taskcluster can produce empty input files when chunking out translation for
-    # parallelization. In this case skip translating, and write out an empty file.
-    if is_file_empty(input_zst):
-        logger.info(f"The input is empty, create a blank output: {output_zst}")
-        with write_lines(output_zst) as _outfile:
-            # Nothing to write, just create the file.
-            pass
-        return
+    # Publish the line counts of the split chunk, which the collect step verifies against.
+    split_stats_path = SplitStats.get_path(input_zst)
+    if split_stats_path.exists() and split_stats_path.parent.resolve() != artifacts.resolve():
+        shutil.copyfile(split_stats_path, artifacts / split_stats_path.name)
 
-    if decoder == Decoder.ctranslate2:
-        translate_with_ctranslate2(
+    if args.translation_memo:
+        translate_with_memo(
+            memo_path=args.translation_memo,
             input_zst=input_zst,
+            output_zst=output_zst,
             artifacts=artifacts,
-            extra_marian_args=extra_marian_args,
-            models_globs=models_globs,
-            is_nbest=is_nbest,
-            vocab=[str(vocab)],
-            device=device.value,
-            device_index=[int(n) for n in gpus],
-        )
-        return
-
-    # The device flag is for use with CTranslate, but add some assertions here so that
-    # we can be consistent in usage.
-    if device == Device.cpu:
-        assert (
-            "--cpu-threads" in extra_marian_args
-        ), "Marian's cpu should be controlled with the flag --cpu-threads"
-    else:
-        assert (
-            "--cpu-threads" not in extra_marian_args
-        ), "Requested a GPU device, but --cpu-threads was provided"
-
-    # Run the training.
-    with tempfile.TemporaryDirectory() as temp_dir_str:
-        temp_dir = Path(temp_dir_str)
-        input_txt = temp_dir / input_zst.stem
-        output_txt = temp_dir / output_zst.stem
-
-        decompress(input_zst, destination=input_txt, remove=True, logger=logger)
-
-        five_minutes = 300
-        if device == Device.gpu:
-            start_gpu_logging(logger, five_minutes)
-        start_byte_count_logger(logger, five_minutes, output_txt)
-
-        run_marian(
             marian_dir=marian_dir,
             models=models,
+            models_globs=models_globs,
             vocab=vocab,
-            input=input_txt,
-            output=output_txt,
             gpus=gpus,
             workspace=args.workspace,
+            decoder=decoder,
+            device=device,
             is_nbest=is_nbest,
-            # Take off the initial "--"
-            extra_args=extra_marian_args[1:],
+            extra_marian_args=extra_marian_args,
+            cpu_replicas=args.cpu_replicas,
+            model_cache=args.ctranslate2_model_cache,
+            checkpoint_dir=args.checkpoint_dir,
+            autotune_lines=args.ctranslate2_autotune,
+            nbest_format=args.nbest_format,
         )
+        return
 
-        stop_gpu_logging()
-        stop_byte_count_logger()
-
-        compress(output_txt, destination=output_zst, remove=True, logger=logger)
-
-        input_count = count_lines(input_txt)
-        output_count = count_lines(output_zst)
-        if is_nbest:
-            beam_size = get_beam_size(extra_marian_args)
-            expected_output = input_count * beam_size
-            assert (
-                expected_output == output_count
-            ), f"The nbest output had {beam_size}x as many lines ({expected_output} vs {output_count})"
-        else:
-            assert (
-                input_count == output_count
-            ), f"The input ({input_count} and output ({output_count}) had the same number of lines"
+    translate(
+        input_zst=input_zst,
+        artifacts=artifacts,
+        marian_dir=marian_dir,
+        models=models,
+        models_globs=models_globs,
+        vocab=vocab,
+        gpus=gpus,
+        workspace=args.workspace,
+        decoder=decoder,
+        device=device,
+        is_nbest=is_nbest,
+        extra_marian_args=extra_marian_args,
+        cpu_replicas=args.cpu_replicas,
+        model_cache=args.ctranslate2_model_cache,
+        checkpoint_dir=args.checkpoint_dir,
+        autotune_lines=args.ctranslate2_autotune,
+        nbest_format=args.nbest_format,
+    )
 
 
 if __name__ == "__main__":
@@ -6,24 +6,40 @@ than Marian. For a more detailed analysis see: https://github.com/mozilla/transl
 https://github.com/OpenNMT/CTranslate2/
 """
 
-from typing import Any, TextIO
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+from collections import deque
+from contextlib import ExitStack
+from dataclasses import asdict, dataclass
 from enum import Enum
 from glob import glob
+from itertools import islice
 from pathlib import Path
+from queue import Queue
+from threading import Event, Thread
+from typing import Any, BinaryIO, Callable, Iterable, Iterator, Optional, TextIO
 
 import ctranslate2
+import psutil
 import sentencepiece as spm
 from ctranslate2.converters.marian import MarianConverter
 
-from pipeline.common.downloads import read_lines, write_lines
+from pipeline.common.downloads import get_file_digest, write_lines
 from pipeline.common.logging import (
+    ProgressCounters,
     get_logger,
     start_gpu_logging,
-    start_byte_count_logger,
     stop_gpu_logging,
-    stop_byte_count_logger,
 )
 from pipeline.common.marian import get_combined_config
+from pipeline.translate.checkpoint import TranslationCheckpoint, read_lines_from_offset
+from pipeline.translate.collect import ChunkStats
+from pipeline.translate.nbest import NbestFormat, NbestWriter, encode_records
 
 
 def load_vocab(path: str):
@@ -41,6 +57,29 @@ ctranslate2.converters.marian.load_vocab = load_vocab
 
 logger = get_logger(__file__)
 
+# On CPU, each replica of the translator translates a batch with this many threads by default.
+CPU_THREADS_PER_REPLICA = 4
+
+# The number of batches that are queued per translator replica, so that a replica never waits
+# for the next batch.
+PENDING_BATCHES_PER_REPLICA = 2
+
+# The number of lines that SentencePiece encodes or decodes at once, and its threads.
+SPM_BATCH_LINES = 10_000
+SPM_THREADS = 4
+
+# The number of batches of lines that are queued between the threads.
+QUEUED_SPM_BATCHES = 8
+
+# The grid that the autotuner searches. The batch sizes are in tokens, like mini-batch-words.
+AUTOTUNE_BATCH_TOKENS = (500, 1000, 2000, 4000, 8000, 16000)
+AUTOTUNE_COMPUTE_TYPES = ("int8", "int8_float16", "float16", "float32")
+# The number of translator replicas per GPU.
+AUTOTUNE_GPU_REPLICAS = (1, 2)
+# The lines of the sample that warm up a translator before it is measured.
+AUTOTUNE_WARMUP_LINES = 100
+AUTOTUNE_CONFIG_NAME = "ctranslate2-autotune.json"
+
 
 class Device(Enum):
     gpu = "gpu"
@@ -65,6 +104,55 @@ def get_model(models_globs: list[str]) -> Path:
     return Path(models[0])
 
 
+def get_converted_model_dir(
+    model: Path, vocab: list[str], quantization: str, cache_dir: Optional[Path] = None
+) -> Path:
+    """
+    The directory of the conversion in the cache_dir, which is keyed by the digests of the model
+    and the vocabs, the quantization and the version of CTranslate2.
+    """
+    key = hashlib.sha256()
+    for path in [model, *vocab]:
+        key.update(get_file_digest(Path(path)).encode("utf-8"))
+    key.update(quantization.encode("utf-8"))
+    key.update(ctranslate2.__version__.encode("utf-8"))
+
+    cache_dir = cache_dir or model.parent
+    return cache_dir / f"{model.stem}.ct2-{key.hexdigest()[:16]}"
+
+
+def convert_model(
+    model: Path, vocab: list[str], quantization: str, cache_dir: Optional[Path] = None
+) -> Path:
+    """
+    Convert the Marian model to CTranslate2, or reuse a previous conversion from the cache_dir.
+    A conversion is written to a temporary directory and renamed into place, so tasks that
+    share a cache never load a partially converted model.
+    """
+    model_dir = get_converted_model_dir(model, vocab, quantization, cache_dir)
+    cache_dir = model_dir.parent
+    if model_dir.exists():
+        logger.info(f"Using the previously converted model: {model_dir}")
+        return model_dir
+
+    logger.info("Converting the Marian model to Ctranslate2:")
+    logger.info(model)
+    logger.info("Outputing model to:")
+    logger.info(model_dir)
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix=f".{model_dir.name}.")
+    converter = MarianConverter(model, vocab)
+    converter.convert(tmp_dir, quantization=quantization, force=True)
+    try:
+        os.rename(tmp_dir, model_dir)
+    except OSError:
+        # Another task that shares the cache finished converting the same model first.
+        logger.info("The model was converted concurrently, using the existing conversion")
+        shutil.rmtree(tmp_dir)
+    return model_dir
+
+
 class DecoderConfig:
     def __init__(self, extra_marian_args: list[str]) -> None:
         super().__init__()
@@ -72,10 +160,16 @@ class DecoderConfig:
         self.config = get_combined_config(Path(__file__).parent / "decoder.yml", extra_marian_args)
 
         self.mini_batch_words: int = self.get_from_config("mini-batch-words", int)
+        # The number of mini-batches to read ahead, and how to sort them. The defaults are the
+        # ones of marian-decoder.
+        self.maxi_batch: int = self.get_from_config("maxi-batch", int, 1)
+        self.maxi_batch_sort = MaxiBatchSort(self.get_from_config("maxi-batch-sort", str, "none"))
         self.beam_size: int = self.get_from_config("beam-size", int)
         self.precision = self.get_from_config("precision", str, "float32")
         if self.get_from_config("fp16", bool, False):
             self.precision = "float16"
+        # Marian's thread budget on CPU, which is shared between the CTranslate2 replicas.
+        self.cpu_threads: int = self.get_from_config("cpu-threads", int, 0)
 
     def get_from_config(self, key: str, type: any, default=None):
         value = self.config.get(key, default)
@@ -88,21 +182,393 @@ class DecoderConfig:
         raise ValueError(f'Expected "{key}" to be of a type "{type}" in the decoder.yml config')
 
 
-def write_single_translation(
-    _index: int, tokenizer_trg: spm.SentencePieceProcessor, result: Any, outfile: TextIO
-):
+def get_cpu_threads(num_threads: int, num_replicas: Optional[int]) -> tuple[int, int]:
+    """
+    Split the CPU threads between the translator replicas, returning the inter_threads (the
+    number of replicas that translate batches in parallel) and the intra_threads of each one.
+    """
+    num_threads = max(1, num_threads)
+    if not num_replicas:
+        num_replicas = num_threads // CPU_THREADS_PER_REPLICA
+    num_replicas = max(1, min(num_replicas, num_threads))
+    return num_replicas, num_threads // num_replicas
+
+
+@dataclass
+class TranslatorConfig:
+    """The settings of the translator that the autotuner chooses between."""
+
+    compute_type: str
+    max_batch_tokens: int
+    # The number of translator replicas, and the threads of each one on CPU.
+    inter_threads: int
+    intra_threads: int
+
+
+def create_translator(
+    model_dir: Path, device: str, device_index: list[int], config: TranslatorConfig
+) -> "ctranslate2.Translator":
+    if device == "gpu":
+        return ctranslate2.Translator(
+            str(model_dir),
+            device="cuda",
+            device_index=device_index,
+            compute_type=config.compute_type,
+            inter_threads=config.inter_threads,
+        )
+    return ctranslate2.Translator(
+        str(model_dir),
+        device="cpu",
+        compute_type=config.compute_type,
+        inter_threads=config.inter_threads,
+        intra_threads=config.intra_threads,
+    )
+
+
+class PeakMemory:
+    """
+    Sample the memory that is used on a thread, and keep the peak. On CPU this is the resident
+    memory of the process, and on GPU the memory that is used on the devices.
+
+    The peak is measured from the memory that was used on entering, so that a trial doesn't
+    count the memory that the process still holds from the trials before it.
+    """
+
+    def __init__(self, device: str, device_index: list[int], interval_seconds=0.1) -> None:
+        self.device = device
+        self.device_index = device_index
+        self.interval_seconds = interval_seconds
+        self.baseline_bytes = 0
+        self.peak_bytes = 0
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def get_used_bytes(self) -> int:
+        if self.device == "gpu":
+            # Only load gpustat when it's needed.
+            import gpustat
+
+            return sum(
+                gpu.memory_used * 2**20
+                for gpu in gpustat.new_query()
+                if gpu.index in self.device_index
+            )
+        return psutil.Process().memory_info().rss
+
+    def run(self) -> None:
+        while True:
+            self.peak_bytes = max(self.peak_bytes, self.get_used_bytes() - self.baseline_bytes)
+            if self.stopped.wait(self.interval_seconds):
+                return
+
+    def __enter__(self) -> "PeakMemory":
+        self.baseline_bytes = self.get_used_bytes()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *_exc) -> None:
+        self.stopped.set()
+        self.thread.join()
+
+
+def get_autotune_grid(
+    device: str, device_index: list[int], num_threads: int
+) -> tuple[list[str], list[tuple[int, int]]]:
+    """The supported compute types, and the thread splits between the translator replicas."""
+    if device == "gpu":
+        supported = ctranslate2.get_supported_compute_types("cuda", device_index[0])
+        thread_splits = [(replicas, 0) for replicas in AUTOTUNE_GPU_REPLICAS]
+    else:
+        supported = ctranslate2.get_supported_compute_types("cpu")
+        replicas = [2**power for power in range(num_threads.bit_length())]
+        thread_splits = sorted({get_cpu_threads(num_threads, n) for n in replicas})
+    return [t for t in AUTOTUNE_COMPUTE_TYPES if t in supported], thread_splits
+
+
+def measure_throughput(
+    model_dir: Path,
+    device: str,
+    device_index: list[int],
+    config: TranslatorConfig,
+    sample: list[list[str]],
+    decoder_config: "DecoderConfig",
+    options: dict[str, Any],
+) -> dict[str, Any]:
+    """
+    Translate the sample with the config, and measure the source tokens per second and the peak
+    memory. A config that fails, for instance by running out of memory, is recorded as an error.
+    """
+    trial: dict[str, Any] = asdict(config)
+
+    def translate(translator: "ctranslate2.Translator", lines: list[list[str]]) -> None:
+        for _ in translate_in_order(
+            translator,
+            get_batches(
+                iter(lines),
+                config.max_batch_tokens,
+                decoder_config.maxi_batch,
+                decoder_config.maxi_batch_sort,
+            ),
+            max_pending=translator.num_translators * PENDING_BATCHES_PER_REPLICA,
+            max_batch_size=config.max_batch_tokens,
+            batch_type="tokens",
+            **options,
+        ):
+            pass
+
+    try:
+        with PeakMemory(device, device_index) as memory:
+            translator = create_translator(model_dir, device, device_index, config)
+            translate(translator, sample[:AUTOTUNE_WARMUP_LINES])
+            start = time.monotonic()
+            translate(translator, sample)
+            elapsed_secs = max(time.monotonic() - start, 1e-6)
+            del translator
+    except Exception as exception:
+        logger.warning(f"The config {config} failed: {exception}")
+        trial["error"] = str(exception)
+        return trial
+
+    trial["tokens_per_second"] = sum(len(line) for line in sample) / elapsed_secs
+    trial["peak_memory_bytes"] = memory.peak_bytes
+    logger.info(
+        f"{config}: {trial['tokens_per_second']:,.1f} tokens/second, "
+        f"peak memory {memory.peak_bytes / 2**20:,.0f} MiB"
+    )
+    return trial
+
+
+def autotune(
+    model_dir: Path,
+    device: str,
+    device_index: list[int],
+    sample: list[list[str]],
+    decoder_config: "DecoderConfig",
+    num_threads: int,
+    options: dict[str, Any],
+) -> tuple[TranslatorConfig, list[dict[str, Any]]]:
+    """
+    Find the translator config with the highest throughput on the sample. The compute types and
+    thread splits are measured with the configured batch size first, and then the batch sizes
+    are measured with the fastest of them, which covers the grid in far fewer trials than
+    measuring every combination. Returns the fastest config, and all of the trials.
+    """
+    compute_types, thread_splits = get_autotune_grid(device, device_index, num_threads)
+    logger.info(
+        f"Autotuning on {len(sample):,} lines with the compute types {compute_types}, "
+        f"the thread splits {thread_splits} and the batch sizes {AUTOTUNE_BATCH_TOKENS}"
+    )
+    trials: list[dict[str, Any]] = []
+
+    def get_best() -> TranslatorConfig:
+        measured = [trial for trial in trials if "tokens_per_second" in trial]
+        if not measured:
+            raise Exception("Every autotuning trial failed")
+        best = max(measured, key=lambda trial: trial["tokens_per_second"])
+        return TranslatorConfig(
+            **{key: best[key] for key in TranslatorConfig.__dataclass_fields__.keys()}
+        )
+
+    def measure(config: TranslatorConfig) -> None:
+        trials.append(
+            measure_throughput(
+                model_dir, device, device_index, config, sample, decoder_config, options
+            )
+        )
+
+    for compute_type in compute_types:
+        for inter_threads, intra_threads in thread_splits:
+            measure(
+                TranslatorConfig(
+                    compute_type, decoder_config.mini_batch_words, inter_threads, intra_threads
+                )
+            )
+    best = get_best()
+    for max_batch_tokens in AUTOTUNE_BATCH_TOKENS:
+        if max_batch_tokens != best.max_batch_tokens:
+            measure(
+                TranslatorConfig(
+                    best.compute_type, max_batch_tokens, best.inter_threads, best.intra_threads
+                )
+            )
+    best = get_best()
+    logger.info(f"The fastest config is {best}")
+    return best, trials
+
+
+def get_batches(
+    lines: Iterable[list[str]],
+    max_batch_tokens: int,
+    maxi_batch: int,
+    maxi_batch_sort: MaxiBatchSort,
+) -> Iterator[tuple[list[int], list[list[str]]]]:
+    """
+    Split the tokenized lines into batches of up to max_batch_tokens tokens including the
+    padding, like Marian does with the mini-batch-words, maxi-batch and maxi-batch-sort options.
+    The lines of maxi_batch mini-batches are read ahead, and with MaxiBatchSort.src they are
+    sorted by the source length, so that the lines of a batch are of similar lengths. The
+    batches are yielded with the indexes of their lines in the input.
+    """
+    buffer_tokens = max_batch_tokens * max(1, maxi_batch)
+    lines = enumerate(lines)
+    while True:
+        buffer: list[tuple[int, list[str]]] = []
+        tokens = 0
+        for index, line in lines:
+            buffer.append((index, line))
+            tokens += len(line)
+            if tokens >= buffer_tokens:
+                break
+        if not buffer:
+            return
+
+        if maxi_batch_sort == MaxiBatchSort.src:
+            buffer.sort(key=lambda item: len(item[1]))
+        batch: list[tuple[int, list[str]]] = []
+        longest = 0
+        for item in buffer:
+            longest = max(longest, len(item[1]))
+            if batch and (len(batch) + 1) * longest > max_batch_tokens:
+                yield [index for index, _ in batch], [line for _, line in batch]
+                batch = []
+                longest = len(item[1])
+            batch.append(item)
+        yield [index for index, _ in batch], [line for _, line in batch]
+
+
+def translate_in_order(
+    translator: "ctranslate2.Translator",
+    batches: Iterable[tuple[list[int], list[list[str]]]],
+    max_pending: int,
+    **options,
+) -> Iterator[Any]:
+    """
+    Translate the batches asynchronously, so that all of the translator replicas are busy, and
+    yield the results in the order of the input lines. Only max_pending batches are queued at a
+    time, which bounds the memory of the read ahead input and the reordered results.
+    """
+    pending: deque[tuple[list[int], list[Any]]] = deque()
+    finished: dict[int, Any] = {}
+    next_index = 0
+    batches = iter(batches)
+    while True:
+        for indices, tokens in islice(batches, max_pending - len(pending)):
+            pending.append(
+                (indices, translator.translate_batch(tokens, asynchronous=True, **options))
+            )
+        if not pending:
+            return
+
+        indices, results = pending.popleft()
+        for index, result in zip(indices, results):
+            finished[index] = result.result()
+        while next_index in finished:
+            yield finished.pop(next_index)
+            next_index += 1
+
+
+def iterate_in_thread(iterable: Iterable, maxsize: int) -> Iterator:
+    """
+    Produce the items of the iterable on a background thread, and yield them through a bounded
+    queue. Any exception of the producer is raised by the consumer.
+    """
+    queue: Queue = Queue(maxsize)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                queue.put((item, None))
+            queue.put((done, None))
+        except Exception as exception:
+            queue.put((None, exception))
+
+    Thread(target=produce, daemon=True).start()
+    while True:
+        item, exception = queue.get()
+        if exception:
+            raise exception
+        if item is done:
+            return
+        yield item
+
+
+class BackgroundWriter:
+    """
+    Consume batches on a background thread that are fed through a bounded queue, for instance to
+    decode and write out the translations while the next ones are being translated.
+    """
+
+    def __init__(self, consume: Callable[[Any], None], maxsize: int) -> None:
+        self.consume = consume
+        self.queue: Queue = Queue(maxsize)
+        self.error: Optional[Exception] = None
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if self.error:
+                # Keep draining the queue so that the producer is never blocked.
+                continue
+            try:
+                self.consume(batch)
+            except Exception as exception:
+                self.error = exception
+
+    def put(self, batch: Any) -> None:
+        if self.error:
+            raise self.error
+        self.queue.put(batch)
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+
+def encode_lines(
+    lines: Iterable[bytes], tokenizer_src: spm.SentencePieceProcessor
+) -> Iterator[tuple[int, list[list[str]]]]:
+    """
+    Tokenize the lines in batches with SentencePiece's multithreaded batch API. The batches are
+    yielded with their length in bytes, which is the offset into the input that they advance.
+    """
+    for batch in iter(lambda: list(islice(lines, SPM_BATCH_LINES)), []):
+        yield sum(len(line) for line in batch), tokenizer_src.encode(
+            [line.decode("utf-8").strip() for line in batch],
+            out_type=str,
+            num_threads=SPM_THREADS,
+        )
+
+
+def write_single_translations(
+    _start_index: int,
+    tokenizer_trg: spm.SentencePieceProcessor,
+    results: list[Any],
+    outfile: TextIO,
+) -> int:
     """
     Just write each single translation to a new line. If beam search was used all the other
-    beam results are discarded.
+    beam results are discarded. Returns the number of lines that were written.
     """
-    line = tokenizer_trg.decode(result.hypotheses[0])
-    outfile.write(line)
-    outfile.write("\n")
+    lines = tokenizer_trg.decode(
+        [result.hypotheses[0] for result in results], num_threads=SPM_THREADS
+    )
+    outfile.write("".join(f"{line}\n" for line in lines))
+    return len(lines)
 
 
 def write_nbest_translations(
-    index: int, tokenizer_trg: spm.SentencePieceProcessor, result: Any, outfile: TextIO
-):
+    start_index: int,
+    tokenizer_trg: spm.SentencePieceProcessor,
+    results: list[Any],
+    outfile: TextIO,
+) -> int:
     """
     Match Marian's way of writing out nbest translations. For example, with a beam-size of 2 and
     collection nbest translations:
@@ -113,9 +579,137 @@ def write_nbest_translations(
     1 ||| The brown fox quickly jumped
     ...
     """
-    for hypothesis in result.hypotheses:
-        line = tokenizer_trg.decode(hypothesis)
-        outfile.write(f"{index} ||| {line}\n")
+    lines = iter(
+        tokenizer_trg.decode(
+            [hypothesis for result in results for hypothesis in result.hypotheses],
+            num_threads=SPM_THREADS,
+        )
+    )
+    output = []
+    for index, result in enumerate(results, start=start_index):
+        for line in islice(lines, len(result.hypotheses)):
+            output.append(f"{index} ||| {line}\n")
+    outfile.write("".join(output))
+    return len(output)
+
+
+def write_binary_nbest_translations(
+    _start_index: int,
+    tokenizer_trg: spm.SentencePieceProcessor,
+    results: list[Any],
+    outfile: BinaryIO,
+) -> int:
+    """
+    Write the nbest translations and their scores as a block of records of the binary format,
+    see `pipeline/translate/nbest.py`. The sentences are in order, so they aren't numbered.
+    """
+    lines = iter(
+        tokenizer_trg.decode(
+            [hypothesis for result in results for hypothesis in result.hypotheses],
+            num_threads=SPM_THREADS,
+        )
+    )
+    sentences = [
+        list(zip(islice(lines, len(result.hypotheses)), result.scores)) for result in results
+    ]
+    outfile.write(encode_records(sentences))
+    return sum(len(hypotheses) for hypotheses in sentences)
+
+
+def get_translate_options(
+    decoder_config: DecoderConfig, is_nbest: bool, nbest_format: NbestFormat
+) -> dict[str, Any]:
+    """
+    Options for "translate_batch":
+    https://opennmt.net/CTranslate2/python/ctranslate2.Translator.html#ctranslate2.Translator.translate_batch
+    """
+    return dict(
+        beam_size=decoder_config.beam_size,
+        return_scores=is_nbest and nbest_format == NbestFormat.binary,
+        num_hypotheses=decoder_config.beam_size if is_nbest else 1,
+    )
+
+
+def choose_translator_config(
+    input_zst: Path,
+    artifacts: Path,
+    model_dir: Path,
+    tokenizer_src: spm.SentencePieceProcessor,
+    decoder_config: DecoderConfig,
+    options: dict[str, Any],
+    device: str,
+    device_index: list[int],
+    cpu_replicas: Optional[int] = None,
+    autotune_lines: Optional[int] = None,
+) -> TranslatorConfig:
+    """
+    The default config of the translator, or with autotune_lines the fastest config on that
+    many lines from the start of the input, which is saved to the artifacts.
+    """
+    num_threads = decoder_config.cpu_threads or os.cpu_count() or 1
+    if device == "gpu":
+        config = TranslatorConfig("default", decoder_config.mini_batch_words, 1, 0)
+    else:
+        config = TranslatorConfig(
+            "default", decoder_config.mini_batch_words, *get_cpu_threads(num_threads, cpu_replicas)
+        )
+    if not autotune_lines:
+        return config
+
+    with read_lines_from_offset(input_zst, 0) as lines:
+        sample = [
+            line
+            for _, batch in encode_lines(islice(lines, autotune_lines), tokenizer_src)
+            for line in batch
+        ]
+    config, trials = autotune(
+        model_dir,
+        device,
+        device_index,
+        sample,
+        decoder_config,
+        num_threads,
+        options,
+    )
+    with open(artifacts / AUTOTUNE_CONFIG_NAME, "w", encoding="utf-8") as file:
+        json.dump({"config": asdict(config), "trials": trials}, file, indent=2)
+    return config
+
+
+def get_translator_config(
+    input_zst: Path,
+    artifacts: Path,
+    extra_marian_args: list[str],
+    models_globs: list[str],
+    is_nbest: bool,
+    vocab: list[str],
+    device: str,
+    device_index: list[int],
+    cpu_replicas: Optional[int] = None,
+    model_cache: Optional[Path] = None,
+    autotune_lines: Optional[int] = None,
+    nbest_format: NbestFormat = NbestFormat.text,
+) -> TranslatorConfig:
+    """
+    Choose the translator config before translating, for instance to know the compute type
+    that the translations are made with. It can be passed on to translate_with_ctranslate2.
+    """
+    decoder_config = DecoderConfig(extra_marian_args[1:])
+    model_dir = convert_model(
+        get_model(models_globs), vocab, decoder_config.precision, model_cache
+    )
+    return choose_translator_config(
+        input_zst,
+        artifacts,
+        model_dir,
+        spm.SentencePieceProcessor(vocab[0]),
+        decoder_config,
+        get_translate_options(decoder_config, is_nbest, nbest_format),
+        device,
+        device_index,
+        cpu_replicas,
+        autotune_lines,
+    )
 
 
 def translate_with_ctranslate2(
@@ -127,7 +721,23 @@ def translate_with_ctranslate2(
     vocab: list[str],
     device: str,
     device_index: list[int],
+    cpu_replicas: Optional[int] = None,
+    model_cache: Optional[Path] = None,
+    checkpoint: Optional[TranslationCheckpoint] = None,
+    progress: Optional[ProgressCounters] = None,
+    autotune_lines: Optional[int] = None,
+    nbest_format: NbestFormat = NbestFormat.text,
+    translator_config: Optional[TranslatorConfig] = None,
 ) -> None:
+    """
+    Translate the input, or with a checkpoint only the input lines that were not translated
+    before, in which case the translations are written to the checkpoint segments first.
+    The nbest translations are written in the nbest_format.
+
+    With autotune_lines, the translator config is tuned on that many lines from the start of
+    the input first, and the fastest config is saved to the artifacts and used to translate.
+    A translator_config that was chosen before is used as is.
+    """
     model = get_model(models_globs)
     postfix = "nbest" if is_nbest else "out"
 
@@ -143,21 +753,32 @@ def translate_with_ctranslate2(
 
     decoder_config = DecoderConfig(extra_marian_args[1:])
 
-    ctranslate2_model_dir = model.parent / f"{Path(model).stem}"
-    logger.info("Converting the Marian model to Ctranslate2:")
-    logger.info(model)
-    logger.info("Outputing model to:")
-    logger.info(ctranslate2_model_dir)
-
-    converter = MarianConverter(model, vocab)
-    converter.convert(ctranslate2_model_dir, quantization=decoder_config.precision)
-
-    if device == "gpu":
-        translator = ctranslate2.Translator(
-            str(ctranslate2_model_dir), device="cuda", device_index=device_index
-        )
-    else:
-        translator = ctranslate2.Translator(str(ctranslate2_model_dir), device="cpu")
+    ctranslate2_model_dir = convert_model(model, vocab, decoder_config.precision, model_cache)
+
+    write_translations = write_single_translations
+    is_binary = is_nbest and nbest_format == NbestFormat.binary
+    if is_binary:
+        write_translations = write_binary_nbest_translations
+    elif is_nbest:
+        write_translations = write_nbest_translations
+
+    options = get_translate_options(decoder_config, is_nbest, nbest_format)
+
+    config = translator_config or choose_translator_config(
+        input_zst,
+        artifacts,
+        ctranslate2_model_dir,
+        tokenizer_src,
+        decoder_config,
+        options,
+        device,
+        device_index,
+        cpu_replicas,
+        autotune_lines,
+    )
+
+    logger.info(f"Translating with {config}")
+    translator = create_translator(ctranslate2_model_dir, device, device_index, config)
 
     logger.info("Loading model")
     translator.load_model()
@@ -165,36 +786,71 @@ def translate_with_ctranslate2(
 
     output_zst = artifacts / f"{input_zst.stem}.{postfix}.zst"
 
-    num_hypotheses = 1
-    write_translation = write_single_translation
-    if is_nbest:
-        num_hypotheses = decoder_config.beam_size
-        write_translation = write_nbest_translations
-
-    def tokenize(line):
-        return tokenizer_src.Encode(line.strip(), out_type=str)
-
     five_minutes = 300
     if device == "gpu":
         start_gpu_logging(logger, five_minutes)
-    start_byte_count_logger(logger, five_minutes, output_zst)
-
-    index = 0
-    with write_lines(output_zst) as outfile, read_lines(input_zst) as lines:
-        for result in translator.translate_iterable(
-            # Options for "translate_iterable":
-            # https://opennmt.net/CTranslate2/python/ctranslate2.Translator.html#ctranslate2.Translator.translate_iterable
-            map(tokenize, lines),
-            max_batch_size=decoder_config.mini_batch_words,
+
+    index = checkpoint.input_lines if checkpoint else 0
+    input_offset = checkpoint.input_offset if checkpoint else 0
+    output_lines = 0
+    with ExitStack() as stack:
+        lines = stack.enter_context(read_lines_from_offset(input_zst, input_offset))
+        if is_binary and not checkpoint:
+            # Each batch is written out as a compressed frame.
+            outfile = stack.enter_context(NbestWriter(output_zst))
+        elif not checkpoint:
+            outfile = stack.enter_context(write_lines(output_zst))
+
+        # The input is tokenized on a producer thread, and the translations are decoded and
+        # written out on a consumer thread, so that the translator is never waiting on them.
+        # The tokenized batches line up with the batches that are written out, so their sizes
+        # are the input offsets of the checkpoint, and their tokens count towards the progress.
+        input_sizes: deque[tuple[int, int]] = deque()
+
+        def tokenize() -> Iterator[list[str]]:
+            for input_bytes, batch in iterate_in_thread(
+                encode_lines(lines, tokenizer_src), QUEUED_SPM_BATCHES
+            ):
+                input_sizes.append((input_bytes, sum(len(line) for line in batch)))
+                yield from batch
+
+        def write_batch(batch: tuple[int, list[Any], int]) -> None:
+            nonlocal output_lines
+            start_index, results, input_bytes = batch
+            if not checkpoint:
+                output_lines += write_translations(start_index, tokenizer_trg, results, outfile)
+                return
+            buffer = io.BytesIO() if is_binary else io.StringIO()
+            written = write_translations(start_index, tokenizer_trg, results, buffer)
+            checkpoint.write(buffer.getvalue(), len(results), written, input_bytes)
+
+        writer = BackgroundWriter(write_batch, QUEUED_SPM_BATCHES)
+        results = translate_in_order(
+            translator,
+            get_batches(
+                tokenize(),
+                config.max_batch_tokens,
+                decoder_config.maxi_batch,
+                decoder_config.maxi_batch_sort,
+            ),
+            max_pending=translator.num_translators * PENDING_BATCHES_PER_REPLICA,
+            # A line that is longer than a batch is still split up by CTranslate2.
+            max_batch_size=config.max_batch_tokens,
             batch_type="tokens",
-            # Options for "translate_batch":
-            # https://opennmt.net/CTranslate2/python/ctranslate2.Translator.html#ctranslate2.Translator.translate_batch
-            beam_size=decoder_config.beam_size,
-            return_scores=False,
-            num_hypotheses=num_hypotheses,
-        ):
-            write_translation(index, tokenizer_trg, result, outfile)
-            index += 1
+            **options,
+        )
+        for batch in iter(lambda: list(islice(results, SPM_BATCH_LINES)), []):
+            input_bytes, input_tokens = input_sizes.popleft()
+            writer.put((index, batch, input_bytes))
+            index += len(batch)
+            if progress:
+                progress.add(lines=len(batch), tokens=input_tokens, bytes=input_bytes)
+        writer.close()
 
     stop_gpu_logging()
-    stop_byte_count_logger()
+    if checkpoint:
+        checkpoint.finish()
+        return
+
+    # Record the line counts so that the collect step doesn't need to count them again.
+    ChunkStats(output_zst, input_lines=index, output_lines=output_lines).save_json()
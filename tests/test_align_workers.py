@@ -0,0 +1,182 @@
+import json
+import os
+import sys
+from collections import Counter
+from types import SimpleNamespace
+
+import psutil
+import pytest
+from fixtures import DataDir
+
+from pipeline.alignments.align import (
+    BYTES_PER_TOKEN,
+    AlignmentPart,
+    Priors,
+    align,
+    estimate_part_memory,
+    get_num_workers,
+    write_parts,
+)
+from pipeline.alignments.checkpoint import MANIFEST_NAME
+
+
+@pytest.fixture
+def data_dir():
+    return DataDir("test_align_workers")
+
+
+@pytest.fixture
+def part(data_dir):
+    data_dir.create_file("part.0.src", "one two three\nfour five\n")
+    data_dir.create_file("part.0.trg", "один два\nтри четыре пять\n")
+    return AlignmentPart(
+        suffix="0",
+        src=data_dir.join("part.0.src"),
+        trg=data_dir.join("part.0.trg"),
+        fwd=data_dir.join("aln.fwd.0"),
+        rev=data_dir.join("aln.rev.0"),
+        priors_input_path=None,
+    )
+
+
+def test_estimate_part_memory(part):
+    # 10 tokens over 2 lines is 5 tokens per line.
+    assert estimate_part_memory(part.src, part.trg, chunk_lines=1000) == (
+        1000 * 5 * BYTES_PER_TOKEN
+    )
+
+
+def test_num_workers_explicit(part):
+    assert get_num_workers(part, chunk_lines=1000, num_workers=2) == 2
+
+
+def test_num_workers_memory_limited(part, monkeypatch):
+    part_memory = 1000 * 5 * BYTES_PER_TOKEN
+
+    class VirtualMemory:
+        available = part_memory * 2 + 1
+
+    monkeypatch.setattr(psutil, "virtual_memory", lambda: VirtualMemory)
+    monkeypatch.setattr("multiprocessing.cpu_count", lambda: 32)
+    assert get_num_workers(part, chunk_lines=1000, num_workers=None) == 2
+
+    VirtualMemory.available = 1
+    assert get_num_workers(part, chunk_lines=1000, num_workers=None) == 1
+
+
+def test_write_parts_streams_compressed_corpus(data_dir):
+    data_dir.create_zst("corpus.en.zst", "".join(f"en {i}\n" for i in range(7)))
+    data_dir.create_zst("corpus.ru.zst", "".join(f"ru {i}\n" for i in range(7)))
+    tmp_dir = data_dir.mkdir("tmp")
+
+    parts = write_parts(
+        data_dir.join("corpus.en.zst"),
+        data_dir.join("corpus.ru.zst"),
+        tmp_dir,
+        chunk_lines=3,
+        priors_input_path=None,
+    )
+
+    part = next(parts)
+    assert sorted(os.listdir(tmp_dir)) == [
+        "part.0.src",
+        "part.0.trg",
+    ], "Only the requested part is written"
+    assert data_dir.read_text("tmp/part.0.src") == "en 0\nen 1\nen 2\n"
+    assert data_dir.read_text("tmp/part.0.trg") == "ru 0\nru 1\nru 2\n"
+
+    remaining = list(parts)
+    assert [p.suffix for p in remaining] == ["1", "2"]
+    assert data_dir.read_text("tmp/part.2.src") == "en 6\n"
+    assert data_dir.read_text("tmp/part.2.trg") == "ru 6\n"
+    assert part.fwd == os.path.join(tmp_dir, "aln.fwd.0")
+
+
+def test_merge_priors():
+    def part_priors(lex: dict, hmmf: dict) -> Priors:
+        return Priors(Counter(lex), Counter(hmmf), Counter({1: 1}), Counter(), Counter())
+
+    parts = [
+        part_priors({("one", "один"): 1, ("two", "два"): 2}, {1: 3}),
+        part_priors({("one", "один"): 4}, {1: 1, 2: 1}),
+        part_priors({("three", "три"): 1}, {}),
+    ]
+
+    priors = Priors.empty()
+    for part in parts:
+        priors.merge(part)
+    reversed_priors = Priors.empty()
+    for part in reversed(parts):
+        reversed_priors.merge(part)
+
+    assert priors == reversed_priors
+    assert priors.lex == Counter({("one", "один"): 5, ("two", "два"): 2, ("three", "три"): 1})
+    assert priors.hmmf == Counter({1: 4, 2: 1})
+    assert priors.hmmr == Counter({1: 3})
+    assert priors.ferf == Counter()
+
+
+@pytest.fixture
+def fake_eflomal(monkeypatch):
+    """Align every line as "0-0 <line length>", and count the lines as the priors."""
+    aligned = []
+
+    class Aligner:
+        def align(self, src_input, trg_input, links_filename_fwd, links_filename_rev, **kwargs):
+            lines = src_input.readlines()
+            aligned.append(lines)
+            for path in links_filename_fwd, links_filename_rev:
+                with open(path, "w") as out:
+                    out.writelines(f"0-0 {len(line)}\n" for line in lines)
+
+    def calculate_priors(src, trg, fwd, rev):
+        return Counter({"lines": len(src.readlines())}), Counter(), Counter(), Counter(), Counter()
+
+    def write_priors(out, lex, *_):
+        out.write(f"{lex['lines']}\n")
+
+    eflomal = SimpleNamespace(
+        Aligner=Aligner, calculate_priors=calculate_priors, write_priors=write_priors
+    )
+    monkeypatch.setitem(sys.modules, "eflomal", eflomal)
+    return aligned
+
+
+def test_align_resumes_from_checkpoint(data_dir, fake_eflomal):
+    src = [f"en {i}\n" for i in range(7)]
+    data_dir.create_zst("corpus.en.zst", "".join(src))
+    data_dir.create_zst("corpus.ru.zst", "".join(f"ru {i}\n" for i in range(7)))
+    tmp_dir = data_dir.mkdir("tmp")
+    checkpoint_dir = data_dir.join("checkpoint")
+
+    def run_align():
+        fake_eflomal.clear()
+        align(
+            data_dir.join("corpus.en.zst"),
+            data_dir.join("corpus.ru.zst"),
+            tmp_dir,
+            chunk_lines=3,
+            priors_input_path=None,
+            num_workers=1,
+            priors_output_path=data_dir.join("corpus.priors"),
+            checkpoint_dir=checkpoint_dir,
+        )
+        return data_dir.read_text("tmp/aln.fwd"), data_dir.read_text("corpus.priors")
+
+    assert run_align() == ("".join(f"0-0 {len(line)}\n" for line in src), "7\n")
+    assert len(fake_eflomal) == 3
+    with open(os.path.join(checkpoint_dir, MANIFEST_NAME)) as file:
+        manifest = json.load(file)
+    assert sorted(manifest["chunks"]) == ["0", "1", "2"]
+    assert manifest["chunks"]["1"]["fwd"] == "aln.fwd.1.zst"
+
+    # Nothing is aligned again when the inputs are the same.
+    assert run_align() == ("".join(f"0-0 {len(line)}\n" for line in src), "7\n")
+    assert fake_eflomal == []
+
+    # Only the chunk with a changed input is aligned again.
+    src[4] = "en four\n"
+    os.remove(data_dir.join("corpus.en.zst"))
+    data_dir.create_zst("corpus.en.zst", "".join(src))
+    assert run_align() == ("".join(f"0-0 {len(line)}\n" for line in src), "7\n")
+    assert fake_eflomal == [src[3:6]]
@@ -1,7 +1,7 @@
 import pytest
 from sacremoses import MosesTokenizer
 
-from pipeline.alignments.align import map_indices
+from pipeline.alignments.align import map_indices, remap_batch
 
 tokenizer = MosesTokenizer("en")
 
@@ -56,3 +56,32 @@ def test_remap_indices(orig, expected_idx_map):
     idx_map = map_indices(tokenized_str, orig)
 
     assert idx_map == expected_idx_map
+
+
+def test_map_indices_escaped():
+    """
+    Moses escapes special characters, which changes the length of the tokens.
+    """
+    orig = "Don't a&b world!"
+    tokenized_str = " ".join(tokenizer.tokenize(orig))
+    assert "&apos;" in tokenized_str
+
+    idx_map = map_indices(tokenized_str, orig)
+
+    assert idx_map == {0: 0, 1: 0, 2: 1, 3: 1, 4: 1, 5: 2, 6: 2}
+
+
+def test_remap_batch():
+    batch = [
+        # "Hello, world!" -> "Hello , world !", duplicates are removed
+        ("0 0 1 1\n", "0 1\n", "0-0 1-0 2-1 3-1 2-0\n"),
+        # An empty line
+        ("\n", "\n", "\n"),
+        # Whitespace tokens from the ICU tokenizer are removed
+        ("0 -1 1\n", "0 0\n", "0-1 1-0 2-0\n"),
+    ]
+
+    lines, remapped = remap_batch(batch)
+
+    assert lines == 3
+    assert remapped == "0-0 1-1 1-0\n\n0-0 1-0\n"
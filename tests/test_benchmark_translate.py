@@ -0,0 +1,40 @@
+import json
+
+import pytest
+from fixtures import DataDir
+
+pytest.importorskip("ctranslate2")
+
+from utils.benchmark_translate import main as benchmark_translate  # noqa: E402
+
+
+def test_benchmark_translate():
+    data_dir = DataDir("test_benchmark_translate")
+    output = data_dir.join("translate.json")
+
+    benchmark_translate(
+        [
+            *["--output", output],
+            *["--work_dir", data_dir.join("work")],
+            *["--distributions", "short", "long"],
+            *["--lines", "20"],
+            *["--repeats", "2"],
+            *["--vocab_size", "500"],
+            *["--dim", "16", "--ffn_dim", "32", "--layers", "1", "--heads", "2"],
+            *["--", "--beam-size", "2", "--mini-batch-words", "100"],
+        ]
+    )
+
+    with open(output) as file:
+        report = json.load(file)
+    assert report["settings"]["marian_args"] == ["--beam-size", "2", "--mini-batch-words", "100"]
+    assert [result["distribution"] for result in report["results"]] == ["short", "long"]
+    for result in report["results"]:
+        assert len(result["runs"]) == 2
+        assert result["lines"] == 20
+        assert result["sentences_per_second"] > 0
+        assert result["tokens_per_second"] > 0
+        assert result["time_to_first_output_seconds"] > 0
+        assert result["peak_rss_bytes"] > 0
+    short, long = report["results"]
+    assert long["source_tokens"] > short["source_tokens"]
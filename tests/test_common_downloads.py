@@ -8,7 +8,13 @@ import pytest
 import zstandard
 from fixtures import DataDir
 
-from pipeline.common.downloads import compress_file, decompress_file, read_lines, write_lines
+from pipeline.common.downloads import (
+    ParallelGzipWriter,
+    compress_file,
+    decompress_file,
+    read_lines,
+    write_lines,
+)
 
 # Content to serve
 line_fixtures = [
@@ -210,3 +216,18 @@ def test_decompress_file(compression: str, keep_original: bool):
     data_dir.print_tree()
     assert Path(compressed_file).exists() == keep_original
     assert_matches_test_content(text_file)
+
+
+@pytest.mark.parametrize("lines", [0, 1, 1000])
+def test_parallel_gzip_writer(lines: int):
+    data_dir = DataDir("test_parallel_gzip_writer")
+    path = Path(data_dir.join("file.txt.gz"))
+    expected = [f"Line {i}\n" for i in range(lines)]
+
+    # The tiny blocks are compressed as many gzip members.
+    with ParallelGzipWriter(path, threads=4, block_size=100) as output:
+        for line in expected:
+            output.write(line.encode("utf-8"))
+
+    with read_lines(path) as actual:
+        assert list(actual) == expected
@@ -0,0 +1,45 @@
+import json
+import logging
+from pathlib import Path
+
+from fixtures import DataDir
+
+from pipeline.common.logging import ProgressCounters, format_duration
+
+
+def test_progress_counters(monkeypatch, caplog):
+    data_dir = DataDir("test_common_logging")
+    json_path = Path(data_dir.join("progress.json"))
+    now = [1000.0]
+    monkeypatch.setattr("pipeline.common.logging.time.time", lambda: now[0])
+
+    progress = ProgressCounters(
+        logging.getLogger("test"), interval_seconds=3600, json_path=json_path, initial_lines=100
+    )
+    progress.total_lines = 1100
+    progress.start()
+
+    now[0] += 10
+    progress.add(lines=200, tokens=4000, bytes=8000)
+    progress.report()
+    stats = json.loads(json_path.read_text())
+    assert stats["lines"] == 300
+    assert stats["lines_per_second"] == 20
+    assert stats["tokens_per_second"] == 400
+    assert stats["percent"] == 27.27
+    assert stats["eta_seconds"] == 40
+
+    # The moving average follows the recent throughput.
+    now[0] += 10
+    progress.add(lines=400)
+    with caplog.at_level(logging.INFO):
+        progress.stop()
+    stats = json.loads(json_path.read_text())
+    assert stats["lines_per_second"] == 30
+    assert stats["moving_lines_per_second"] == 30
+    assert stats["eta_seconds"] == 13.3
+    assert "700 lines of 1,100 (63.64%)" in caplog.text
+
+
+def test_format_duration():
+    assert format_duration(3725.5) == "1:02:05"
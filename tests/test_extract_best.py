@@ -1,7 +1,11 @@
 import os
+import sys
 
+import pytest
 from fixtures import DataDir
 
+from pipeline.translate import extract_best
+
 nbest = """0 ||| Реформа, направленная на выдвижение условий, идет слишком медленно. ||| F0= -9.21191 F1= -11.53 ||| -1.22059
 0 ||| Реформа, направленная на выдвижение условий, проходит слишком медленно. ||| F0= -10.1025 F1= -11.1262 ||| -1.24908
 0 ||| Реформа условий была слишком медленной. ||| F0= -6.67615 F1= -6.21271 ||| -1.28906
@@ -25,8 +29,8 @@ refs = """Реформирование кондициональности про
 
 def test_extract_best_chrf():
     data_dir = DataDir("test_extract_best")
-    data_dir.create_file("file.1.nbest", nbest)
-    data_dir.create_file("file.1.ref", refs)
+    data_dir.create_zst("file.1.nbest.zst", nbest)
+    data_dir.create_zst("file.1.ref.zst", refs)
     data_dir.mkdir("artifacts")
     env = {
         "TEST_ARTIFACTS": data_dir.path,
@@ -68,8 +72,8 @@ refs_empty = """.GDFAKERPROJECTファイルを開くには?
 
 def test_extract_best_empty():
     data_dir = DataDir("test_extract_best")
-    data_dir.create_file("file.1.nbest", nbest_empty)
-    data_dir.create_file("file.1.ref", refs_empty)
+    data_dir.create_zst("file.1.nbest.zst", nbest_empty)
+    data_dir.create_zst("file.1.ref.zst", refs_empty)
     data_dir.mkdir("artifacts")
     env = {
         "TEST_ARTIFACTS": data_dir.path,
@@ -84,3 +88,77 @@ def test_extract_best_empty():
     with open(output_file, "r") as f:
         output = f.read()
     assert output.strip() == refs_empty
+
+
+def run_extract_best(monkeypatch, data_dir: DataDir, *args: str) -> None:
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "extract_best.py",
+            *["--nbest", data_dir.join("file.1.nbest.zst")],
+            *["--references", data_dir.join("file.1.ref.zst")],
+            *args,
+        ],
+    )
+    extract_best.main()
+
+
+@pytest.mark.parametrize("metric", ["bleu", "sacrebleu", "chrf"])
+@pytest.mark.parametrize("workers", [1, 2])
+def test_extract_best_in_workers(monkeypatch, metric, workers):
+    data_dir = DataDir("test_extract_best")
+    data_dir.create_zst(
+        "file.1.nbest.zst",
+        nbest + "\n" + nbest_empty.replace("1 |||", "3 |||").replace("0 |||", "2 |||"),
+    )
+    data_dir.create_zst("file.1.ref.zst", refs + "\n" + refs_empty)
+    monkeypatch.setattr(extract_best, "CHUNK_SENTENCES", 1)
+
+    run_extract_best(
+        monkeypatch,
+        data_dir,
+        *["--output", data_dir.join("file.1.nbest.out.zst")],
+        *["--metric", metric],
+        *["--workers", str(workers)],
+    )
+
+    output = data_dir.read_text("file.1.nbest.out.zst").splitlines()
+    assert len(output) == 4
+    if metric == "chrf":
+        assert output == [
+            "Реформа, направленная на выдвижение условий, проходит слишком медленно.",
+            "Помощь по-прежнему носит фрагментарный характер, а доноры не координируют свои "
+            "действия.",
+            *refs_empty.splitlines(),
+        ]
+
+
+def test_extract_best_sentence_mismatch(monkeypatch):
+    data_dir = DataDir("test_extract_best")
+    data_dir.create_zst("file.1.nbest.zst", nbest)
+    data_dir.create_zst("file.1.ref.zst", refs + "\nAn extra reference\n")
+
+    with pytest.raises(ValueError, match="fewer sentences"):
+        run_extract_best(monkeypatch, data_dir, "--output", data_dir.join("file.1.nbest.out"))
+
+
+@pytest.mark.parametrize("metric", ["sacrebleu", "chrf"])
+def test_sacrebleu_scorer_matches_sentence_scores(metric):
+    import sacrebleu
+
+    sentence_score = sacrebleu.sentence_bleu if metric == "sacrebleu" else sacrebleu.sentence_chrf
+    sentences = [
+        (refs.splitlines()[:1], [line.split(" ||| ")[1] for line in nbest.splitlines()[:8]]),
+        (refs.splitlines(), [line.split(" ||| ")[1] for line in nbest.splitlines()[8:]]),
+        (["The  cat sat\ton the mat. "], ["the cat sat on the mat", " The cat  sat", "", "mat"]),
+        ([""], ["", "Something"]),
+    ]
+    scorer = extract_best.SacrebleuScorer(metric)
+    for sentence_refs, texts in sentences:
+        # The previous implementation split the texts on whitespace and joined them again.
+        expected = [
+            sentence_score(" ".join(text.split()), [" ".join(r.split()) for r in sentence_refs])
+            for text in texts
+        ]
+        assert scorer.score(sentence_refs, texts) == [score.score for score in expected]
@@ -0,0 +1,150 @@
+import random
+
+import numpy as np
+import pytest
+import sentencepiece as spm
+from fixtures import DataDir
+
+from pipeline.alignments.prune_shortlist import (
+    BINARY_SHORTLIST_MAGIC,
+    hash_words,
+    prune_shortlist,
+)
+
+
+@pytest.fixture
+def data_dir():
+    return DataDir("test_prune_shortlist")
+
+
+def prune_with_dicts(lex_lines: list[str], vocab_tokens: list[str], top_k: int) -> list[str]:
+    """The original implementation, which held the whole lexicon in a dict of dicts."""
+    tops = vocab_tokens[: top_k + 2]
+    pairs: dict[str, dict[str, float]] = {}
+    for line in lex_lines:
+        try:
+            trg, src, prob = line.strip().split()
+        except ValueError:
+            continue
+        if trg == "NULL" or src == "NULL":
+            continue
+        pairs.setdefault(src, {})[trg] = float(prob)
+
+    output = []
+    for src, probs in pairs.items():
+        top_src = list(sorted(probs, key=probs.get, reverse=True)[:top_k])
+        for trg in top_src + tops:
+            if trg in probs:
+                output.append("{} {} {:.8f}".format(trg, src, probs[trg]))
+    return output
+
+
+def group_by_source(lines: list[str]) -> dict[str, list[str]]:
+    groups: dict[str, list[str]] = {}
+    for line in lines:
+        groups.setdefault(line.split()[1], []).append(line)
+    return groups
+
+
+def create_lexicon(data_dir: DataDir, num_lines: int):
+    rng = random.Random(42)
+    vocab_tokens = ["<unk>", "<s>", "</s>"] + [f"▁tok{i}" for i in range(40)]
+    data_dir.create_file("vocab.txt", "".join(f"{token}\t0\n" for token in vocab_tokens))
+
+    lex_lines = []
+    # extract_lex writes every pair once.
+    all_pairs = [(trg, src) for trg in vocab_tokens for src in vocab_tokens]
+    for trg, src in rng.sample(all_pairs, num_lines):
+        # Some probabilities are repeated to test the ties.
+        prob = rng.choice([0.5, 0.25, rng.random()])
+        lex_lines.append(f"{trg} {src} {prob:.6f}\n")
+    lex_lines += ["NULL ▁tok1 0.5\n", "▁tok1 NULL 0.5\n", "▁broken 0.5\n", "▁oov ▁tok2 0.9\n"]
+    data_dir.create_zst("lex.s2t.zst", "".join(lex_lines))
+    return lex_lines, vocab_tokens
+
+
+@pytest.mark.parametrize("batch_lines", [1_000_000, 7])
+def test_prune_shortlist(data_dir, monkeypatch, batch_lines):
+    monkeypatch.setattr("pipeline.alignments.prune_shortlist.BATCH_LINES", batch_lines)
+    lex_lines, vocab_tokens = create_lexicon(data_dir, num_lines=1500)
+
+    prune_shortlist(
+        lex_path=data_dir.join("lex.s2t.zst"),
+        vocab_path=data_dir.join("vocab.txt"),
+        output_path=data_dir.join("lex.s2t.pruned.zst"),
+        top_k=5,
+    )
+
+    output = data_dir.read_text("lex.s2t.pruned.zst").splitlines()
+    expected = prune_with_dicts(lex_lines, vocab_tokens, top_k=5)
+    # The sources were written in the order of a set, now they follow the vocab.
+    assert group_by_source(output) == group_by_source(expected)
+    assert [line.split()[1] for line in output] == sorted(
+        (line.split()[1] for line in output),
+        key=lambda src: vocab_tokens.index(src) if src in vocab_tokens else len(vocab_tokens),
+    )
+
+
+def test_prune_binary_shortlist(data_dir):
+    vocab_tokens = ["<unk>", "<s>", "</s>"] + [f"▁tok{i}" for i in range(40)]
+    data_dir.create_file("vocab.txt", "".join(f"{token}\t0\n" for token in vocab_tokens))
+    data_dir.create_zst(
+        "lex.s2t.zst",
+        "▁tok1 ▁tok0 0.1\n▁tok2 ▁tok0 0.7\n▁tok3 ▁tok0 0.7\n<s> ▁tok0 0.9\n▁tok5 ▁tok4 0.3\n",
+    )
+
+    prune_shortlist(
+        lex_path=data_dir.join("lex.s2t.zst"),
+        vocab_path=data_dir.join("vocab.txt"),
+        output_path=None,
+        top_k=100,
+        binary_output_path=data_dir.join("lex.bin"),
+        binary_first_num=10,
+        binary_best_num=2,
+    )
+
+    with open(data_dir.join("lex.bin"), "rb") as file:
+        data = file.read()
+    magic, checksum, first_num, best_num, offsets_size, short_lists_size = np.frombuffer(
+        data[:48], dtype=np.uint64
+    ).tolist()
+    vocab_size = 43
+    assert magic == BINARY_SHORTLIST_MAGIC
+    assert (first_num, best_num, offsets_size, short_lists_size) == (10, 2, vocab_size + 1, 3)
+    assert checksum == hash_words(np.frombuffer(data[16 : len(data) // 8 * 8], dtype=np.uint64))
+
+    offsets = np.frombuffer(data[48 : 48 + offsets_size * 8], dtype=np.uint64).tolist()
+    short_lists = np.frombuffer(data[48 + offsets_size * 8 :], dtype=np.uint32).tolist()
+    tok0, tok3, tok4, tok5 = 3, 6, 7, 8
+    assert offsets[tok0 : tok0 + 2] == [0, 2]
+    assert offsets[tok4 : tok4 + 2] == [2, 3]
+    assert offsets[-1] == 3
+    # <s> has the best probability, and the tie is broken by the larger id.
+    assert short_lists == [1, tok3, tok5]
+
+
+def test_prune_binary_shortlist_matches_marian_conv(data_dir):
+    """
+    Compare with the binary shortlist that marian-conv wrote for the same lexicon, see
+    tests/data/shortlist/README.md
+    """
+    sp = spm.SentencePieceProcessor(model_file="tests/data/vocab.spm")
+    data_dir.create_file(
+        "vocab.txt", "".join(f"{sp.id_to_piece(i)}\t0\n" for i in range(sp.get_piece_size()))
+    )
+
+    prune_shortlist(
+        lex_path="tests/data/shortlist/lex.s2t.zst",
+        vocab_path=data_dir.join("vocab.txt"),
+        output_path=None,
+        top_k=100,
+        binary_output_path=data_dir.join("lex.s2t.bin"),
+        binary_first_num=10,
+        binary_best_num=5,
+    )
+
+    with open(data_dir.join("lex.s2t.bin"), "rb") as file:
+        actual = file.read()
+    with open("tests/data/shortlist/lex.s2t.bin", "rb") as file:
+        expected = file.read()
+    assert actual == expected
@@ -0,0 +1,181 @@
+import multiprocessing
+import os
+import random
+from collections import Counter, defaultdict
+
+import pytest
+from fixtures import DataDir, en_sample, ru_sample
+
+from pipeline.alignments.prune_shortlist import Vocab
+from pipeline.alignments.shortlist import (
+    _init_worker,
+    count_and_prune,
+    encode_corpus,
+    extract_lex_and_prune,
+    load_vocab,
+)
+
+extract_lex_path = os.path.join(os.getenv("BIN", "bin"), "extract_lex")
+
+vocab_tokens = ["<unk>", "<s>", "</s>"] + [f"▁tok{i}" for i in range(30)]
+
+
+@pytest.fixture
+def data_dir():
+    return DataDir("test_shortlist_builder")
+
+
+def emulate_extract_lex_and_prune(src_lines, trg_lines, aln_lines, top_k: int) -> list[str]:
+    """
+    What extract_lex and prune_shortlist.py did together. The ties of the probabilities are
+    broken by the target id here, as extract_lex wrote them out in an arbitrary order.
+    """
+    counts: dict[int, Counter] = defaultdict(Counter)
+    for src_line, trg_line, aln_line in zip(src_lines, trg_lines, aln_lines):
+        src = [int(token) for token in src_line.split()]
+        trg = [int(token) for token in trg_line.split()]
+        aligned = set()
+        for pair in aln_line.split():
+            i, j = map(int, pair.split("-"))
+            if i >= len(src) or j >= len(trg):
+                continue
+            aligned.add(i)
+            counts[src[i]][trg[j]] += 1
+        for i, token in enumerate(src):
+            if i not in aligned:
+                counts[token]["NULL"] += 1
+
+    output = []
+    tops = list(range(top_k + 2))
+    for src_id in sorted(counts):
+        total = sum(counts[src_id].values())
+        probs = {trg: count / total for trg, count in counts[src_id].items() if trg != "NULL"}
+        top_src = sorted(probs, key=lambda trg: (-probs[trg], trg))[:top_k]
+        for trg_id in top_src + tops:
+            if trg_id in probs:
+                output.append(f"{vocab_tokens[trg_id]} {vocab_tokens[src_id]} {probs[trg_id]:.8f}")
+    return output
+
+
+@pytest.mark.parametrize("num_workers", [1, 3])
+def test_count_and_prune(data_dir, monkeypatch, num_workers):
+    monkeypatch.setattr("pipeline.alignments.shortlist.BATCH_LINES", 7)
+    monkeypatch.setattr("pipeline.alignments.shortlist.COMPACT_PAIRS", 20)
+    rng = random.Random(1)
+    src_lines, trg_lines, aln_lines = [], [], []
+    for _ in range(100):
+        src = [rng.randrange(len(vocab_tokens)) for _ in range(rng.randint(0, 8))]
+        trg = [rng.randrange(len(vocab_tokens)) for _ in range(rng.randint(0, 8))]
+        pairs = {
+            (rng.randrange(len(src)), rng.randrange(len(trg)))
+            for _ in range(min(len(src), len(trg)))
+        }
+        src_lines.append(" ".join(map(str, src)) + "\n")
+        trg_lines.append(" ".join(map(str, trg)) + "\n")
+        aln_lines.append(" ".join(f"{i}-{j}" for i, j in sorted(pairs)) + "\n")
+    # An alignment that is out of bounds is skipped.
+    src_lines.append("3 4\n")
+    trg_lines.append("5\n")
+    aln_lines.append("0-0 1-1\n")
+
+    data_dir.create_zst("corpus.src.zst", "".join(src_lines))
+    data_dir.create_zst("corpus.trg.zst", "".join(trg_lines))
+    data_dir.create_zst("corpus.aln.zst", "".join(aln_lines))
+
+    count_and_prune(
+        data_dir.join("corpus.src.zst"),
+        data_dir.join("corpus.trg.zst"),
+        data_dir.join("corpus.aln.zst"),
+        Vocab(vocab_tokens),
+        data_dir.join("lex.s2t.pruned.zst"),
+        top_k=3,
+        num_workers=num_workers,
+    )
+
+    assert data_dir.read_text("lex.s2t.pruned.zst").splitlines() == emulate_extract_lex_and_prune(
+        src_lines, trg_lines, aln_lines, top_k=3
+    )
+
+
+def test_encode_corpus(data_dir):
+    vocab_path = "tests/data/vocab.spm"
+    data_dir.create_zst("corpus.en.zst", "Hello world\n\nThe second line\n")
+
+    vocab = load_vocab(vocab_path)
+    with multiprocessing.Pool(
+        processes=2, initializer=_init_worker, initargs=(vocab_path,)
+    ) as pool:
+        encode_corpus(pool, data_dir.join("corpus.en.zst"), data_dir.join("corpus.spm.zst"))
+
+    lines = data_dir.read_text("corpus.spm.zst").splitlines()
+    assert len(lines) == 3
+    assert lines[1] == ""
+    pieces = [vocab.tokens[int(token_id)] for token_id in lines[0].split()]
+    assert "".join(pieces).replace("▁", " ").strip() == "Hello world"
+
+
+def read_probs(lines: list[str], tokens: list[str]) -> dict[tuple[str, str], float]:
+    """Read lines of "trg src prob" to a dict, mapping the ids to the pieces with the tokens."""
+    probs = {}
+    for line in lines:
+        trg, src, prob = line.split()
+        if trg == "NULL" or src == "NULL":
+            continue
+        if tokens:
+            trg, src = tokens[int(trg)], tokens[int(src)]
+        probs[(trg, src)] = float(prob)
+    return probs
+
+
+@pytest.mark.skipif(not os.path.exists(extract_lex_path), reason="extract_lex is needed")
+def test_count_and_prune_matches_extract_lex(data_dir):
+    vocab_path = "tests/data/vocab.spm"
+    vocab = load_vocab(vocab_path)
+    data_dir.create_zst("corpus.en.zst", en_sample)
+    data_dir.create_zst("corpus.ru.zst", ru_sample)
+    with multiprocessing.Pool(
+        processes=2, initializer=_init_worker, initargs=(vocab_path,)
+    ) as pool:
+        encode_corpus(pool, data_dir.join("corpus.en.zst"), data_dir.join("corpus.spm.en.zst"))
+        encode_corpus(pool, data_dir.join("corpus.ru.zst"), data_dir.join("corpus.spm.ru.zst"))
+
+    # Alignments near the diagonal, with some that are out of bounds and some unaligned tokens.
+    rng = random.Random(3)
+    aln_lines = []
+    src_lines = data_dir.read_text("corpus.spm.en.zst").splitlines()
+    trg_lines = data_dir.read_text("corpus.spm.ru.zst").splitlines()
+    for src_line, trg_line in zip(src_lines, trg_lines):
+        src_len = len(src_line.split())
+        trg_len = len(trg_line.split())
+        pairs = {
+            (i, min(trg_len, i * trg_len // src_len + rng.randint(-1, 1)))
+            for i in range(src_len)
+            if rng.random() < 0.8
+        }
+        aln_lines.append(" ".join(f"{i}-{j}" for i, j in sorted(pairs) if j >= 0) + "\n")
+    data_dir.create_zst("corpus.aln.zst", "".join(aln_lines))
+    paths = [data_dir.join(name) for name in ("corpus.spm.en.zst", "corpus.spm.ru.zst")]
+    paths.append(data_dir.join("corpus.aln.zst"))
+
+    tmp_dir = data_dir.mkdir("tmp")
+    extract_lex_and_prune(
+        extract_lex_path, *paths, vocab, data_dir.join("extract_lex.pruned.zst"), 100, tmp_dir
+    )
+    # Keeping every target gives the whole lexicon.
+    count_and_prune(*paths, vocab, data_dir.join("lex.s2t.zst"), vocab.size, num_workers=2)
+    count_and_prune(*paths, vocab, data_dir.join("lex.s2t.pruned.zst"), 100, num_workers=2)
+
+    with open(os.path.join(tmp_dir, "lex.s2t"), encoding="utf-8") as lex_file:
+        expected_lex = read_probs(lex_file.read().splitlines(), vocab.tokens)
+    actual_lex = read_probs(data_dir.read_text("lex.s2t.zst").splitlines(), [])
+    assert actual_lex == pytest.approx(expected_lex, rel=1e-5)
+
+    expected_pruned = data_dir.read_text("extract_lex.pruned.zst").splitlines()
+    actual_pruned = data_dir.read_text("lex.s2t.pruned.zst").splitlines()
+    # extract_lex writes the ties in an arbitrary order.
+    assert sorted(line.split()[:2] for line in actual_pruned) == sorted(
+        line.split()[:2] for line in expected_pruned
+    )
+    assert read_probs(actual_pruned, []) == pytest.approx(
+        read_probs(expected_pruned, []), rel=1e-5
+    )
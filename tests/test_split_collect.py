@@ -1,14 +1,19 @@
 import glob
+import os
 import random
 import shutil
 import string
-import subprocess
+from pathlib import Path
 
 import pytest
 import sh
 from fixtures import DataDir
 
 from pipeline.common.datasets import decompress
+from pipeline.translate.collect import ChunkStats
+from pipeline.translate.collect import main as collect
+from pipeline.translate import splitter
+from pipeline.translate.splitter import Budget, SplitStats, estimate_file, measure_file
 from pipeline.translate.splitter import main as split_file
 
 
@@ -17,14 +22,15 @@ def data_dir():
     return DataDir("test_split_collect")
 
 
-def generate_dataset(length, path):
+def generate_dataset(length, path, seed=None):
+    rng = random.Random(seed)
     words = [
-        "".join([random.choice(string.ascii_letters) for _ in range(random.randint(1, 10))])
+        "".join([rng.choice(string.ascii_letters) for _ in range(rng.randint(1, 10))])
         for _ in range(20)
     ]
     sentences = []
     for i in range(length):
-        sentence = " ".join([words[random.randint(0, 19)] for _ in range(random.randint(1, 200))])
+        sentence = " ".join([words[rng.randint(0, 19)] for _ in range(rng.randint(1, 200))])
         sentences.append(sentence)
 
     with open(path, "w") as f:
@@ -63,11 +69,21 @@ def test_split_collect_mono(data_dir):
     # file.1.zst, file.2.zst ... file.10.zst
     expected_files = set([data_dir.join(f"file.{i}.zst") for i in range(1, 11)])
     assert set(glob.glob(data_dir.join("file.*.zst"))) == expected_files
+    # The splitter records the lines of every chunk, e.g. file.1.stats.json
+    chunk_lines = [SplitStats.load_lines(Path(path)) for path in sorted(expected_files)]
+    assert chunk_lines == [
+        len(data_dir.read_text(os.path.basename(path)).splitlines())
+        for path in sorted(expected_files)
+    ]
+    assert sum(chunk_lines) == length
 
     imitate_translate(data_dir.path, suffix=".out")
-    subprocess.run(
-        ["pipeline/translate/collect.sh", data_dir.path, output_compressed, f"{path}.zst"],
-        check=True,
+    collect(
+        [
+            f"--chunks_dir={data_dir.path}",
+            f"--output_path={output_compressed}",
+            f"--mono_path={path}.zst",
+        ]
     )
 
     decompress(output_compressed)
@@ -107,10 +123,239 @@ def test_split_collect_corpus(data_dir):
     assert set(glob.glob(data_dir.join("file.*.zst"))) == expected_files
 
     imitate_translate(data_dir.path, suffix=".nbest.out")
-    subprocess.run(
-        ["pipeline/translate/collect.sh", data_dir.path, output_compressed, f"{path_src}.zst"],
-        check=True,
+    collect(
+        [
+            f"--chunks_dir={data_dir.path}",
+            f"--output_path={output_compressed}",
+            f"--mono_path={path_src}.zst",
+        ]
     )
 
     decompress(output_compressed)
     assert read_file(path_src) == read_file(output)
+
+
+def imitate_translate_compressed(dir, lines_delta=0):
+    """
+    Copy the compressed chunks as the translate step would output them, including the
+    recorded line counts.
+    """
+    for file in glob.glob(f"{dir}/file.?.zst") + glob.glob(f"{dir}/file.??.zst"):
+        output_path = file.replace(".zst", ".out.zst")
+        shutil.copy(file, output_path)
+        line_count = len(read_file(decompress(file)).splitlines())
+        ChunkStats(
+            output_path, input_lines=line_count, output_lines=line_count + lines_delta
+        ).save_json()
+
+
+@pytest.mark.parametrize("split_stats", [True, False])
+def test_split_collect_mono_compressed(data_dir, monkeypatch, split_stats):
+    length = 1234
+    path = data_dir.join("mono.in")
+    output = data_dir.join("mono.output")
+    output_compressed = f"{output}.zst"
+    generate_dataset(length, path)
+
+    split_file([f"--output_dir={data_dir.path}", "--num_parts=10", f"{path}.zst"])
+    imitate_translate_compressed(data_dir.path)
+    if not split_stats:
+        # The input lines that the translate step recorded are used instead.
+        for i in range(1, 11):
+            os.remove(data_dir.join(f"file.{i}.stats.json"))
+
+    assert os.path.exists(data_dir.join("file.1.out.stats.json"))
+
+    def count_lines_parallel(paths):
+        raise AssertionError(f"The lines were counted in {paths}")
+
+    monkeypatch.setattr("pipeline.translate.collect.count_lines_parallel", count_lines_parallel)
+    collect(
+        [
+            f"--chunks_dir={data_dir.path}",
+            f"--output_path={output_compressed}",
+            f"--mono_path={path}.zst",
+        ]
+    )
+
+    decompress(output_compressed)
+    assert read_file(path) == read_file(output)
+
+
+def test_collect_mismatched_counts(data_dir):
+    length = 100
+    path = data_dir.join("mono.in")
+    generate_dataset(length, path)
+
+    split_file([f"--output_dir={data_dir.path}", "--num_parts=3", f"{path}.zst"])
+    imitate_translate_compressed(data_dir.path, lines_delta=-1)
+
+    with pytest.raises(Exception, match="input lines"):
+        collect(
+            [
+                f"--chunks_dir={data_dir.path}",
+                f"--output_path={data_dir.join('mono.output.zst')}",
+                f"--mono_path={path}.zst",
+            ]
+        )
+
+
+def test_collect_missing_chunk(data_dir):
+    length = 100
+    path = data_dir.join("mono.in")
+    generate_dataset(length, path)
+
+    split_file([f"--output_dir={data_dir.path}", "--num_parts=3", f"{path}.zst"])
+    imitate_translate_compressed(data_dir.path)
+    os.remove(data_dir.join("file.2.out.zst"))
+
+    with pytest.raises(Exception, match=r"Chunks are missing .*\[2\]"):
+        collect(
+            [
+                f"--chunks_dir={data_dir.path}",
+                f"--output_path={data_dir.join('mono.output.zst')}",
+                f"--mono_path={path}.zst",
+            ]
+        )
+
+
+@pytest.mark.parametrize("budget", ["lines", "bytes", "tokens"])
+def test_split_paired_corpus(data_dir, budget):
+    length = 1234
+    path_src = data_dir.join("corpus.src.in")
+    path_trg = data_dir.join("corpus.trg.in")
+    path_aln = data_dir.join("corpus.aln.in")
+    generate_dataset(length, path_src, seed=1)
+    generate_dataset(length, path_trg, seed=2)
+    generate_dataset(length, path_aln, seed=3)
+
+    split_file(
+        [
+            f"--output_dir={data_dir.path}",
+            "--num_parts=10",
+            f"--budget={budget}",
+            f"--ref_path={path_trg}.zst",
+            f"--aln_path={path_aln}.zst",
+            f"{path_src}.zst",
+        ]
+    )
+
+    # file.1.zst, file.1.ref.zst, file.1.aln.zst ... file.10.aln.zst
+    expected_files = set(
+        data_dir.join(f"file.{i}{suffix}.zst")
+        for i in range(1, 11)
+        for suffix in ["", ".ref", ".aln"]
+    )
+    assert set(glob.glob(data_dir.join("file.*.zst"))) == expected_files
+
+    for suffix, path in [("", path_src), (".ref", path_trg), (".aln", path_aln)]:
+        chunks = [
+            read_file(decompress(data_dir.join(f"file.{i}{suffix}.zst"))) for i in range(1, 11)
+        ]
+        assert "".join(chunks) == read_file(path), "The chunks concatenate to the original"
+
+    for i in range(1, 11):
+        src_lines = read_file(data_dir.join(f"file.{i}")).splitlines()
+        trg_lines = read_file(data_dir.join(f"file.{i}.ref")).splitlines()
+        assert len(src_lines) == len(trg_lines), "The chunks are split on the same lines"
+
+    if budget == "bytes":
+        sizes = [os.path.getsize(data_dir.join(f"file.{i}")) for i in range(1, 11)]
+        # A line goes to the chunk that its start falls in, so every chunk starts and ends
+        # within a line of its share of the bytes.
+        max_line = max(len(line) + 1 for line in read_file(path_src).splitlines())
+        share = os.path.getsize(path_src) / 10
+        for size in sizes:
+            assert abs(size - share) < max_line, "The chunks have a balanced size"
+
+
+@pytest.mark.parametrize("budget", list(Budget))
+def test_split_estimated_total(data_dir, monkeypatch, budget):
+    path = data_dir.join("mono.in")
+    generate_dataset(5000, path, seed=4)
+    # Only read half of the compressed file to estimate the total. The sample is decompressed
+    # in whole zstd blocks, which are large compared to the file.
+    monkeypatch.setattr(splitter, "SAMPLE_BYTES", os.path.getsize(f"{path}.zst") // 2)
+
+    total = measure_file(f"{path}.zst", budget)
+    assert estimate_file(f"{path}.zst", budget) == pytest.approx(total, rel=0.1)
+
+    split_file(
+        [
+            f"--output_dir={data_dir.path}",
+            "--num_parts=10",
+            f"--budget={budget.value}",
+            f"{path}.zst",
+        ]
+    )
+    chunks = [read_file(decompress(data_dir.join(f"file.{i}.zst"))) for i in range(1, 11)]
+    assert "".join(chunks) == read_file(path), "The chunks concatenate to the original"
+    assert all(chunks), "Every chunk gets some of the lines"
+
+
+def test_split_round_robin(data_dir):
+    length = 100
+    path = data_dir.join("mono.in")
+    generate_dataset(length, path)
+
+    split_file([f"--output_dir={data_dir.path}", "--num_parts=3", "--round_robin", f"{path}.zst"])
+
+    lines = read_file(path).split("\n")
+    for i in range(3):
+        chunk_lines = read_file(decompress(data_dir.join(f"file.{i + 1}.zst"))).split("\n")
+        assert [line for line in chunk_lines if line] == lines[i::3]
+
+
+def test_collect_round_robin(data_dir):
+    path = data_dir.join("mono.in")
+    generate_dataset(100, path)
+
+    split_file([f"--output_dir={data_dir.path}", "--num_parts=3", "--round_robin", f"{path}.zst"])
+    assert SplitStats.load(Path(data_dir.join("file.1.zst"))).round_robin
+    imitate_translate_compressed(data_dir.path)
+
+    with pytest.raises(Exception, match="split round-robin"):
+        collect(
+            [
+                f"--chunks_dir={data_dir.path}",
+                f"--output_path={data_dir.join('mono.output.zst')}",
+                f"--mono_path={path}.zst",
+            ]
+        )
+
+
+def test_split_mismatched_corpus(data_dir):
+    path_src = data_dir.join("corpus.src.in")
+    path_trg = data_dir.join("corpus.trg.in")
+    generate_dataset(100, path_src)
+    generate_dataset(99, path_trg)
+
+    with pytest.raises(Exception, match="different number of lines"):
+        split_file(
+            [
+                f"--output_dir={data_dir.path}",
+                "--num_parts=3",
+                f"--ref_path={path_trg}.zst",
+                f"{path_src}.zst",
+            ]
+        )
+
+
+def test_collect_missing_last_chunk(data_dir):
+    length = 100
+    path = data_dir.join("mono.in")
+    generate_dataset(length, path)
+
+    split_file([f"--output_dir={data_dir.path}", "--num_parts=3", f"{path}.zst"])
+    imitate_translate_compressed(data_dir.path)
+    # The remaining chunks have no gaps, and their recorded line counts match.
+    os.remove(data_dir.join("file.3.out.zst"))
+
+    with pytest.raises(Exception, match=r"split into 3 chunks, but 2 chunks were found"):
+        collect(
+            [
+                f"--chunks_dir={data_dir.path}",
+                f"--output_path={data_dir.join('mono.output.zst')}",
+                f"--mono_path={path}.zst",
+            ]
+        )
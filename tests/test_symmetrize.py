@@ -0,0 +1,140 @@
+import os
+import random
+
+import pytest
+import zstandard
+
+from pipeline.alignments.symmetrize import (
+    Heuristic,
+    symmetrize,
+    symmetrize_batch,
+    symmetrize_with_atools,
+)
+
+atools_path = os.path.join(os.getenv("BIN", "bin"), "atools")
+
+# Forward alignments, reverse alignments, and the expected results per heuristic.
+lines = [
+    # Both directions agree.
+    ("0-0 1-1", "0-0 1-1"),
+    # The neighbors of the intersection are added.
+    ("0-0 1-1 2-1", "0-0 1-1 1-2"),
+    # 2-2 is not a neighbor of the intersection, but aligns two unaligned words.
+    ("0-0 2-2", "0-0"),
+    # 0-2 is not a neighbor of the intersection, and only aligns one unaligned word.
+    ("0-0 0-2", "0-0"),
+    # The pairs are not ordered in the input.
+    ("1-0 0-1", "0-1 1-0"),
+    # Empty lines.
+    ("", ""),
+    ("0-0", ""),
+]
+
+expected = {
+    Heuristic.intersect: ["0-0 1-1", "0-0 1-1", "0-0", "0-0", "0-1 1-0", "", ""],
+    Heuristic.union: ["0-0 1-1", "0-0 1-1 1-2 2-1", "0-0 2-2", "0-0 0-2", "0-1 1-0", "", "0-0"],
+    Heuristic.grow_diag: ["0-0 1-1", "0-0 1-1 1-2 2-1", "0-0", "0-0", "0-1 1-0", "", ""],
+    Heuristic.grow_diag_final: [
+        "0-0 1-1",
+        "0-0 1-1 1-2 2-1",
+        "0-0 2-2",
+        "0-0 0-2",
+        "0-1 1-0",
+        "",
+        "0-0",
+    ],
+    Heuristic.grow_diag_final_and: [
+        "0-0 1-1",
+        "0-0 1-1 1-2 2-1",
+        "0-0 2-2",
+        "0-0",
+        "0-1 1-0",
+        "",
+        "0-0",
+    ],
+}
+
+
+@pytest.mark.parametrize("heuristic", list(Heuristic))
+def test_symmetrize_batch(heuristic: Heuristic):
+    fwd_lines = [fwd + "\n" for fwd, _ in lines]
+    rev_lines = [rev + "\n" for _, rev in lines]
+
+    num_lines, output = symmetrize_batch((heuristic, fwd_lines, rev_lines))
+
+    assert num_lines == len(lines)
+    assert output.decode("utf-8").split("\n")[:-1] == expected[heuristic]
+
+
+def test_grow_diag_chain():
+    # Each added point makes the next one a neighbor, so they are all added in one pass.
+    _, output = symmetrize_batch(
+        (Heuristic.grow_diag, ["0-0 1-1 2-2 3-3\n"], ["0-0 0-1 1-2 2-3\n"])
+    )
+    assert output == b"0-0 0-1 1-1 1-2 2-2 2-3 3-3\n"
+
+
+def test_symmetrize_mismatched_lines():
+    with pytest.raises(ValueError, match="different number of lines"):
+        symmetrize_batch((Heuristic.union, ["0-0\n", "0-0\n"], ["0-0\n"]))
+
+
+def test_symmetrize_compressed(tmp_path, monkeypatch):
+    monkeypatch.setattr("pipeline.alignments.symmetrize.BATCH_LINES", 3)
+    fwd_path = tmp_path / "aln.fwd"
+    rev_path = tmp_path / "aln.rev"
+    output_path = tmp_path / "corpus.aln.zst"
+    fwd_path.write_text("".join(fwd + "\n" for fwd, _ in lines))
+    rev_path.write_text("".join(rev + "\n" for _, rev in lines))
+
+    symmetrize(str(fwd_path), str(rev_path), str(output_path), num_workers=2)
+
+    with open(output_path, "rb") as file:
+        output = zstandard.ZstdDecompressor().stream_reader(file).read().decode("utf-8")
+    assert output.split("\n")[:-1] == expected[Heuristic.grow_diag_final_and]
+
+
+def generate_alignments(num_lines: int) -> tuple[str, str]:
+    """
+    Random forward and reverse alignments shaped like the fast_align output, where every word
+    on the aligned side has at most one link. The directions mostly agree, like real ones.
+    """
+    rng = random.Random(7)
+    fwd_lines = []
+    rev_lines = []
+    for _ in range(num_lines):
+        src_len = rng.randint(1, 12)
+        trg_len = rng.randint(1, 12)
+        diagonal = {j: min(src_len - 1, j * src_len // trg_len) for j in range(trg_len)}
+        fwd = []
+        for j in range(trg_len):
+            if rng.random() < 0.9:
+                i = diagonal[j] if rng.random() < 0.7 else rng.randrange(src_len)
+                fwd.append((i, j))
+        rev = []
+        for i in range(src_len):
+            if rng.random() < 0.9:
+                near = [j for j, diagonal_i in diagonal.items() if diagonal_i == i]
+                j = rng.choice(near) if near and rng.random() < 0.7 else rng.randrange(trg_len)
+                rev.append((i, j))
+        fwd_lines.append(" ".join(f"{i}-{j}" for i, j in fwd) + "\n")
+        rev_lines.append(" ".join(f"{i}-{j}" for i, j in rev) + "\n")
+    return "".join(fwd_lines), "".join(rev_lines)
+
+
+@pytest.mark.skipif(not os.path.exists(atools_path), reason="atools from fast_align is needed")
+@pytest.mark.parametrize("heuristic", list(Heuristic))
+def test_symmetrize_matches_atools(tmp_path, heuristic: Heuristic):
+    fwd_path = tmp_path / "aln.fwd"
+    rev_path = tmp_path / "aln.rev"
+    fwd_text, rev_text = generate_alignments(5000)
+    fwd_path.write_text(fwd_text)
+    rev_path.write_text(rev_text)
+
+    symmetrize_with_atools(
+        atools_path, str(fwd_path), str(rev_path), str(tmp_path / "atools.aln"), heuristic
+    )
+    symmetrize(str(fwd_path), str(rev_path), str(tmp_path / "numpy.aln"), heuristic)
+
+    # The points are compared as written, so the order that grow-diag adds them in counts too.
+    assert (tmp_path / "numpy.aln").read_text() == (tmp_path / "atools.aln").read_text()
@@ -1,3 +1,5 @@
+import os
+
 import pytest
 
 from pipeline.alignments.tokenizer import IcuTokenizer, TokenizerType, tokenize
@@ -170,3 +172,86 @@ def test_icu_tokens(lang, text, expected_tokenized):
     tokenized = " ".join(tokens)
 
     assert expected_tokenized == tokenized
+
+
+@pytest.mark.parametrize(
+    "lang,text,expected_indices",
+    [
+        ("en", "Hello, world!", [0, 0, -1, 1, 1]),
+        ("en", "  Leading  spaces", [-1, 0, -1, 1]),
+        ("zh", "这是一个简单的测试语句 🤣 。", [0, 0, 0, 0, 0, 0, 0, 0, -1, 1, 2]),
+    ],
+    ids=["en", "en_spaces", "zh"],
+)
+def test_icu_word_indices(lang, text, expected_indices):
+    tokens, word_indices = IcuTokenizer(lang).tokenize_with_word_indices(text)
+
+    assert tokens == IcuTokenizer(lang).tokenize(text)
+    assert word_indices == expected_indices
+    assert len(set(index for index in word_indices if index >= 0)) == len(text.split())
+
+
+def test_tokenizer_compressed():
+    data_dir = DataDir("test_tokenizer")
+    input_path = data_dir.create_zst("input.en.zst", en_sample)
+    output_path = data_dir.join("output.en.zst")
+    word_indices_path = data_dir.join("output.word-indices.en.zst")
+
+    tokenize(
+        input_path=input_path,
+        output_path=output_path,
+        lang="en",
+        tokenizer=TokenizerType.sacre_moses,
+        sentences_per_chunk=100,
+        word_indices_path=word_indices_path,
+    )
+
+    lines = data_dir.read_text("output.en.zst").splitlines()
+    word_indices = data_dir.read_text("output.word-indices.en.zst").splitlines()
+
+    assert len(lines) == len(en_sample.splitlines())
+    assert len(word_indices) == len(lines)
+    assert lines[0].startswith("The little girl , seeing")
+    assert word_indices[0].startswith("0 1 2 2 3")
+    for line, indices in zip(lines, word_indices):
+        assert len(line.split()) == len(indices.split())
+
+
+def test_tokenization_cache(monkeypatch):
+    """
+    A corpus that contains an already tokenized corpus only tokenizes the new chunks.
+    """
+    monkeypatch.setattr("pipeline.alignments.tokenizer.CACHE_CHUNK_LINES", 3)
+    data_dir = DataDir("test_tokenizer")
+    cache_dir = data_dir.join("tokenization-cache")
+    original = [f"Line {i}, from the original corpus." for i in range(50)]
+    extended = original + [f"Line {i}, from the new data." for i in range(10)]
+    data_dir.create_zst("original.en.zst", "\n".join(original) + "\n")
+    data_dir.create_zst("extended.en.zst", "\n".join(extended) + "\n")
+
+    def run_tokenize(name, cache_dir):
+        tokenize(
+            input_path=data_dir.join(f"{name}.en.zst"),
+            output_path=data_dir.join(f"{name}.tok.en.zst"),
+            lang="en",
+            tokenizer=TokenizerType.sacre_moses,
+            word_indices_path=data_dir.join(f"{name}.word-indices.en.zst"),
+            cache_dir=cache_dir,
+        )
+        return (
+            data_dir.read_text(f"{name}.tok.en.zst"),
+            data_dir.read_text(f"{name}.word-indices.en.zst"),
+        )
+
+    original_tokenized = run_tokenize("original", cache_dir)
+    cached_chunks = set(os.listdir(cache_dir))
+    assert cached_chunks, "Chunks were added to the cache"
+
+    # Tokenize the corpus again, the cache is not modified.
+    assert run_tokenize("original", cache_dir) == original_tokenized
+    assert set(os.listdir(cache_dir)) == cached_chunks
+
+    extended_tokenized = run_tokenize("extended", cache_dir)
+    assert extended_tokenized == run_tokenize("extended", cache_dir=None)
+    new_chunks = set(os.listdir(cache_dir)) - cached_chunks
+    assert 0 < len(new_chunks) < len(cached_chunks), "Only the new chunks were tokenized"
@@ -0,0 +1,66 @@
+import gzip
+from pathlib import Path
+
+import pytest
+from fixtures import DataDir
+
+from pipeline.train.train import Reservoir, build_dataset_tsv
+
+src_lines = ["Hello world.", " Padded sentence. ", "No alignment.", "Last line."]
+trg_lines = ["Hola mundo.", "Frase rellenada.", "Sin alineación.", "Última línea."]
+aln_lines = ["0-0 1-1", "0-0 1-1", "", " 0-0 "]
+
+
+@pytest.mark.parametrize("batch_lines", [1, 3, 10_000])
+@pytest.mark.parametrize("with_alignments", [True, False])
+def test_build_dataset_tsv(monkeypatch, batch_lines: int, with_alignments: bool):
+    monkeypatch.setattr("pipeline.train.train.TSV_BATCH_LINES", batch_lines)
+    data_dir = DataDir("test_train_tsv")
+    data_dir.create_zst("corpus.en.zst", "\n".join(src_lines) + "\n")
+    data_dir.create_zst("corpus.es.zst", "\n".join(trg_lines) + "\n")
+    alignments = None
+    if with_alignments:
+        data_dir.create_zst("corpus.aln.zst", "\n".join(aln_lines) + "\n")
+        alignments = Path(data_dir.join("corpus.aln.zst"))
+
+    tsv_path = build_dataset_tsv(data_dir.join("corpus"), "en", "es", alignments, threads=2)
+
+    assert tsv_path == Path(data_dir.join("corpus.enes.tsv.gz"))
+    with gzip.open(tsv_path, "rt", encoding="utf-8") as file:
+        rows = [line.rstrip("\n").split("\t") for line in file]
+    if with_alignments:
+        assert rows == [
+            ["Hello world.", "Hola mundo.", "0-0 1-1"],
+            ["Padded sentence.", "Frase rellenada.", "0-0 1-1"],
+            ["Last line.", "Última línea.", "0-0"],
+        ]
+    else:
+        assert rows == [[src.strip(), trg] for src, trg in zip(src_lines, trg_lines)]
+    # The original files are removed.
+    assert not Path(data_dir.join("corpus.en.zst")).exists()
+    assert not Path(data_dir.join("corpus.es.zst")).exists()
+    assert not Path(data_dir.join("corpus.aln.zst")).exists()
+
+
+def test_reservoir():
+    reservoir = Reservoir(10)
+    for i in range(1000):
+        reservoir.add(i)
+
+    assert reservoir.count == 1000
+    assert len(reservoir.samples) == 10
+    assert len(set(reservoir.samples)) == 10
+    assert all(0 <= sample < 1000 for sample in reservoir.samples)
+
+
+def test_build_dataset_tsv_unicode_whitespace():
+    data_dir = DataDir("test_train_tsv")
+    # The lines are stripped of Unicode whitespace, and a lone "\r" is a line break like in
+    # read_lines.
+    data_dir.create_zst("devset.zh.zst", "\u3000你好\xa0\nx\u2028\nfirst\rsecond\n")
+    data_dir.create_zst("devset.en.zst", "\xa0Hello\u3000\ny\n a\nb\n")
+
+    tsv_path = build_dataset_tsv(data_dir.join("devset"), "zh", "en", threads=2)
+
+    with gzip.open(tsv_path, "rt", encoding="utf-8", newline="\n") as file:
+        assert file.read() == "你好\tHello\nx\ty\nfirst\ta\nsecond\tb\n"
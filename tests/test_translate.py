@@ -5,6 +5,7 @@ import shutil
 import pytest
 from fixtures import DataDir, en_sample
 from pipeline.common.marian import marian_args_to_dict
+from pipeline.translate.nbest import read_nbest
 
 fixtures_path = Path(__file__).parent / "fixtures"
 
@@ -40,6 +41,12 @@ def sanitize_marian_args(args_list: list[str]):
     return args_dict
 
 
+def read_nbest_texts(path: str) -> list[list[str]]:
+    """The texts of the hypotheses of each sentence, from the binary n-best format."""
+    with read_nbest(Path(path)) as sentences:
+        return [[text for text, _score in hypotheses] for hypotheses in sentences]
+
+
 def test_translate_corpus(data_dir: DataDir):
     data_dir.create_zst("file.1.zst", en_sample)
     data_dir.create_file("fake-model.npz", "")
@@ -52,9 +59,13 @@ def test_translate_corpus(data_dir: DataDir):
     )
     data_dir.print_tree()
 
-    output = data_dir.read_text("artifacts/file.1.nbest.zst")
-    for pseudo_translated in en_sample.upper().split("\n"):
-        assert pseudo_translated in output
+    # The fake marian-decoder appends the beam index to the upper cased line, and the
+    # translate-corpus kind writes out the binary n-best format.
+    beam_size = 8
+    assert read_nbest_texts(data_dir.join("artifacts/file.1.nbest.zst")) == [
+        [f"{line.upper().strip()} {beam_index}" for beam_index in range(beam_size)]
+        for line in en_sample.splitlines()
+    ]
 
     args = json.loads(data_dir.read_text("marian-decoder.args.txt"))
     assert sanitize_marian_args(args) == {
@@ -63,8 +74,6 @@ def test_translate_corpus(data_dir: DataDir):
             "<src>/data/tests_data/test_translate/vocab.spm",
             "<src>/data/tests_data/test_translate/vocab.spm",
         ],
-        "input": "<tmp>/file.1",
-        "output": "<tmp>/file.1.nbest",
         "n-best": True,
         "log": "<tmp>/file.1.log",
         "devices": ["0", "1", "2", "3"],
@@ -91,7 +100,7 @@ def test_translate_corpus_empty(data_dir: DataDir):
 
     data_dir.print_tree()
 
-    assert data_dir.read_text("artifacts/file.1.nbest.zst") == "", "The text is empty"
+    assert read_nbest_texts(data_dir.join("artifacts/file.1.nbest.zst")) == [], "No sentences"
 
 
 mono_args = {
@@ -101,8 +110,6 @@ mono_args = {
             "<src>/data/tests_data/test_translate/vocab.spm",
             "<src>/data/tests_data/test_translate/vocab.spm",
         ],
-        "input": "<tmp>/file.1",
-        "output": "<tmp>/file.1.out",
         "log": "<tmp>/file.1.log",
         "devices": ["0", "1", "2", "3"],
         "workspace": "12000",
@@ -117,8 +124,6 @@ mono_args = {
             "<src>/data/tests_data/test_translate/vocab.spm",
             "<src>/data/tests_data/test_translate/vocab.spm",
         ],
-        "input": "<tmp>/file.1",
-        "output": "<tmp>/file.1.out",
         "log": "<tmp>/file.1.log",
         "devices": ["0", "1", "2", "3"],
         "workspace": "12000",
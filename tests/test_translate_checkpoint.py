@@ -0,0 +1,167 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+from fixtures import DataDir
+
+from pipeline.translate.checkpoint import (
+    MANIFEST_NAME,
+    TranslationCheckpoint,
+    read_lines_from_offset,
+)
+from pipeline.translate.collect import ChunkStats
+from pipeline.translate.nbest import read_nbest
+from pipeline.translate.splitter import SplitStats
+
+src_dir = Path(__file__).parent.parent
+fixtures_path = Path(__file__).parent / "fixtures"
+
+BEAM_SIZE = 8
+LINES = [f"line {i}\n" for i in range(7)]
+
+
+@pytest.fixture
+def data_dir():
+    data_dir = DataDir("test_translate_checkpoint")
+    shutil.copyfile("tests/data/vocab.spm", data_dir.join("vocab.spm"))
+    data_dir.create_file("fake-model.npz", "")
+    data_dir.mkdir("artifacts")
+    data_dir.create_zst("file.1.zst", "".join(LINES))
+    return data_dir
+
+
+def preempted_checkpoint(
+    data_dir: DataDir, postfix: str, translated_lines: int, beam_size: int = 1
+) -> Path:
+    """Write a checkpoint for the first lines, as if a previous run was preempted."""
+    checkpoint_dir = Path(data_dir.join("artifacts/checkpoint"))
+    checkpoint = TranslationCheckpoint(
+        checkpoint_dir,
+        Path(data_dir.join("file.1.zst")),
+        Path(data_dir.join(f"artifacts/file.1.{postfix}.zst")),
+    )
+    for index, line in enumerate(LINES[:translated_lines]):
+        text = f"{index} ||| previous run\n" * beam_size
+        checkpoint.write(text, 1, beam_size, len(line.encode("utf-8")))
+    checkpoint.flush()
+    return checkpoint_dir
+
+
+def run_translate(data_dir: DataDir, is_nbest: bool, checkpoint: bool, *args: str) -> None:
+    """Translate with the fake marian-decoder, which upper cases the lines."""
+    subprocess.check_call(
+        [
+            sys.executable,
+            "pipeline/translate/translate.py",
+            *["--input", data_dir.join("file.1.zst")],
+            *["--models_glob", data_dir.join("fake-model.npz")],
+            *["--artifacts", data_dir.join("artifacts")],
+            *["--vocab", data_dir.join("vocab.spm")],
+            *["--marian_dir", str(fixtures_path)],
+            *["--gpus", "0"],
+            *["--workspace", "12000"],
+            *(["--checkpoint_dir", data_dir.join("artifacts/checkpoint")] if checkpoint else []),
+            *(["--nbest"] if is_nbest else []),
+            *args,
+        ],
+        cwd=src_dir,
+        env={**os.environ, "PYTHONPATH": str(src_dir), "TEST_ARTIFACTS": data_dir.path},
+    )
+
+
+def translate(data_dir: DataDir, is_nbest: bool, checkpoint: bool = True) -> list[str]:
+    run_translate(data_dir, is_nbest, checkpoint)
+    postfix = "nbest" if is_nbest else "out"
+    return data_dir.read_text(f"artifacts/file.1.{postfix}.zst").splitlines()
+
+
+def test_translate_with_checkpoint(data_dir):
+    assert translate(data_dir, is_nbest=False) == [line.upper().strip() for line in LINES]
+    args = json.loads(data_dir.read_text("marian-decoder.args.txt"))
+    assert "--input" not in args, "The lines are fed through stdin"
+    assert not os.path.exists(data_dir.join("artifacts/checkpoint"))
+    stats = ChunkStats.load(Path(data_dir.join("artifacts/file.1.out.zst")))
+    assert (stats.input_lines, stats.output_lines) == (7, 7)
+
+
+@pytest.mark.parametrize("is_nbest", [False, True])
+def test_translate_streams_without_checkpoint(data_dir, is_nbest):
+    output = translate(data_dir, is_nbest, checkpoint=False)
+
+    beam_size = BEAM_SIZE if is_nbest else 1
+    assert len(output) == len(LINES) * beam_size
+    assert output[-1] == (f"6 ||| LINE 6 {BEAM_SIZE - 1}" if is_nbest else "LINE 6")
+    args = json.loads(data_dir.read_text("marian-decoder.args.txt"))
+    assert "--input" not in args and "--output" not in args
+    postfix = "nbest" if is_nbest else "out"
+    stats = ChunkStats.load(Path(data_dir.join(f"artifacts/file.1.{postfix}.zst")))
+    assert (stats.input_lines, stats.output_lines) == (7, 7 * beam_size)
+    progress = json.loads(data_dir.read_text("artifacts/file.1.progress.json"))
+    assert progress["lines"] == 7
+    assert progress["bytes"] == len("".join(LINES))
+
+
+@pytest.mark.parametrize("has_stats", [True, False])
+def test_translate_progress_total_lines(data_dir, has_stats):
+    if has_stats:
+        SplitStats(data_dir.join("file.1.zst"), lines=len(LINES)).save_json()
+
+    translate(data_dir, is_nbest=False, checkpoint=False)
+
+    progress = json.loads(data_dir.read_text("artifacts/file.1.progress.json"))
+    # The total is only known from the stats of the splitter, the input isn't counted.
+    assert progress["total_lines"] == (len(LINES) if has_stats else None)
+    assert progress["percent"] == (100.0 if has_stats else None)
+
+
+def test_translate_resumes_nbest(data_dir):
+    preempted_checkpoint(data_dir, "nbest", translated_lines=3, beam_size=BEAM_SIZE)
+
+    assert translate(data_dir, is_nbest=True) == [
+        *[f"{index} ||| previous run" for index in range(3) for _ in range(BEAM_SIZE)],
+        *[
+            f"{index} ||| {line.upper().strip()} {beam}"
+            for index, line in enumerate(LINES)
+            if index >= 3
+            for beam in range(BEAM_SIZE)
+        ],
+    ]
+    stats = ChunkStats.load(Path(data_dir.join("artifacts/file.1.nbest.zst")))
+    assert (stats.input_lines, stats.output_lines) == (7, 7 * BEAM_SIZE)
+
+
+@pytest.mark.parametrize("checkpoint", [True, False])
+def test_translate_binary_nbest(data_dir, checkpoint):
+    run_translate(data_dir, True, checkpoint, "--nbest_format", "binary")
+
+    with read_nbest(Path(data_dir.join("artifacts/file.1.nbest.zst"))) as sentences:
+        assert [[text for text, _ in hypotheses] for hypotheses in sentences] == [
+            [f"{line.upper().strip()} {beam}" for beam in range(BEAM_SIZE)] for line in LINES
+        ]
+    stats = ChunkStats.load(Path(data_dir.join("artifacts/file.1.nbest.zst")))
+    assert (stats.input_lines, stats.output_lines) == (7, 7 * BEAM_SIZE)
+
+
+def test_checkpoint_of_another_input(data_dir):
+    checkpoint_dir = preempted_checkpoint(data_dir, "out", translated_lines=3)
+    with open(checkpoint_dir / MANIFEST_NAME) as file:
+        assert len(json.load(file)["segments"]) == 1
+
+    os.remove(data_dir.join("file.1.zst"))
+    data_dir.create_zst("file.1.zst", "other\n")
+    checkpoint = TranslationCheckpoint(
+        checkpoint_dir,
+        Path(data_dir.join("file.1.zst")),
+        Path(data_dir.join("artifacts/file.1.out.zst")),
+    )
+    assert (checkpoint.input_lines, checkpoint.input_offset) == (0, 0)
+
+
+def test_read_lines_from_offset(data_dir):
+    offset = len("".join(LINES[:2]).encode("utf-8"))
+    with read_lines_from_offset(Path(data_dir.join("file.1.zst")), offset) as lines:
+        assert [line.decode("utf-8") for line in lines] == LINES[2:]
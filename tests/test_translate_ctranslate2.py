@@ -0,0 +1,383 @@
+import io
+import os
+import random
+import tarfile
+import time
+from pathlib import Path
+from typing import Optional
+
+import pytest
+import sentencepiece as spm
+from fixtures import DataDir
+from zstandard import ZstdDecompressor
+
+pytest.importorskip("ctranslate2")
+
+from pipeline.translate.checkpoint import TranslationCheckpoint  # noqa: E402
+from pipeline.translate.collect import ChunkStats  # noqa: E402
+from pipeline.translate.nbest import iter_records  # noqa: E402
+from pipeline.translate.convert_model import main as convert_model_main  # noqa: E402
+from pipeline.translate.translate_ctranslate2 import (  # noqa: E402
+    BackgroundWriter,
+    DecoderConfig,
+    PeakMemory,
+    autotune,
+    convert_model,
+    encode_lines,
+    get_cpu_threads,
+    iterate_in_thread,
+    MaxiBatchSort,
+    get_batches,
+    translate_in_order,
+    translate_with_ctranslate2,
+    write_binary_nbest_translations,
+    write_nbest_translations,
+)
+
+
+class FakeResult:
+    def __init__(self, hypotheses: list[list[str]], scores: Optional[list[float]] = None) -> None:
+        self.hypotheses = hypotheses
+        self.scores = scores
+
+    def result(self) -> "FakeResult":
+        return self
+
+
+class FakeTranslator:
+    """Translates by upper casing the tokens, and records the batches it was given."""
+
+    def __init__(self) -> None:
+        self.batches: list[list[list[str]]] = []
+
+    def translate_batch(self, tokens: list[list[str]], asynchronous: bool, **options):
+        assert asynchronous
+        self.batches.append(tokens)
+        return [FakeResult([[token.upper() for token in line]]) for line in tokens]
+
+
+@pytest.mark.parametrize(
+    "num_threads,num_replicas,expected",
+    [
+        (16, None, (4, 4)),
+        (16, 2, (2, 8)),
+        (3, None, (1, 3)),
+        (2, 8, (2, 1)),
+    ],
+)
+def test_get_cpu_threads(num_threads, num_replicas, expected):
+    assert get_cpu_threads(num_threads, num_replicas) == expected
+
+
+@pytest.mark.parametrize("maxi_batch_sort", [MaxiBatchSort.src, MaxiBatchSort.none])
+def test_get_batches(maxi_batch_sort):
+    rng = random.Random(0)
+    lines = [["tok"] * rng.randint(1, 10) for _ in range(200)]
+
+    batches = list(
+        get_batches(
+            iter(lines), max_batch_tokens=20, maxi_batch=3, maxi_batch_sort=maxi_batch_sort
+        )
+    )
+
+    indices = [index for batch_indices, _ in batches for index in batch_indices]
+    if maxi_batch_sort == MaxiBatchSort.none:
+        assert indices == list(range(200))
+    else:
+        assert sorted(indices) == list(range(200))
+    for batch_indices, batch in batches:
+        assert batch == [lines[index] for index in batch_indices]
+        lengths = [len(line) for line in batch]
+        if maxi_batch_sort == MaxiBatchSort.src:
+            assert lengths == sorted(lengths)
+        assert len(batch) == 1 or len(batch) * max(lengths) <= 20
+
+
+def test_get_batches_sorts_within_maxi_batch():
+    lines = [["tok"] * length for length in [5, 1, 5, 1, 3, 3, 1, 5]]
+
+    batches = get_batches(
+        iter(lines), max_batch_tokens=4, maxi_batch=3, maxi_batch_sort=MaxiBatchSort.src
+    )
+
+    # Lines are read ahead until there are 12 tokens, and sorted by length before batching.
+    assert [indices for indices, _ in batches] == [[1, 3], [0], [2], [6], [4], [5], [7]]
+
+
+def test_translate_in_order():
+    rng = random.Random(1)
+    lines = [[f"tok{rng.randrange(5)}" for _ in range(rng.randint(1, 10))] for _ in range(200)]
+    translator = FakeTranslator()
+
+    results = translate_in_order(
+        translator,
+        get_batches(
+            iter(lines), max_batch_tokens=20, maxi_batch=3, maxi_batch_sort=MaxiBatchSort.src
+        ),
+        max_pending=4,
+    )
+
+    assert [result.hypotheses[0] for result in results] == [
+        [token.upper() for token in line] for line in lines
+    ]
+    assert len(translator.batches) > 1
+
+
+def test_convert_model_cache(monkeypatch):
+    data_dir = DataDir("test_translate_ctranslate2")
+    data_dir.create_file("model.npz", "weights")
+    data_dir.create_file("vocab.spm", "vocab")
+    conversions = []
+
+    class FakeConverter:
+        def __init__(self, model, vocab) -> None:
+            self.model = model
+
+        def convert(self, output_dir, quantization, force):
+            conversions.append(quantization)
+            with open(f"{output_dir}/model.bin", "w") as file:
+                file.write(quantization)
+
+    monkeypatch.setattr("pipeline.translate.translate_ctranslate2.MarianConverter", FakeConverter)
+    model = Path(data_dir.join("model.npz"))
+    cache_dir = Path(data_dir.join("cache"))
+    vocab = [data_dir.join("vocab.spm")]
+
+    model_dir = convert_model(model, vocab, "float16", cache_dir)
+    assert (model_dir / "model.bin").read_text() == "float16"
+    assert convert_model(model, vocab, "float16", cache_dir) == model_dir
+    assert conversions == ["float16"]
+
+    assert convert_model(model, vocab, "int8", cache_dir) != model_dir
+    model.write_text("other weights")
+    assert convert_model(model, vocab, "float16", cache_dir) != model_dir
+    assert conversions == ["float16", "int8", "float16"]
+    # Only the renamed conversions are left in the cache.
+    assert len(list(cache_dir.iterdir())) == 3
+
+
+@pytest.mark.parametrize("decoder", ["ctranslate2", "marian"])
+def test_convert_model_archive(monkeypatch, decoder: str):
+    """The archived conversion is reused from the model cache of a chunk task."""
+    data_dir = DataDir("test_translate_ctranslate2")
+    data_dir.create_file("model.npz", "weights")
+    data_dir.create_file("vocab.spm", "vocab")
+    conversions = []
+
+    class FakeConverter:
+        def __init__(self, model, vocab) -> None:
+            pass
+
+        def convert(self, output_dir, quantization, force):
+            conversions.append(quantization)
+            with open(f"{output_dir}/model.bin", "w") as file:
+                file.write(quantization)
+
+    monkeypatch.setattr("pipeline.translate.translate_ctranslate2.MarianConverter", FakeConverter)
+    convert_model_main(
+        [
+            *["--models_glob", data_dir.join("model.npz")],
+            *["--vocab", data_dir.join("vocab.spm")],
+            *["--artifacts", data_dir.join("artifacts")],
+            *["--decoder", decoder],
+        ]
+    )
+
+    # Extract the archive like the fetches of a chunk task.
+    cache_dir = Path(data_dir.join("fetches/ctranslate2-models"))
+    cache_dir.mkdir(parents=True)
+    with open(data_dir.join("artifacts/ctranslate2-model.tar.zst"), "rb") as file:
+        with ZstdDecompressor().stream_reader(file) as reader:
+            with tarfile.open(fileobj=reader, mode="r|") as tar:
+                tar.extractall(cache_dir)
+
+    model = Path(data_dir.join("model.npz"))
+    vocab = [data_dir.join("vocab.spm")]
+    precision = DecoderConfig([]).precision
+    if decoder == "ctranslate2":
+        assert conversions == [precision]
+        model_dir = convert_model(model, vocab, precision, cache_dir)
+        assert (model_dir / "model.bin").read_text() == precision
+        assert conversions == [precision], "The archived conversion was used"
+    else:
+        assert conversions == []
+        assert list(cache_dir.iterdir()) == []
+
+
+def test_iterate_in_thread():
+    assert list(iterate_in_thread(iter(range(100)), maxsize=2)) == list(range(100))
+
+    def failing():
+        yield 1
+        raise ValueError("Failed to read")
+
+    with pytest.raises(ValueError):
+        list(iterate_in_thread(failing(), maxsize=2))
+
+
+def test_background_writer():
+    written = []
+    writer = BackgroundWriter(written.append, maxsize=2)
+    for batch in range(50):
+        writer.put(batch)
+    writer.close()
+    assert written == list(range(50))
+
+    def fail(_batch):
+        raise ValueError("Failed to write")
+
+    writer = BackgroundWriter(fail, maxsize=2)
+    writer.put(0)
+    with pytest.raises(ValueError):
+        writer.close()
+
+
+def test_encode_and_write_nbest():
+    tokenizer = spm.SentencePieceProcessor("tests/data/vocab.spm")
+    lines = ["Hello world\n", "  The second line \n", "\n"]
+    ((input_bytes, encoded),) = list(
+        encode_lines(iter(line.encode() for line in lines), tokenizer)
+    )
+    assert input_bytes == len("".join(lines))
+    assert encoded == [tokenizer.encode(line.strip(), out_type=str) for line in lines]
+
+    outfile = io.StringIO()
+    results = [FakeResult([encoded[0], encoded[1]]), FakeResult([encoded[2], encoded[0]])]
+    assert write_nbest_translations(5, tokenizer, results, outfile) == 4
+    assert outfile.getvalue() == (
+        "5 ||| Hello world\n5 ||| The second line\n6 ||| \n6 ||| Hello world\n"
+    )
+
+
+def test_write_binary_nbest():
+    tokenizer = spm.SentencePieceProcessor("tests/data/vocab.spm")
+    hello, second = tokenizer.encode(["Hello world", "The second line"], out_type=str)
+    results = [FakeResult([hello, second], [-0.5, -1.5]), FakeResult([[]], [-2.0])]
+
+    outfile = io.BytesIO()
+    assert write_binary_nbest_translations(5, tokenizer, results, outfile) == 3
+
+    outfile.seek(0)
+    assert list(iter_records(outfile)) == [
+        [("Hello world", -0.5), ("The second line", -1.5)],
+        [("", -2.0)],
+    ]
+
+
+def test_translate_resumes_from_checkpoint(monkeypatch):
+    data_dir = DataDir("test_translate_ctranslate2_checkpoint")
+    lines = [f"hello world {i}\n" for i in range(5)]
+    data_dir.create_zst("file.1.zst", "".join(lines))
+    data_dir.create_file("model.npz", "")
+    data_dir.mkdir("artifacts")
+    translated = []
+
+    class Translator:
+        """Translates the tokens as they are, so the output is the input."""
+
+        num_translators = 1
+
+        def __init__(self, *args, **kwargs) -> None:
+            pass
+
+        def load_model(self) -> None:
+            pass
+
+        def translate_batch(self, tokens, asynchronous: bool, **options):
+            translated.extend(tokens)
+            return [FakeResult([line]) for line in tokens]
+
+    monkeypatch.setattr(
+        "pipeline.translate.translate_ctranslate2.ctranslate2.Translator", Translator
+    )
+    monkeypatch.setattr(
+        "pipeline.translate.translate_ctranslate2.convert_model", lambda *args: data_dir.path
+    )
+
+    # A previous run was preempted after the first two lines.
+    input_zst = Path(data_dir.join("file.1.zst"))
+    output_zst = Path(data_dir.join("artifacts/file.1.out.zst"))
+    checkpoint = TranslationCheckpoint(Path(data_dir.join("checkpoint")), input_zst, output_zst)
+    checkpoint.write("previous run\n" * 2, 2, 2, len("".join(lines[:2])))
+    checkpoint.flush()
+
+    translate_with_ctranslate2(
+        input_zst=input_zst,
+        artifacts=Path(data_dir.join("artifacts")),
+        extra_marian_args=["--"],
+        models_globs=[data_dir.join("model.npz")],
+        is_nbest=False,
+        vocab=["tests/data/vocab.spm"],
+        device="cpu",
+        device_index=[0],
+        checkpoint=checkpoint,
+    )
+
+    assert data_dir.read_text("artifacts/file.1.out.zst").splitlines() == [
+        "previous run",
+        "previous run",
+        *[line.strip() for line in lines[2:]],
+    ]
+    assert len(translated) == 3, "Only the remaining lines are translated"
+    stats = ChunkStats.load(output_zst)
+    assert (stats.input_lines, stats.output_lines) == (5, 5)
+    assert not os.path.exists(data_dir.join("checkpoint"))
+
+
+def test_autotune(monkeypatch):
+    class Translator:
+        """Translates a batch faster with int8, so that the larger batches are faster too."""
+
+        def __init__(self, model_dir, device, compute_type, inter_threads, intra_threads):
+            self.compute_type = compute_type
+            self.num_translators = inter_threads
+
+        def translate_batch(self, tokens, asynchronous: bool, **options):
+            time.sleep(0.05 if self.compute_type == "int8" else 0.1)
+            return [FakeResult([line]) for line in tokens]
+
+    monkeypatch.setattr(
+        "pipeline.translate.translate_ctranslate2.ctranslate2.Translator", Translator
+    )
+    monkeypatch.setattr(
+        "pipeline.translate.translate_ctranslate2.ctranslate2.get_supported_compute_types",
+        lambda *args: {"int8", "int16", "float32"},
+    )
+    decoder_config = DecoderConfig(["--mini-batch-words", "1000", "--maxi-batch", "1"])
+    sample = [["tok"] * 10 for _ in range(600)]
+
+    best, trials = autotune(
+        Path("model"), "cpu", [0], sample, decoder_config, num_threads=4, options={}
+    )
+
+    assert best.compute_type == "int8"
+    # The whole sample fits in one batch of either size.
+    assert best.max_batch_tokens in (8000, 16000)
+    # The compute types and thread splits are measured first, and then the other batch sizes.
+    assert [(trial["compute_type"], trial["inter_threads"]) for trial in trials[:6]] == [
+        ("int8", 1),
+        ("int8", 2),
+        ("int8", 4),
+        ("float32", 1),
+        ("float32", 2),
+        ("float32", 4),
+    ]
+    assert [trial["max_batch_tokens"] for trial in trials[6:]] == [500, 2000, 4000, 8000, 16000]
+    # The fake translator may not use any memory beyond what the process already holds.
+    assert all(trial["peak_memory_bytes"] >= 0 for trial in trials)
+
+
+def test_peak_memory_per_trial():
+    used_bytes = [3000]
+
+    def measure_trial(trial_bytes: int) -> int:
+        memory = PeakMemory("cpu", [0], interval_seconds=0.01)
+        memory.get_used_bytes = lambda: used_bytes[0]
+        with memory:
+            used_bytes[0] += trial_bytes
+            time.sleep(0.1)
+        return memory.peak_bytes
+
+    assert measure_trial(2000) == 2000
+    # The process holds on to the memory of the first trial, which isn't counted again.
+    assert measure_trial(500) == 500
@@ -0,0 +1,130 @@
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+from fixtures import DataDir
+
+from pipeline.translate.memo import get_model_key, group_nbest
+
+src_dir = Path(__file__).parent.parent
+fixtures_path = Path(__file__).parent / "fixtures"
+
+BEAM_SIZE = 8
+
+
+@pytest.fixture
+def data_dir():
+    data_dir = DataDir("test_translate_memo")
+    shutil.copyfile("tests/data/vocab.spm", data_dir.join("vocab.spm"))
+    data_dir.create_file("fake-model.npz", "")
+    data_dir.mkdir("artifacts")
+    return data_dir
+
+
+def translate(
+    data_dir: DataDir, name: str, lines: list[str], is_nbest: bool, *args: str
+) -> list[str]:
+    """Translate with the fake marian-decoder, which upper cases the lines."""
+    data_dir.create_zst(name, "".join(f"{line}\n" for line in lines))
+    subprocess.check_call(
+        [
+            sys.executable,
+            "pipeline/translate/translate.py",
+            *["--input", data_dir.join(name)],
+            *["--models_glob", data_dir.join("fake-model.npz")],
+            *["--artifacts", data_dir.join("artifacts")],
+            *["--vocab", data_dir.join("vocab.spm")],
+            *["--marian_dir", str(fixtures_path)],
+            *["--gpus", "0"],
+            *["--workspace", "12000"],
+            *["--translation_memo", data_dir.join("memo.db")],
+            *(["--nbest"] if is_nbest else []),
+            *args,
+        ],
+        cwd=src_dir,
+        env={**os.environ, "PYTHONPATH": str(src_dir), "TEST_ARTIFACTS": data_dir.path},
+    )
+    postfix = "nbest" if is_nbest else "out"
+    return data_dir.read_text(f"artifacts/{Path(name).stem}.{postfix}.zst").splitlines()
+
+
+def count_memo(data_dir: DataDir) -> int:
+    with sqlite3.connect(data_dir.join("memo.db")) as connection:
+        return connection.execute("SELECT COUNT(*) FROM translations").fetchone()[0]
+
+
+def test_translation_memo(data_dir):
+    lines = ["one", "two", "one", "three", "two"]
+    assert translate(data_dir, "file.1.zst", lines, is_nbest=False) == [
+        line.upper() for line in lines
+    ]
+    assert count_memo(data_dir) == 3
+    # The progress of translating the unique lines is published next to the output.
+    progress = json.loads(data_dir.read_text("artifacts/file.1.progress.json"))
+    assert (progress["lines"], progress["total_lines"]) == (3, 3)
+
+    # Only the new line is translated.
+    assert translate(data_dir, "file.2.zst", ["three", "four", "one"], is_nbest=False) == [
+        "THREE",
+        "FOUR",
+        "ONE",
+    ]
+    assert count_memo(data_dir) == 4
+
+    # When everything was translated before, Marian is not run at all.
+    os.remove(data_dir.join("marian-decoder.args.txt"))
+    assert translate(data_dir, "file.3.zst", ["four", "four"], is_nbest=False) == [
+        "FOUR",
+        "FOUR",
+    ]
+    assert not os.path.exists(data_dir.join("marian-decoder.args.txt"))
+
+
+def test_translation_memo_nbest(data_dir):
+    lines = ["one", "two", "one"]
+    output = translate(data_dir, "file.1.zst", lines, is_nbest=True)
+
+    assert output == [
+        f"{index} ||| {line.upper()} {beam}"
+        for index, line in enumerate(lines)
+        for beam in range(BEAM_SIZE)
+    ]
+    # The n-best translations are stored per unique line.
+    assert count_memo(data_dir) == 2
+
+
+def test_translation_memo_decoder_config(data_dir):
+    translate(data_dir, "file.1.zst", ["one"], True)
+    assert count_memo(data_dir) == 1
+
+    # The beam size of decoder.yml is overridden, so the translations are not reused.
+    output = translate(data_dir, "file.2.zst", ["one"], True, "--", "--beam-size", "4")
+    assert output == [f"0 ||| ONE {beam}" for beam in range(4)]
+    assert count_memo(data_dir) == 2
+
+
+def test_model_key(data_dir):
+    models = [Path(data_dir.join("fake-model.npz"))]
+    vocab = Path(data_dir.join("vocab.spm"))
+    config = {"beam-size": 8, "normalize": 1.0}
+
+    def get_key(**kwargs) -> str:
+        settings = dict(decoder="ctranslate2", device="gpu", is_nbest=False)
+        settings.update(decoder_config=config, compute_type="int8")
+        settings.update(kwargs)
+        return get_model_key(models, vocab, **settings)
+
+    assert get_key() == get_key(decoder_config=dict(reversed(config.items())))
+    assert get_key() != get_key(decoder_config={**config, "normalize": 0.6})
+    assert get_key() != get_key(compute_type="float16")
+    assert get_key() != get_key(device="cpu")
+
+
+def test_group_nbest():
+    lines = ["0 ||| a ||| F0= -1\n", "0 ||| b ||| F0= -2\n", "1 |||  ||| F0= 0\n"]
+    assert list(group_nbest(lines)) == [["a ||| F0= -1", "b ||| F0= -2"], [" ||| F0= 0"]]
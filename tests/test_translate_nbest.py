@@ -0,0 +1,105 @@
+import sys
+from pathlib import Path
+
+import pytest
+from fixtures import DataDir
+from zstandard import ZstdDecompressor
+
+from pipeline.translate import extract_best
+from pipeline.translate.nbest import (
+    HEADER,
+    NbestWriter,
+    convert_text_nbest,
+    encode_records,
+    is_binary_nbest,
+    parse_text_nbest,
+    read_nbest,
+)
+
+# Marian's scores, and an empty hypothesis that lost the trailing space.
+text_nbest = """0 ||| Реформа идет слишком медленно. ||| F0= -9.21191 F1= -11.53 ||| -1.22059
+0 ||| Реформа проходит слишком медленно. ||| F0= -10.1025 F1= -11.1262 ||| -1.24908
+1 ||| Помощь по-прежнему раздроблена. ||| F0= -7.23773 F1= -8.77496 ||| -0.842928
+1 |||
+"""
+
+sentences = [
+    [
+        ("Реформа идет слишком медленно.", -1.22059),
+        ("Реформа проходит слишком медленно.", -1.24908),
+    ],
+    [("Помощь по-прежнему раздроблена.", -0.842928), ("", 0.0)],
+]
+
+
+def assert_sentences(actual, expected):
+    assert [[text for text, _ in hypotheses] for hypotheses in actual] == [
+        [text for text, _ in hypotheses] for hypotheses in expected
+    ]
+    for actual_hypotheses, expected_hypotheses in zip(actual, expected):
+        for (_, actual_score), (_, expected_score) in zip(actual_hypotheses, expected_hypotheses):
+            # The scores are stored as 32 bit floats.
+            assert actual_score == pytest.approx(expected_score, abs=1e-6)
+
+
+def test_parse_text_nbest():
+    assert_sentences(list(parse_text_nbest(text_nbest.splitlines())), sentences)
+
+
+@pytest.mark.parametrize("compressed", [True, False])
+def test_read_concatenated_blocks(compressed):
+    data_dir = DataDir("test_translate_nbest")
+    path = Path(data_dir.join("file.1.nbest.zst"))
+    with NbestWriter(path) as writer:
+        writer.write(encode_records(sentences[:1]))
+        writer.write(encode_records([]))
+        writer.write(encode_records(sentences[1:]))
+    if not compressed:
+        with open(path, "rb") as file:
+            decompressed = ZstdDecompressor().stream_reader(file, read_across_frames=True).read()
+        assert decompressed.count(HEADER) == 3
+        path = Path(data_dir.join("file.1.nbest"))
+        path.write_bytes(decompressed)
+
+    assert is_binary_nbest(path)
+    with read_nbest(path) as records:
+        assert_sentences(list(records), sentences)
+
+
+def test_convert_text_nbest():
+    data_dir = DataDir("test_translate_nbest")
+    data_dir.create_zst("file.1.nbest.zst", text_nbest)
+    path = Path(data_dir.join("file.1.nbest.zst"))
+    assert not is_binary_nbest(path)
+
+    assert convert_text_nbest(path, path) == (2, 4)
+
+    assert is_binary_nbest(path)
+    with read_nbest(path) as records:
+        assert_sentences(list(records), sentences)
+
+
+def test_extract_best_from_binary(monkeypatch):
+    data_dir = DataDir("test_translate_nbest")
+    with NbestWriter(Path(data_dir.join("file.1.nbest.zst"))) as writer:
+        writer.write(encode_records(sentences))
+    data_dir.create_file(
+        "file.1.ref", "Реформа проходит слишком медленно.\nПомощь по-прежнему раздроблена.\n"
+    )
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "extract_best.py",
+            *["--nbest", data_dir.join("file.1.nbest.zst")],
+            *["--references", data_dir.join("file.1.ref")],
+            *["--output", data_dir.join("file.1.nbest.out")],
+            *["--metric", "chrf"],
+        ],
+    )
+
+    extract_best.main()
+
+    assert data_dir.read_text("file.1.nbest.out") == (
+        "Реформа проходит слишком медленно.\nПомощь по-прежнему раздроблена.\n"
+    )
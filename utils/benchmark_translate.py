@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+Benchmark the throughput of the translate step on a CPU, so that a change to translate.py,
+translate_ctranslate2.py or decoder.yml can be measured before and after.
+
+A tiny, randomly initialized transformer is built in the CTranslate2 format, along with a
+SentencePiece vocab that is trained on the fixture text in tests/data. The model is placed in a
+CTranslate2 model cache, so that the translate entry point runs unchanged without a Marian
+model to convert. Synthetic corpora with different sentence length distributions are then
+translated, and the throughput is written out as JSON.
+
+The translations of a random model are meaningless, and the decoding stops at a random length
+that doesn't follow the length of the input. A few sentences of each corpus decode until the
+maximum length, so the numbers are only comparable between runs with the same settings on the
+same machine, and not between the distributions.
+
+Usage:
+
+    task benchmark-translate
+    task benchmark-translate -- --lines 5000 --distributions short long -- --beam-size 4
+
+The arguments after the "--" are passed to translate.py as the Marian decoder args, which
+override pipeline/translate/decoder.yml.
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+import zipfile
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import ctranslate2
+import numpy as np
+import sentencepiece as spm
+from ctranslate2.specs import transformer_spec
+
+from pipeline.common.downloads import write_lines
+from pipeline.common.logging import get_logger
+from pipeline.translate.translate_ctranslate2 import DecoderConfig, get_converted_model_dir
+
+logger = get_logger(__file__)
+
+ROOT_DIR = Path(__file__).parent.parent
+FIXTURE_ZIP = ROOT_DIR / "tests/data/corpus_samples/en-ru.txt.zip"
+FIXTURE_NAME = "ELRC-3075-wikipedia_health.en-ru.en"
+
+# The sentence lengths in words of the synthetic corpora.
+DISTRIBUTIONS: dict[str, Callable[[random.Random], int]] = {
+    "short": lambda rng: rng.randint(1, 8),
+    "medium": lambda rng: rng.randint(8, 30),
+    "long": lambda rng: rng.randint(40, 120),
+    # A long tail of lengths, like a crawled corpus.
+    "mixed": lambda rng: min(200, max(1, round(rng.lognormvariate(math.log(15), 0.8)))),
+}
+
+
+def read_fixture_text() -> list[str]:
+    with zipfile.ZipFile(FIXTURE_ZIP) as archive:
+        text = archive.read(FIXTURE_NAME).decode("utf-8")
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+def train_vocab(lines: list[str], work_dir: Path, vocab_size: int) -> Path:
+    """Train a SentencePiece vocab on the fixture text, which is named like the pipeline's."""
+    text_path = work_dir / "vocab-training.txt"
+    text_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    spm.SentencePieceTrainer.train(
+        input=str(text_path),
+        model_prefix=str(work_dir / "vocab"),
+        vocab_size=vocab_size,
+        minloglevel=2,
+    )
+    vocab_path = work_dir / "vocab.spm"
+    (work_dir / "vocab.model").rename(vocab_path)
+    return vocab_path
+
+
+def build_random_model(
+    model_dir: Path,
+    vocab: list[str],
+    dim: int,
+    ffn_dim: int,
+    layers: int,
+    heads: int,
+    eos_bias: float,
+    seed: int,
+) -> None:
+    """
+    Build a transformer with random weights in the CTranslate2 format. The output projection is
+    biased towards the end of sentence token, so that most of the decoding stops after tens of
+    tokens instead of running to the maximum length.
+    """
+    spec = transformer_spec.TransformerSpec.from_config(num_layers=layers, num_heads=heads)
+    rng = np.random.default_rng(seed)
+
+    def weight(*shape: int) -> np.ndarray:
+        return (rng.standard_normal(shape) / math.sqrt(shape[-1])).astype(np.float32)
+
+    def set_layer_norm(layer_norm) -> None:
+        layer_norm.gamma = np.ones(dim, dtype=np.float32)
+        layer_norm.beta = np.zeros(dim, dtype=np.float32)
+
+    def set_attention(attention, is_self_attention: bool) -> None:
+        set_layer_norm(attention.layer_norm)
+        if is_self_attention:
+            # The queries, keys and values are fused.
+            shapes = [(3 * dim, dim), (dim, dim)]
+        else:
+            # The queries, the fused keys and values of the encoder output, and the output.
+            shapes = [(dim, dim), (2 * dim, dim), (dim, dim)]
+        for linear, shape in zip(attention.linear, shapes):
+            linear.weight = weight(*shape)
+
+    def set_ffn(ffn) -> None:
+        set_layer_norm(ffn.layer_norm)
+        ffn.linear_0.weight = weight(ffn_dim, dim)
+        ffn.linear_1.weight = weight(dim, ffn_dim)
+
+    spec.encoder.embeddings[0].weight = weight(len(vocab), dim)
+    set_layer_norm(spec.encoder.layer_norm)
+    for layer in spec.encoder.layer:
+        set_attention(layer.self_attention, is_self_attention=True)
+        set_ffn(layer.ffn)
+
+    spec.decoder.embeddings.weight = weight(len(vocab), dim)
+    set_layer_norm(spec.decoder.layer_norm)
+    spec.decoder.projection.weight = weight(len(vocab), dim)
+    bias = np.zeros(len(vocab), dtype=np.float32)
+    bias[vocab.index("</s>")] = eos_bias
+    spec.decoder.projection.bias = bias
+    for layer in spec.decoder.layer:
+        set_attention(layer.self_attention, is_self_attention=True)
+        set_attention(layer.attention, is_self_attention=False)
+        set_ffn(layer.ffn)
+
+    spec.register_source_vocabulary(vocab)
+    spec.register_target_vocabulary(vocab)
+    spec.validate()
+    spec.optimize()
+    spec.save(str(model_dir))
+
+
+def write_corpus(
+    path: Path, words: list[str], distribution: str, num_lines: int, seed: int
+) -> None:
+    """Write sentences of random words, with lengths that follow the distribution."""
+    rng = random.Random(f"{seed}-{distribution}")
+    get_length = DISTRIBUTIONS[distribution]
+    with write_lines(path) as outfile:
+        for _ in range(num_lines):
+            outfile.write(" ".join(rng.choices(words, k=get_length(rng))) + "\n")
+
+
+def run_translate(
+    corpus: Path, model: Path, vocab: Path, model_cache: Path, artifacts: Path, marian_args: list
+) -> dict[str, Any]:
+    """
+    Run the translate entry point, and measure it. The peak RSS is the one of the translate
+    process, which os.wait4 reports for just that child.
+    """
+    shutil.rmtree(artifacts, ignore_errors=True)
+    artifacts.mkdir(parents=True)
+    command = [
+        sys.executable,
+        str(ROOT_DIR / "pipeline/translate/translate.py"),
+        *["--input", str(corpus)],
+        *["--models_glob", str(model)],
+        *["--artifacts", str(artifacts)],
+        *["--vocab", str(vocab)],
+        # Marian isn't used, but the argument is required.
+        *["--marian_dir", str(model.parent)],
+        *["--gpus", "0"],
+        *["--workspace", "0"],
+        *["--decoder", "ctranslate2"],
+        *["--device", "cpu"],
+        *["--ctranslate2_model_cache", str(model_cache)],
+        "--",
+        *marian_args,
+    ]
+    logger.info(f"Translating {corpus.name}")
+    start = time.monotonic()
+    process = subprocess.Popen(
+        command, env={**os.environ, "PYTHONPATH": str(ROOT_DIR)}, stdout=subprocess.DEVNULL
+    )
+    _pid, status, rusage = os.wait4(process.pid, 0)
+    wall_seconds = time.monotonic() - start
+    # The process was reaped by os.wait4, so record its exit code for Popen.
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+    with open(artifacts / f"{corpus.stem}.progress.json", encoding="utf-8") as file:
+        progress = json.load(file)
+    # The throughput is measured by translate.py from the start of the translation, which
+    # includes loading the model but not starting Python.
+    return {
+        "lines": progress["lines"],
+        "source_tokens": progress["tokens"],
+        "wall_seconds": round(wall_seconds, 3),
+        "sentences_per_second": round(progress["lines_per_second"], 1),
+        "tokens_per_second": round(progress["tokens_per_second"], 1),
+        "time_to_first_output_seconds": progress["first_output_seconds"],
+        # ru_maxrss is in kilobytes on Linux.
+        "peak_rss_bytes": rusage.ru_maxrss * 1024,
+    }
+
+
+def summarize(runs: list[dict[str, Any]]) -> dict[str, Any]:
+    """The median of each measurement over the repeated runs."""
+    return {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+
+
+def get_git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args_list: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        # Preserves whitespace in the help text.
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=ROOT_DIR / "data/benchmarks/translate.json",
+        help="The JSON report (default: data/benchmarks/translate.json)",
+    )
+    parser.add_argument(
+        "--work_dir",
+        type=Path,
+        default=ROOT_DIR / "data/benchmarks/translate",
+        help="Where the model, the vocab and the corpora are built (default: "
+        "data/benchmarks/translate)",
+    )
+    parser.add_argument(
+        "--distributions",
+        nargs="+",
+        choices=list(DISTRIBUTIONS),
+        default=list(DISTRIBUTIONS),
+        help="The sentence length distributions of the corpora (default: all of them)",
+    )
+    parser.add_argument(
+        "--lines", type=int, default=1000, help="The lines of each corpus (default: 1000)"
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=1,
+        help="Translate each corpus this many times, and report the medians (default: 1)",
+    )
+    parser.add_argument("--vocab_size", type=int, default=2000)
+    parser.add_argument("--dim", type=int, default=64, help="The model dimension (default: 64)")
+    parser.add_argument("--ffn_dim", type=int, default=256)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--heads", type=int, default=4)
+    parser.add_argument(
+        "--eos_bias",
+        type=float,
+        default=2.5,
+        help="The bias of the model towards ending a sentence, which controls the output "
+        "lengths. With the default of 2.5, the mean output is about 10 tokens.",
+    )
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument(
+        "marian_args",
+        nargs=argparse.REMAINDER,
+        help="The Marian decoder args for translate.py, after a --",
+    )
+    args = parser.parse_args(args_list)
+    marian_args: list[str] = args.marian_args
+    if marian_args and marian_args[0] == "--":
+        marian_args = marian_args[1:]
+
+    work_dir: Path = args.work_dir
+    shutil.rmtree(work_dir, ignore_errors=True)
+    work_dir.mkdir(parents=True)
+
+    fixture_lines = read_fixture_text()
+    vocab_path = train_vocab(fixture_lines, work_dir, args.vocab_size)
+    tokenizer = spm.SentencePieceProcessor(str(vocab_path))
+    vocab = [tokenizer.id_to_piece(i) for i in range(tokenizer.vocab_size())]
+
+    # The model placeholder only determines the key of the model cache, so it records the
+    # model settings.
+    model_settings = {
+        key: getattr(args, key)
+        for key in ("dim", "ffn_dim", "layers", "heads", "eos_bias", "seed")
+    }
+    model = work_dir / "model.npz"
+    model.write_text(json.dumps(model_settings), encoding="utf-8")
+    model_cache = work_dir / "model-cache"
+    precision = DecoderConfig(marian_args).precision
+    model_dir = get_converted_model_dir(model, [str(vocab_path)], precision, model_cache)
+    model_dir.mkdir(parents=True)
+    logger.info(f"Building a random model with {model_settings}")
+    build_random_model(model_dir, vocab, **model_settings)
+
+    words = [word for line in fixture_lines for word in line.split()]
+    results = []
+    for distribution in args.distributions:
+        corpus = work_dir / f"{distribution}.zst"
+        write_corpus(corpus, words, distribution, args.lines, args.seed)
+        runs = [
+            run_translate(
+                corpus, model, vocab_path, model_cache, work_dir / "artifacts", marian_args
+            )
+            for _ in range(args.repeats)
+        ]
+        result = {"distribution": distribution, **summarize(runs), "runs": runs}
+        logger.info(
+            f"{distribution}: {result['sentences_per_second']:,.1f} sentences/second, "
+            f"{result['tokens_per_second']:,.1f} tokens/second, "
+            f"first output after {result['time_to_first_output_seconds']}s, "
+            f"peak RSS {result['peak_rss_bytes'] / 2**20:,.0f} MiB"
+        )
+        results.append(result)
+
+    report = {
+        "environment": {
+            "cpu_count": os.cpu_count(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "ctranslate2": ctranslate2.__version__,
+            "git_revision": get_git_revision(),
+        },
+        "settings": {
+            "lines": args.lines,
+            "repeats": args.repeats,
+            "vocab_size": args.vocab_size,
+            "model": model_settings,
+            "marian_args": marian_args,
+        },
+        "results": results,
+    }
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    logger.info(f"Wrote the report to {args.output}")
+
+
+if __name__ == "__main__":
+    main()